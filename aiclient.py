@@ -4,13 +4,86 @@ Módulo que define la clase abstracta base para todos los cliente de IA.
 Cada cliente específico extenderá esta clase.
 """
 
+from java.lang import Thread
+from java.util.concurrent import Callable, Executors, FutureTask, ThreadFactory
+
+
+class AIRequest(FutureTask):
+    """
+    Petición asíncrona a un cliente de IA (java.util.concurrent.Future).
+    Además de la cancelación estándar, cancelar una petición que ya se está
+    ejecutando aborta su conexión con el modelo, liberando el hilo y el socket
+    sin esperar a la respuesta. Solo se cierran las conexiones que ha abierto
+    el hilo que la ejecuta; las de otras peticiones del cliente (por ejemplo,
+    la preparación de la cache de contexto) no se ven afectadas.
+    """
+    def __init__(self, aiclient, function):
+        callable = _RequestCallable(function)
+        FutureTask.__init__(self, callable)
+        callable.request = self
+        self.aiclient = aiclient
+        self.running = False
+        self.thread = None
+
+    def cancel(self, may_interrupt=True):
+        running = self.running
+        thread = self.thread
+        cancelled = FutureTask.cancel(self, may_interrupt)
+        if cancelled and running:
+            self.aiclient.abort(thread)
+        return cancelled
+
+class _RequestCallable(Callable):
+    def __init__(self, function):
+        self.request = None
+        self.function = function
+
+    def call(self):
+        self.request.thread = Thread.currentThread()
+        self.request.running = True
+        try:
+            return self.function()
+        finally:
+            self.request.running = False
+
+class _DaemonThreadFactory(ThreadFactory):
+    def newThread(self, runnable):
+        thread = Thread(runnable, "chatagent-aiclient")
+        thread.setDaemon(True)
+        return thread
+
+
 class AIClient:
     """
     Clase abstracta base para los distintos clientes de IA.
     Define la interfaz común que deben implementar todos los clientes específicos.
     """
-    def __init__(self):
-      pass
+    def __init__(self, executor=None):
+      """
+      Args:
+          executor (optional): Executor en el que se ejecutan las peticiones asíncronas.
+                               Los clientes que envuelven a otro usan el de este, de forma
+                               que no se crea un hilo por cada envoltorio. Por defecto se
+                               crea uno con un único hilo.
+      """
+      self.response_schema = None
+      if executor is None:
+          # Un único hilo: las peticiones asíncronas se atienden en orden
+          executor = Executors.newSingleThreadExecutor(_DaemonThreadFactory())
+      self.executor = executor
+
+    def set_response_schema(self, schema):
+        """
+        Establece el esquema JSON que deben cumplir las respuestas del modelo.
+        Los clientes que soporten salida estructurada lo enviarán al modelo
+        para que responda directamente con un objeto JSON válido; el resto
+        pueden ignorarlo.
+
+        Args:
+            schema (dict): Esquema con la sintaxis de JSON Schema, o None para
+                           no restringir la respuesta.
+        """
+        self.response_schema = schema
       
     def resetHistory(self):
         """
@@ -20,7 +93,7 @@ class AIClient:
         raise NotImplementedError("El método resetHistory debe ser implementado por las subclases.")
         
 
-    def send_message(self, user_prompt, initial_prompt=None, temperature=None):
+    def send_message(self, user_prompt, initial_prompt=None, temperature=None, turn_context=None):
         """
         Envía un mensaje al modelo de IA, gestionando el historial de la conversación.
 
@@ -32,6 +105,9 @@ class AIClient:
                                             Útil para establecer el contexto inicial de la conversación.
                                             Por defecto es None.
             temperature (float, optional): La temperatura de generación para esta solicitud específica.
+            turn_context (str, optional): Instrucciones que se envían junto al mensaje solo en
+                                          este turno (ver with_turn_context). No se guardan en el
+                                          historial, que conserva solo el mensaje del usuario.
 
         Returns:
             str: La respuesta generada por el modelo de IA.
@@ -40,6 +116,119 @@ class AIClient:
         """
         raise NotImplementedError("El método send_message debe ser implementado por las subclases.")
 
+    def add_exchange(self, user_prompt, response, initial_prompt=None):
+        """
+        Añade al historial de la conversación un intercambio (mensaje del usuario y
+        respuesta del modelo) obtenido sin llamar al modelo, por ejemplo desde una cache.
+        De esta forma las siguientes llamadas a send_message mantienen el contexto.
+
+        Args:
+            user_prompt (str): El mensaje del usuario.
+            response (str): La respuesta del modelo a ese mensaje.
+            initial_prompt (str, optional): Mensaje inicial, que se añade solo si el historial está vacío.
+        """
+        raise NotImplementedError("El método add_exchange debe ser implementado por las subclases.")
+
+    def send_message_stream(self, user_prompt, initial_prompt=None, temperature=None, on_chunk=None, turn_context=None):
+        """
+        Envía un mensaje al modelo de IA recibiendo la respuesta en streaming.
+        Cada fragmento de texto se notifica a 'on_chunk' según va llegando, de forma
+        que la interfaz pueda mostrarlo sin esperar a la respuesta completa.
+
+        La implementación por defecto no hace streaming: llama a send_message y
+        notifica la respuesta completa como un único fragmento. Los clientes que
+        soporten streaming deben sobrescribir este método.
+
+        Args:
+            user_prompt (str): El mensaje actual del usuario.
+            initial_prompt (str, optional): Mensaje inicial, solo si el historial está vacío.
+            temperature (float, optional): La temperatura de generación para esta solicitud específica.
+            on_chunk (callable, optional): Función que recibe cada fragmento de texto (unicode).
+            turn_context (str, optional): Instrucciones solo para este turno (ver send_message).
+
+        Returns:
+            str: La respuesta completa generada por el modelo de IA,
+                 o una cadena que indica el error.
+        """
+        response = self.send_message(user_prompt, initial_prompt, temperature, turn_context)
+        if on_chunk is not None and response:
+            on_chunk(response)
+        return response
+
+    def send_message_async(self, user_prompt, initial_prompt=None, temperature=None, on_chunk=None, turn_context=None):
+        """
+        Envía un mensaje al modelo de IA sin bloquear al llamante.
+        Las peticiones de un mismo cliente se ejecutan de una en una y en el orden
+        en que se hacen, ya que comparten el historial de la conversación.
+        Si se indica 'on_chunk' la respuesta se recibe en streaming (ver send_message_stream).
+
+        Args:
+            user_prompt (str): El mensaje actual del usuario.
+            initial_prompt (str, optional): Mensaje inicial, solo si el historial está vacío.
+            temperature (float, optional): La temperatura de generación para esta solicitud específica.
+            on_chunk (callable, optional): Función que recibe cada fragmento de texto (unicode).
+            turn_context (str, optional): Instrucciones solo para este turno (ver send_message).
+
+        Returns:
+            AIRequest: Future con la respuesta. Su método get() devuelve lo mismo que
+                       send_message; cancel() descarta la petición y, si ya está en
+                       curso, cierra su conexión.
+        """
+        if on_chunk is not None:
+            function = lambda: self.send_message_stream(user_prompt, initial_prompt, temperature, on_chunk, turn_context)
+        else:
+            function = lambda: self.send_message(user_prompt, initial_prompt, temperature, turn_context)
+        request = AIRequest(self, function)
+        self.executor.execute(request)
+        return request
+
+    def abort(self, thread=None):
+        """
+        Aborta la petición en curso, cerrando su conexión con el modelo.
+        La petición abortada termina devolviendo un error y no modifica el historial.
+        Los clientes que no hacen peticiones de red pueden dejarlo sin implementar.
+
+        Args:
+            thread (java.lang.Thread, optional): El hilo que ejecuta la petición; solo
+                                                 se cierran sus conexiones. Por defecto
+                                                 se cierran todas las del cliente.
+        """
+        pass
+
+    def prewarm(self, initial_prompt):
+        """
+        Prepara de antemano lo necesario para las conversaciones que empiecen con
+        este prompt inicial (por ejemplo, la cache de contexto en el servidor), de
+        forma que la primera petición no tenga que esperar a ello.
+        Se llama desde un hilo en segundo plano al seleccionar el modelo de datos.
+        Los clientes que no tienen nada que preparar pueden dejarlo sin implementar.
+        """
+        pass
+
+def with_turn_context(turn_context, user_prompt):
+    """
+    Compone el mensaje que se envía al modelo cuando hay instrucciones solo
+    para el turno actual.
+
+    Args:
+        turn_context (str): Las instrucciones del turno, o None.
+        user_prompt (str): El mensaje del usuario.
+
+    Returns:
+        str: El mensaje a enviar.
+    """
+    if not turn_context:
+        return user_prompt
+    return u"Instrucciones para esta peticion:\n%s\n\nPeticion del usuario:\n%s" % (turn_context, user_prompt)
+
+def is_error_response(response):
+    """
+    Indica si lo que ha devuelto send_message es un mensaje de error generado por
+    el cliente ("Error: ...", "Error del API: ...") en lugar de una respuesta del
+    modelo. Una respuesta vacía también se considera un error.
+    """
+    return not response or response.startswith(u"Error")
+
 def main(**args):
   print "Ok"
    
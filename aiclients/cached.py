@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: cached
+
+Descripción:
+Cache persistente en disco de las respuestas de un cliente de IA.
+CachedAIClient envuelve cualquier AIClient y guarda cada respuesta indexada por
+el modelo, la temperatura, un hash del prompt inicial (que contiene el DDL) y la
+conversación normalizada hasta ese momento. Con temperaturas bajas las respuestas
+son prácticamente deterministas, así que repetir una pregunta sobre el mismo
+modelo de datos se resuelve en milisegundos y sin llamar al API.
+La cache sobrevive a los reinicios de gvSIG y su tamaño está limitado,
+descartando las entradas usadas hace más tiempo (LRU).
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+from addons.chatagent_prototype.aiclient import AIClient, is_error_response
+from addons.chatagent_prototype import config
+
+
+def normalize_text(text):
+    """
+    Normaliza un texto para usarlo como parte de la clave de la cache:
+    espacios en blanco colapsados. Se conservan las mayúsculas, ya que pueden
+    cambiar la respuesta (por ejemplo, valores literales en las SQL).
+    """
+    if text is None:
+        return u""
+    return u" ".join(text.split())
+
+def hash_text(text):
+    if text is None:
+        text = u""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ResponseDiskCache:
+    """
+    Almacén en disco de respuestas, un fichero JSON por entrada.
+    La fecha de modificación de cada fichero se actualiza en cada acierto y se
+    usa para descartar las entradas menos usadas recientemente cuando el tamaño
+    total supera el máximo.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.total_bytes = sum([size for path, mtime, size in self._list_entries()])
+
+    def get(self, key):
+        """
+        Devuelve el registro guardado para la clave, o None si no existe.
+        """
+        path = self._path(key)
+        self.lock.acquire()
+        try:
+            if not os.path.exists(path):
+                return None
+            try:
+                f = open(path, "rb")
+                try:
+                    record = json.loads(f.read().decode("utf-8"))
+                finally:
+                    f.close()
+            except (IOError, ValueError), e:
+                print "Advertencia: entrada de la cache de respuestas ilegible '%s'. %s" % (path, e)
+                return None
+            os.utime(path, None)
+            return record
+        finally:
+            self.lock.release()
+
+    def put(self, key, record):
+        """
+        Guarda un registro para la clave, descartando entradas antiguas si es necesario.
+        """
+        path = self._path(key)
+        data = json.dumps(record, ensure_ascii=False).encode("utf-8")
+        self.lock.acquire()
+        try:
+            if os.path.exists(path):
+                self.total_bytes -= os.path.getsize(path)
+            tmp_path = path + ".tmp"
+            f = open(tmp_path, "wb")
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+            self.total_bytes += len(data)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+        finally:
+            self.lock.release()
+
+    def count(self):
+        return len(self._list_entries())
+
+    def _evict(self):
+        entries = self._list_entries()
+        entries.sort(key=lambda entry: entry[1])
+        for path, mtime, size in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.total_bytes -= size
+            except OSError, e:
+                print "Advertencia: no se ha podido eliminar '%s' de la cache de respuestas. %s" % (path, e)
+
+    def _list_entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((path, os.path.getmtime(path), os.path.getsize(path)))
+            except OSError:
+                pass
+        return entries
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_response_store(directory, max_bytes):
+    """
+    Devuelve el almacén de respuestas de la carpeta indicada, compartido por
+    todos los clientes que la usan, de forma que su lock y su tamaño total
+    sean únicos. El tamaño máximo es el de la primera llamada para esa carpeta.
+    """
+    path = os.path.abspath(directory)
+    store = _stores.get(path)
+    if store is None:
+        _stores_lock.acquire()
+        try:
+            store = _stores.get(path)
+            if store is None:
+                store = ResponseDiskCache(path, max_bytes)
+                _stores[path] = store
+        finally:
+            _stores_lock.release()
+    return store
+
+
+class CachedAIClient(AIClient):
+    """
+    Cliente de IA que envuelve a otro y cachea sus respuestas en disco.
+    En caso de acierto la respuesta se añade al historial del cliente envuelto
+    con add_exchange, de forma que los siguientes mensajes mantienen el contexto.
+    """
+
+    def __init__(self, delegate, directory=None, max_bytes=None):
+        """
+        Args:
+            delegate (aiclient.AIClient): El cliente de IA al que se delegan los fallos de cache.
+            directory (str, optional): Carpeta de la cache. Por defecto config.RESPONSE_CACHE_DIR.
+            max_bytes (int, optional): Tamaño máximo de la cache. Por defecto config.RESPONSE_CACHE_MAX_BYTES.
+        """
+        self.delegate = delegate
+        AIClient.__init__(self, delegate.executor)
+        if directory is None:
+            directory = config.RESPONSE_CACHE_DIR
+        if max_bytes is None:
+            max_bytes = config.RESPONSE_CACHE_MAX_BYTES
+        self.store = get_response_store(directory, max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.prefix_hash = None
+        self.conversation = []  # Pares (mensaje, respuesta) normalizados de la conversación actual
+
+    def __getattr__(self, name):
+        # El resto de atributos (model_name, métricas del historial...) son los del cliente envuelto
+        if name == "delegate":
+            raise AttributeError(name)
+        return getattr(self.delegate, name)
+
+    def set_response_schema(self, schema):
+        AIClient.set_response_schema(self, schema)
+        self.delegate.set_response_schema(schema)
+
+    def abort(self, thread=None):
+        self.delegate.abort(thread)
+
+    def prewarm(self, initial_prompt):
+        self.delegate.prewarm(initial_prompt)
+
+    def resetHistory(self):
+        self.delegate.resetHistory()
+        self.prefix_hash = None
+        self.conversation = []
+
+    def add_exchange(self, user_prompt, response, initial_prompt=None):
+        self._start_conversation(initial_prompt)
+        self.delegate.add_exchange(user_prompt, response, initial_prompt)
+        self.conversation.append((normalize_text(user_prompt), hash_text(response)))
+
+    def send_message(self, user_prompt, initial_prompt=None, temperature=None, turn_context=None):
+        return self._send(user_prompt, initial_prompt, temperature, None, turn_context)
+
+    def send_message_stream(self, user_prompt, initial_prompt=None, temperature=None, on_chunk=None, turn_context=None):
+        if on_chunk is None:
+            on_chunk = lambda text: None
+        return self._send(user_prompt, initial_prompt, temperature, on_chunk, turn_context)
+
+    def get_stats(self):
+        """
+        Devuelve los contadores de la cache.
+
+        Returns:
+            dict: Con las claves hits, misses, entries y bytes.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": self.store.count(),
+            "bytes": self.store.total_bytes
+        }
+
+    def _send(self, user_prompt, initial_prompt, temperature, on_chunk, turn_context=None):
+        self._start_conversation(initial_prompt)
+        key = self._key(user_prompt, temperature, turn_context)
+        record = self.store.get(key)
+        if record is not None:
+            self.hits += 1
+            response = record["response"]
+            print u"Cache de respuestas: acierto (%d aciertos, %d fallos)" % (self.hits, self.misses)
+            self.delegate.add_exchange(user_prompt, response, initial_prompt)
+            if on_chunk is not None:
+                on_chunk(response)
+        else:
+            self.misses += 1
+            print u"Cache de respuestas: fallo (%d aciertos, %d fallos)" % (self.hits, self.misses)
+            if on_chunk is not None:
+                response = self.delegate.send_message_stream(user_prompt, initial_prompt, temperature, on_chunk, turn_context)
+            else:
+                response = self.delegate.send_message(user_prompt, initial_prompt, temperature, turn_context)
+            if is_error_response(response):
+                # Los errores no se cachean ni forman parte de la conversación
+                return response
+            try:
+                self.store.put(key, {"user_prompt": user_prompt, "response": response})
+            except Exception, e:
+                print u"Advertencia: no se ha podido guardar la respuesta en la cache. %s" % e
+        self.conversation.append((normalize_text(user_prompt), hash_text(response)))
+        return response
+
+    def _start_conversation(self, initial_prompt):
+        if self.prefix_hash is None:
+            self.prefix_hash = hash_text(initial_prompt)
+
+    def _key(self, user_prompt, temperature, turn_context=None):
+        if temperature is None:
+            temperature = getattr(self.delegate, "temperature", None)
+        key_data = json.dumps([
+            getattr(self.delegate, "model_name", None),
+            temperature,
+            self.prefix_hash,
+            self.response_schema,
+            self.conversation,
+            hash_text(turn_context) if turn_context else None,
+            normalize_text(user_prompt)
+        ], sort_keys=True)
+        return hashlib.sha256(key_data).hexdigest()
+
+
+def main(**args):
+  print "Ok"
@@ -5,13 +5,17 @@ Módulo: gemini_api
 Descripción:
 Este módulo proporciona una clase GeminiAPI para interactuar con la API de Gemini.
 Gestiona el historial de la conversación y realiza solicitudes HTTP POST
-utilizando las clases estándar de Java (java.net) y procesa JSON con javax.json.
+a través de la capa de transporte compartida (aiclients.transport, basada en
+java.net) y procesa JSON con javax.json.
 Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
 """
 
-# Importa las clases necesarias de Java para la conexión de red y E/S
-from java.net import URL, HttpURLConnection
-from java.io import BufferedReader, InputStreamReader, OutputStreamWriter, StringReader
+# Importa las clases necesarias de Java para E/S
+from java.io import BufferedReader, InputStreamReader, StringReader
+from java.lang import String, StringBuilder
+from java.net import InetSocketAddress
+from java.util.zip import GZIPInputStream
+from com.sun.net.httpserver import HttpHandler, HttpServer
 
 # Importa las clases necesarias de javax.json para la manipulación de JSON
 from javax.json import Json
@@ -19,10 +23,16 @@ from javax.json import JsonObject
 from javax.json import JsonArray
 from javax.json import JsonReader
 
+import json
 import sys
+import time
 
-from addons.chatagent_prototype.aiclient import AIClient
+from addons.chatagent_prototype.aiclient import AIClient, with_turn_context, is_error_response
+from addons.chatagent_prototype.aiclients.history import ConversationHistory
+from addons.chatagent_prototype.aiclients.transport import HttpTransport, HttpError, iter_sse_events, read_fully
+from addons.chatagent_prototype.aiclients.gemini_cache import GeminiContextCache, is_context_cache_error
 from addons.chatagent_prototype import config
+from addons.chatagent_prototype import tracing
 
 
 class GeminiClient(AIClient):
@@ -30,7 +40,7 @@ class GeminiClient(AIClient):
     Clase para interactuar con la API de Gemini, gestionando el historial de mensajes.
     """
 
-    def __init__(self, temperature=0.1): # 0.3 o incluso menor parece lo razonable para programar (jython o SQL)
+    def __init__(self, temperature=0.1, model_name=None): # 0.3 o incluso menor parece lo razonable para programar (jython o SQL)
         """
         Inicializa una nueva instancia de GeminiAPI.
         El historial de mensajes se inicializa vacío.
@@ -41,73 +51,154 @@ class GeminiClient(AIClient):
                                            Un valor entre 0.0 y 1.0 (inclusive).
                                            Valores más bajos hacen las respuestas más deterministas,
                                            valores más altos las hacen más creativas. Por defecto es 0.3.
+            model_name (str, optional): El modelo de Gemini a utilizar. Por defecto config.GEMINI_MODEL.
         """
         AIClient.__init__(self)
-        self.history = []  # Almacena el historial de mensajes en el formato esperado por la API de Gemini.
-                           # Ejemplo: [{"role": "user", "parts": [{"text": "Hola"}]}, ...]
-        self.model_name = config.GEMINI_MODEL
+        if model_name is None:
+            model_name = config.GEMINI_MODEL
+        self.model_name = model_name
+        # Almacena el historial de mensajes en el formato esperado por la API de Gemini,
+        # junto con su JSON ya serializado, y lo compacta para no superar el presupuesto
+        # de tokens del modelo.
+        # Ejemplo: [{"role": "user", "parts": [{"text": "Hola"}]}, ...]
+        self.history = ConversationHistory(
+            token_budget=config.HISTORY_TOKEN_BUDGETS.get(self.model_name, config.HISTORY_DEFAULT_TOKEN_BUDGET),
+            keep_full_replies=config.HISTORY_KEEP_FULL_REPLIES
+        )
         self.api_key = config.API_KEY
-        self.api_url_base = "https://generativelanguage.googleapis.com/v1beta/models/%s:generateContent?key=%s"
+        self.api_url_base = config.GEMINI_API_BASE_URL + "/models/%s:generateContent?key=%s"
+        self.api_stream_url_base = config.GEMINI_API_BASE_URL + "/models/%s:streamGenerateContent?alt=sse&key=%s"
         self.temperature = temperature # Atributo para la temperatura de generación
+        self.transport = HttpTransport() # Conexiones reutilizables (keep-alive) y comprimidas
+        self.response_schema_json = None # Esquema de la respuesta (salida estructurada) ya convertido a JSON
+        self.initial_prompt = None # Prompt inicial de la conversación (primer mensaje del historial)
+        self.context_cache = None # Cache de contexto en el servidor para el prompt inicial
+        if config.GEMINI_CONTEXT_CACHE:
+            self.context_cache = GeminiContextCache(
+                self.transport,
+                config.GEMINI_API_BASE_URL,
+                self.api_key,
+                ttl=config.GEMINI_CONTEXT_CACHE_TTL,
+                retry_after=config.GEMINI_CONTEXT_CACHE_RETRY
+            )
 
     def resetHistory(self):
         """
         Reinicia el historial de mensajes de la conversación.
         Esto elimina todas las interacciones previas almacenadas.
         """
-        self.history = []
+        self.history.clear()
+        self.initial_prompt = None
         print("Historial de mensajes reiniciado.")
 
-    def _build_payload(self, current_temperature=None):
+    def abort(self, thread=None):
         """
-        Construye el objeto JSON que se enviará como payload a la API de Gemini.
+        Aborta la petición en curso cerrando su conexión (ver AIClient.abort).
+        """
+        self.transport.abort(thread)
+
+    def prewarm(self, initial_prompt):
+        if self.context_cache is not None and initial_prompt:
+            self.context_cache.get(self.model_name, initial_prompt)
+
+    def add_exchange(self, user_prompt, response, initial_prompt=None):
+        """
+        Añade al historial un intercambio obtenido sin llamar a Gemini
+        (por ejemplo, desde la cache de respuestas).
+        """
+        if not self.history and initial_prompt is not None:
+            self.history.append({"role": "user", "parts": [{"text": initial_prompt}]}, pinned=True)
+            self.initial_prompt = initial_prompt
+        self.history.append({"role": "user", "parts": [{"text": user_prompt}]})
+        self.history.append({"role": "model", "parts": [{"text": response}]})
+
+    def set_response_schema(self, schema):
+        """
+        Establece el esquema de la respuesta. Si no es None, las peticiones se
+        hacen con responseMimeType "application/json" y responseSchema, de forma
+        que Gemini responde directamente con un objeto JSON que cumple el esquema.
+        """
+        AIClient.set_response_schema(self, schema)
+        self.response_schema_json = None
+        if schema is not None:
+            json_reader = Json.createReader(StringReader(json.dumps(to_gemini_schema(schema))))
+            self.response_schema_json = json_reader.readObject()
+            json_reader.close()
+
+    def get_history_metrics(self):
+        """
+        Devuelve las métricas de compactación del historial, una por turno de la
+        conversación actual (como mucho las de los history.MAX_METRICS últimos),
+        con el tamaño del historial antes y después de compactarlo.
+
+        Returns:
+            list: Lista de diccionarios con las claves turn, chars_before, chars_after,
+                  tokens_before, tokens_after, dropped_messages y stripped_replies.
+        """
+        return list(self.history.metrics)
+
+    def _build_payload(self, current_temperature=None, cached_content=None):
+        """
+        Construye el JSON que se enviará como payload a la API de Gemini.
         El payload se construye a partir del historial de mensajes actual e incluye
         la configuración de generación con la temperatura.
 
+        Los mensajes del historial ya están serializados (ver ConversationHistory),
+        por lo que aquí solo se concatenan sus fragmentos; el coste de construir el
+        payload no depende de volver a serializar el prompt inicial en cada turno.
+
         Args:
             current_temperature (float, optional): La temperatura específica para esta solicitud.
                                                    Si se proporciona, sobrescribe la temperatura
                                                    predeterminada de la instancia.
+            cached_content (str, optional): Nombre de la cache de contexto del prompt inicial
+                                            (ver _get_cached_content). Si se indica, el prompt
+                                            inicial se referencia por ella en lugar de enviarlo
+                                            en 'contents'.
 
         Returns:
-            javax.json.JsonObject: El objeto JSON que representa el payload de la solicitud.
+            unicode: La cadena JSON que representa el payload de la solicitud.
         """
-        payload_builder = Json.createObjectBuilder()
-
-        # Construye el array 'contents' que contiene toda la conversación
-        contents_array_builder = Json.createArrayBuilder()
-        for message in self.history:
-            message_builder = Json.createObjectBuilder()
-            message_builder.add("role", message["role"])
-            
-            parts_array_builder = Json.createArrayBuilder()
-            # Itera sobre las partes de cada mensaje (asumiendo que cada parte tiene una clave 'text')
-            for part in message["parts"]:
-                parts_array_builder.add(Json.createObjectBuilder().add("text", part["text"]))
-            
-            message_builder.add("parts", parts_array_builder)
-            contents_array_builder.add(message_builder)
-
-        payload_builder.add("contents", contents_array_builder)
-
         # Añadir la configuración de generación (generationConfig) con la temperatura
         # Usa la temperatura proporcionada en el método o la temperatura de la instancia
         temp_to_use = current_temperature if current_temperature is not None else self.temperature
         
         generation_config_builder = Json.createObjectBuilder()
         generation_config_builder.add("temperature", float(temp_to_use)) # Asegura que sea un float
+        if self.response_schema_json is not None:
+            # Salida estructurada: la respuesta es directamente un JSON que cumple el esquema
+            generation_config_builder.add("responseMimeType", "application/json")
+            generation_config_builder.add("responseSchema", self.response_schema_json)
+
+        if cached_content is not None:
+            # El prompt inicial (primer mensaje del historial) ya esta en el servidor
+            return u'{"cachedContent":"%s","contents":%s,"generationConfig":%s}' % (
+                cached_content,
+                self.history.to_json_array(1),
+                generation_config_builder.build().toString()
+            )
+        return u'{"contents":%s,"generationConfig":%s}' % (
+            self.history.to_json_array(),
+            generation_config_builder.build().toString()
+        )
+
+    def _get_cached_content(self):
+        """
+        Devuelve el nombre de la cache de contexto del prompt inicial de la
+        conversación, o None si la cache de contexto no está activa o no
+        hay prompt inicial.
+        """
+        if self.context_cache is None or not self.initial_prompt:
+            return None
+        return self.context_cache.get(self.model_name, self.initial_prompt)
 
-        payload_builder.add("generationConfig", generation_config_builder)
-
-        return payload_builder.build()
-
-    def _send_request(self, payload_json_object):
+    def _send_request(self, payload):
         """
         Envía una solicitud HTTP POST a la API de Gemini con el payload JSON especificado.
         Maneja la conexión, el envío de datos y la lectura de la respuesta.
 
         Args:
-            payload_json_object (javax.json.JsonObject): El objeto JSON a enviar en el cuerpo de la solicitud.
+            payload (unicode): El JSON a enviar en el cuerpo de la solicitud.
 
         Returns:
             str: La respuesta completa de la API como una cadena JSON.
@@ -118,54 +209,91 @@ class GeminiClient(AIClient):
         try:
             # Construye la URL completa con el nombre del modelo y la clave API
             url_string = self.api_url_base % (self.model_name, self.api_key)
-            url = URL(url_string)
-            
-            # Abre la conexión HTTP
-            conn = url.openConnection()
-            conn.setRequestMethod("POST")
-            conn.setRequestProperty("Content-Type", "application/json")
-            conn.setDoOutput(True)  # Habilita la escritura en el cuerpo de la solicitud
-
-            # Escribe el payload JSON en el flujo de salida de la conexión
-            output_stream = conn.getOutputStream()
-            writer = OutputStreamWriter(output_stream, "UTF-8")
-            writer.write(payload_json_object.toString())  # Convierte el JsonObject a su representación de cadena JSON
-            writer.flush()
-            writer.close()
-            output_stream.close()
-
-            # Obtiene el código de respuesta HTTP
-            response_code = conn.getResponseCode()
-
-            # Lee la respuesta (o el flujo de error si el código no es 200 OK)
-            if response_code == HttpURLConnection.HTTP_OK:
-                reader = BufferedReader(InputStreamReader(conn.getInputStream(), "UTF-8"))
-            else:
-                reader = BufferedReader(InputStreamReader(conn.getErrorStream(), "UTF-8"))
-                error_response_content = ""
-                line = reader.readLine()
-                while line is not None:
-                    error_response_content += line
-                    line = reader.readLine()
-                reader.close()
-                conn.disconnect()
-                raise Exception("Error de la API (Código: %d): %s" % (response_code, error_response_content))
-
-            # Lee el contenido completo de la respuesta
-            response_content = ""
-            line = reader.readLine()
-            while line is not None:
-                response_content += line
-                line = reader.readLine()
-            reader.close()
-            conn.disconnect()
-            return response_content
+            return self.transport.post_json(url_string, payload)
         except Exception, e:
             # Captura y re-lanza cualquier excepción de red o I/O para un manejo superior
             print("Error al enviar la solicitud HTTP: %s" % e)
             raise
 
-    def send_message(self, user_prompt, initial_prompt=None, temperature=None):
+    def _send_stream_request(self, payload, on_chunk, span=None):
+        """
+        Envía una solicitud al endpoint streamGenerateContent de Gemini y consume
+        la respuesta en formato SSE (Server-Sent Events) fragmento a fragmento.
+        Cada fragmento de texto recibido se notifica a 'on_chunk' en cuanto llega.
+
+        Args:
+            payload (unicode): El JSON a enviar en el cuerpo de la solicitud.
+            on_chunk (callable): Función que recibe cada fragmento de texto (unicode) según llega.
+            span (tracing.Span, optional): Span de red donde anotar el consumo de tokens
+                                           y el tiempo hasta el primer fragmento.
+
+        Returns:
+            str: El texto completo generado por el modelo (la concatenación de todos los fragmentos).
+
+        Raises:
+            Exception: Si ocurre un error durante la conexión HTTP, la respuesta de la API no es exitosa
+                       o el propio stream notifica un error.
+        """
+        try:
+            url_string = self.api_stream_url_base % (self.model_name, self.api_key)
+            reader = self.transport.open_stream(url_string, payload)
+            generated_text = StringBuilder()
+            try:
+                for event_data in iter_sse_events(reader):
+                    self._process_stream_event(event_data, generated_text, on_chunk, span)
+            finally:
+                self.transport.close_stream(reader)
+            return generated_text.toString()
+        except Exception, e:
+            print("Error al recibir la respuesta en streaming: %s" % e)
+            raise
+
+    def _process_stream_event(self, event_data, generated_text, on_chunk, span=None):
+        """
+        Procesa un evento SSE de la respuesta en streaming, acumulando el texto
+        recibido y notificándolo a 'on_chunk'.
+        """
+        json_reader = Json.createReader(StringReader(event_data))
+        chunk_json = json_reader.readObject()
+        json_reader.close()
+        if chunk_json.containsKey("error"):
+            error_obj = chunk_json.getJsonObject("error")
+            raise Exception(u"Error del API: %s" % error_obj.getString("message", "Error desconocido del API."))
+        if span is not None and chunk_json.containsKey("usageMetadata"):
+            # Cada fragmento trae el consumo acumulado; el último es el total
+            span.set(**usage_metadata(chunk_json.getJsonObject("usageMetadata")))
+        text = self._extract_chunk_text(chunk_json)
+        if text:
+            if span is not None and generated_text.length() == 0:
+                span.set(first_chunk_ms=span.elapsed_ms())
+            generated_text.append(text)
+            if on_chunk is not None:
+                on_chunk(text)
+
+    def _extract_chunk_text(self, chunk_json):
+        """
+        Extrae el texto de un fragmento de la respuesta en streaming.
+        A diferencia de una respuesta completa, es normal que un fragmento
+        no tenga texto (por ejemplo, el último, que solo trae metadatos).
+        """
+        text = u""
+        candidates = chunk_json.getJsonArray("candidates") if chunk_json.containsKey("candidates") else None
+        if candidates is None or candidates.isEmpty():
+            return text
+        candidate = candidates.getJsonObject(0)
+        if not candidate.containsKey("content"):
+            return text
+        content = candidate.getJsonObject("content")
+        if not content.containsKey("parts"):
+            return text
+        parts = content.getJsonArray("parts")
+        for i in range(parts.size()):
+            part = parts.getJsonObject(i)
+            if part.containsKey("text"):
+                text += part.getString("text")
+        return text
+
+    def send_message(self, user_prompt, initial_prompt=None, temperature=None, turn_context=None):
         """
         Envía un mensaje al modelo de Gemini, gestionando el historial de la conversación.
 
@@ -186,70 +314,81 @@ class GeminiClient(AIClient):
                  Si ocurre un error durante la solicitud o el procesamiento de la respuesta,
                  devuelve una cadena que indica el error.
         """
+        return self._send(user_prompt, initial_prompt, temperature, None, turn_context)
+
+    def send_message_stream(self, user_prompt, initial_prompt=None, temperature=None, on_chunk=None, turn_context=None):
+        """
+        Igual que send_message, pero consume el endpoint streamGenerateContent
+        y notifica a 'on_chunk' cada fragmento de texto según llega.
+
+        Args:
+            user_prompt (str): El mensaje actual del usuario.
+            initial_prompt (str, optional): Mensaje inicial, solo si el historial está vacío.
+            temperature (float, optional): La temperatura de generación para esta solicitud específica.
+            on_chunk (callable, optional): Función que recibe cada fragmento de texto (unicode).
+
+        Returns:
+            str: La respuesta completa generada por el modelo de Gemini,
+                 o una cadena que indica el error.
+        """
+        if on_chunk is None:
+            on_chunk = lambda text: None
+        return self._send(user_prompt, initial_prompt, temperature, on_chunk, turn_context)
+
+    def _send(self, user_prompt, initial_prompt, temperature, on_chunk, turn_context=None):
+        """
+        Implementación común de send_message y send_message_stream.
+        Si 'on_chunk' es None la respuesta se obtiene de una sola vez,
+        en otro caso se recibe en streaming.
+        """
         try:
             # 1. Gestionar el 'initial_prompt': se añade solo si el historial está vacío
             if not self.history and initial_prompt is not None:
-                self.history.append({"role": "user", "parts": [{"text": initial_prompt}]})
+                self.history.append({"role": "user", "parts": [{"text": initial_prompt}]}, pinned=True)
+                self.initial_prompt = initial_prompt
                 #print u"DEBUG: Initial prompt añadido al historial:\n'%s'" % initial_prompt # Para depuración
 
             # 2. Añadir el 'user_prompt' actual al historial.
-            # Este es el mensaje que el usuario acaba de enviar.
-            self.history.append({"role": "user", "parts": [{"text": user_prompt}]})
+            # Este es el mensaje que el usuario acaba de enviar, con las instrucciones del turno si las hay.
+            self.history.append({"role": "user", "parts": [{"text": with_turn_context(turn_context, user_prompt)}]})
             #print u"DEBUG: User prompt añadido al historial: '%s'" % user_prompt # Para depuración
 
-            # 3. Construir el payload JSON utilizando el historial completo y la temperatura
-            payload_json_object = self._build_payload(current_temperature=temperature)
-            
-            # 4. Enviar la solicitud HTTP a la API de Gemini
-            json_response_string = self._send_request(payload_json_object)
-
-            # 5. Parsear la respuesta JSON recibida
-            json_reader = Json.createReader(StringReader(json_response_string))
-            response_json = json_reader.readObject()
-            json_reader.close()
+            # Compactar el historial si excede el presupuesto de tokens del modelo
+            metrics = self.history.compact()
+            print u"Historial: turno %d, %d -> %d caracteres (~%d -> ~%d tokens), %d mensajes descartados" % (
+                metrics["turn"], metrics["chars_before"], metrics["chars_after"],
+                metrics["tokens_before"], metrics["tokens_after"], metrics["dropped_messages"]
+            )
 
-            #print u"DEBUG: recibida respuesta:\n%s" % response_json.toString()
-            
-            generated_text = ""
-            # Extraer el texto generado por el modelo de la respuesta JSON
-            if response_json.containsKey("candidates"):
-                candidates = response_json.getJsonArray("candidates")
-                if not candidates.isEmpty():
-                    first_candidate = candidates.getJsonObject(0)
-                    if first_candidate.containsKey("content"):
-                        content = first_candidate.getJsonObject("content")
-                        if content.containsKey("parts"):
-                            parts = content.getJsonArray("parts")
-                            if not parts.isEmpty():
-                                first_part = parts.getJsonObject(0)
-                                if first_part.containsKey("text"):
-                                    generated_text = first_part.getString("text")
-                                else:
-                                    print u"Advertencia: La parte del contenido no tiene el campo 'text'."
-                            else:
-                                print u"Advertencia: El array 'parts' del contenido está vacío."
-                        else:
-                            print u"Advertencia: El candidato no tiene el campo 'content'."
-                    else:
-                        print u"Advertencia: El candidato no tiene el campo 'content'."
-                else:
-                    print u"Advertencia: El array 'candidates' está vacío en la respuesta de la API."
-            else:
-                print u"Advertencia: La respuesta de la API no contiene el campo 'candidates'."
-                # Si la respuesta contiene un objeto 'error', lo procesamos
-                if response_json.containsKey("error"):
-                    error_obj = response_json.getJsonObject("error")
-                    error_message = error_obj.getString("message", "Error desconocido del API.")
-                    generated_text = u"Error del API: %s" % error_message
-                    print u"Error detallado del API: %s" % error_message
-                else:
-                    generated_text = "Error: Estructura de respuesta inesperada del API."
+            # 3. Construir el payload JSON utilizando el historial completo y la temperatura
+            cached_content = self._get_cached_content()
+            payload = self._build_payload(current_temperature=temperature, cached_content=cached_content)
+
+            # 4 y 5. Enviar la solicitud a la API de Gemini y extraer el texto de la respuesta
+            try:
+                generated_text = self._request_text(payload, on_chunk)
+            except HttpError, e:
+                if cached_content is None or not is_context_cache_error(e):
+                    raise
+                # La cache de contexto ha caducado o se ha borrado en el servidor;
+                # se olvida y se reintenta enviando el prompt inicial completo.
+                print u"Advertencia: fallo usando la cache de contexto, se reenvia el prompt inicial. %s" % e
+                self.context_cache.invalidate(self.model_name, self.initial_prompt, cached_content)
+                payload = self._build_payload(current_temperature=temperature)
+                generated_text = self._request_text(payload, on_chunk)
 
             #print u"DEBUG: extraida respuesta:\n%s" % generated_text
  
             # 6. Añadir la respuesta del modelo al historial
-            # Solo se añade si la respuesta no es un mensaje de error generado internamente.
-            if not generated_text.startswith("Error:"):
+            # Solo se añade si la respuesta no es un mensaje de error generado internamente;
+            # en ese caso se quita también el mensaje del usuario, como cuando la llamada falla.
+            if is_error_response(generated_text):
+                self.history.pop()
+            else:
+                if turn_context:
+                    # Las instrucciones del turno no se conservan en el historial
+                    self.history.pop()
+                    self.history.append({"role": "user", "parts": [{"text": user_prompt}]})
                 self.history.append({"role": "model", "parts": [{"text": generated_text}]})
             
             return generated_text
@@ -263,6 +402,232 @@ class GeminiClient(AIClient):
                 self.history.pop() # Elimina el último mensaje del usuario si la respuesta no se pudo obtener
             return u"Error: No se pudo procesar la solicitud o la respuesta del API. Detalles: %s" % e
 
+    def _request_text(self, payload, on_chunk):
+        """
+        Envía el payload a la API de Gemini y devuelve el texto generado.
+        Si 'on_chunk' no es None la respuesta se recibe en streaming.
+        """
+        with tracing.span("network", model=self.model_name, streaming=on_chunk is not None,
+                          payload_chars=len(payload)) as span:
+            if on_chunk is not None:
+                # Enviar la solicitud y recibir la respuesta fragmento a fragmento
+                generated_text = self._send_stream_request(payload, on_chunk, span)
+                if not generated_text:
+                    generated_text = "Error: La respuesta en streaming del API no contenia texto."
+                span.set(response_chars=len(generated_text))
+                return generated_text
+
+            # Enviar la solicitud HTTP a la API de Gemini
+            json_response_string = self._send_request(payload)
+            span.set(response_chars=len(json_response_string))
+
+            # Parsear la respuesta JSON recibida
+            json_reader = Json.createReader(StringReader(json_response_string))
+            response_json = json_reader.readObject()
+            json_reader.close()
+
+            #print u"DEBUG: recibida respuesta:\n%s" % response_json.toString()
+
+            if response_json.containsKey("usageMetadata"):
+                span.set(**usage_metadata(response_json.getJsonObject("usageMetadata")))
+            return self._extract_generated_text(response_json)
+
+    def count_tokens(self, text):
+        """
+        Cuenta los tokens de un texto con el endpoint countTokens del modelo.
+
+        Args:
+            text (unicode): El texto a medir.
+
+        Returns:
+            int: El número de tokens.
+        """
+        content_builder = Json.createObjectBuilder()
+        content_builder.add("role", "user")
+        content_builder.add("parts", Json.createArrayBuilder().add(Json.createObjectBuilder().add("text", text)))
+        payload = Json.createObjectBuilder().add("contents", Json.createArrayBuilder().add(content_builder)).build().toString()
+        url_string = config.GEMINI_API_BASE_URL + "/models/%s:countTokens?key=%s" % (self.model_name, self.api_key)
+        response = self.transport.post_json(url_string, payload)
+        json_reader = Json.createReader(StringReader(response))
+        response_json = json_reader.readObject()
+        json_reader.close()
+        return response_json.getInt("totalTokens")
+
+    def _extract_generated_text(self, response_json):
+        """
+        Extrae el texto generado por el modelo de una respuesta completa de generateContent.
+
+        Args:
+            response_json (javax.json.JsonObject): La respuesta de la API.
+
+        Returns:
+            str: El texto generado, o un mensaje de error si la respuesta no tiene la estructura esperada.
+        """
+        generated_text = ""
+        # Extraer el texto generado por el modelo de la respuesta JSON
+        if response_json.containsKey("candidates"):
+            candidates = response_json.getJsonArray("candidates")
+            if not candidates.isEmpty():
+                first_candidate = candidates.getJsonObject(0)
+                if first_candidate.containsKey("content"):
+                    content = first_candidate.getJsonObject("content")
+                    if content.containsKey("parts"):
+                        parts = content.getJsonArray("parts")
+                        if not parts.isEmpty():
+                            first_part = parts.getJsonObject(0)
+                            if first_part.containsKey("text"):
+                                generated_text = first_part.getString("text")
+                            else:
+                                print u"Advertencia: La parte del contenido no tiene el campo 'text'."
+                        else:
+                            print u"Advertencia: El array 'parts' del contenido está vacío."
+                    else:
+                        print u"Advertencia: El candidato no tiene el campo 'content'."
+                else:
+                    print u"Advertencia: El candidato no tiene el campo 'content'."
+            else:
+                print u"Advertencia: El array 'candidates' está vacío en la respuesta de la API."
+        else:
+            print u"Advertencia: La respuesta de la API no contiene el campo 'candidates'."
+            # Si la respuesta contiene un objeto 'error', lo procesamos
+            if response_json.containsKey("error"):
+                error_obj = response_json.getJsonObject("error")
+                error_message = error_obj.getString("message", "Error desconocido del API.")
+                generated_text = u"Error del API: %s" % error_message
+                print u"Error detallado del API: %s" % error_message
+            else:
+                generated_text = "Error: Estructura de respuesta inesperada del API."
+        return generated_text
+
+def usage_metadata(usage_json):
+    """
+    Convierte el objeto usageMetadata de una respuesta de Gemini en los
+    atributos de consumo de tokens de una traza.
+
+    Args:
+        usage_json (javax.json.JsonObject): El objeto usageMetadata.
+
+    Returns:
+        dict: Con las claves prompt_tokens, output_tokens, cached_tokens y total_tokens.
+    """
+    return {
+        "prompt_tokens": usage_json.getInt("promptTokenCount", 0),
+        "output_tokens": usage_json.getInt("candidatesTokenCount", 0),
+        "cached_tokens": usage_json.getInt("cachedContentTokenCount", 0),
+        "total_tokens": usage_json.getInt("totalTokenCount", 0)
+    }
+
+def to_gemini_schema(schema):
+  """
+  Convierte un esquema con la sintaxis de JSON Schema al subconjunto OpenAPI
+  que espera el campo responseSchema de Gemini: los tipos van en mayúsculas y
+  se indica el orden de las propiedades, con 'type' en primer lugar.
+  """
+  if isinstance(schema, dict):
+    converted = {}
+    for key, value in schema.items():
+      if key == "type" and isinstance(value, basestring):
+        converted[key] = value.upper()
+      elif key == "properties":
+        converted[key] = dict([(name, to_gemini_schema(prop)) for name, prop in value.items()])
+        ordering = sorted(value.keys())
+        if "type" in ordering:
+          ordering.remove("type")
+          ordering.insert(0, "type")
+        converted["propertyOrdering"] = ordering
+      else:
+        converted[key] = to_gemini_schema(value)
+    return converted
+  if isinstance(schema, list):
+    return [to_gemini_schema(item) for item in schema]
+  return schema
+
+def benchmark_build_payload(turns=100, initial_prompt_size=150000, reply_size=2000):
+  """
+  Micro-benchmark de GeminiClient._build_payload.
+  Simula una conversación con un prompt inicial grande (como el que contiene el DDL)
+  y mide cuánto tarda en construirse el payload en cada turno. Con el historial
+  pre-serializado el tiempo debe mantenerse plano del turno 1 al último.
+
+  Returns:
+      list: Pares (turno, milisegundos).
+  """
+  client = GeminiClient()
+  client.history.append({"role": "user", "parts": [{"text": u"x" * initial_prompt_size}]})
+  timings = []
+  for turn in range(1, turns + 1):
+    client.history.append({"role": "user", "parts": [{"text": u"Pregunta numero %d" % turn}]})
+    start = time.time()
+    client._build_payload()
+    timings.append((turn, (time.time() - start) * 1000.0))
+    client.history.append({"role": "model", "parts": [{"text": u"y" * reply_size}]})
+  for turn, ms in timings:
+    if turn in (1, 2, 10, 25, 50, 75, 100) or turn == turns:
+      print "Turno %3d: %8.3f ms" % (turn, ms)
+  return timings
+
+class _StreamStandInHandler(HttpHandler):
+  # Simula el endpoint streamGenerateContent del API de Gemini: cada fragmento
+  # de la respuesta se envía como un evento SSE por separado
+  def __init__(self):
+    self.calls = []
+
+  def handle(self, exchange):
+    input_stream = exchange.getRequestBody()
+    if "gzip" == exchange.getRequestHeaders().getFirst("Content-Encoding"):
+      input_stream = GZIPInputStream(input_stream)
+    request = json.loads(read_fully(InputStreamReader(input_stream, "UTF-8")))
+    self.calls.append(exchange.getRequestURI().toString())
+    if request["contents"][-1]["parts"][0]["text"] == u"fallo":
+      events = [u'{"candidates":[{"content":{"parts":[{"text":"a medias"}]}}]}',
+                u'{"error":{"message":"Internal error"}}']
+    else:
+      events = [u'{"candidates":[{"content":{"parts":[{"text":"%s"}]}}]}' % text for text in (u"Hola", u", ", u"mundo")]
+      events.append(u'{"usageMetadata":{"promptTokenCount":12,"candidatesTokenCount":3,"totalTokenCount":15}}')
+    exchange.getResponseHeaders().set("Content-Type", "text/event-stream")
+    exchange.sendResponseHeaders(200, 0)
+    output = exchange.getResponseBody()
+    for event in events:
+      output.write(String(u"data: %s\r\n\r\n" % event).getBytes("UTF-8"))
+      output.flush()
+    exchange.close()
+
+def test_streaming_with_local_server():
+  """
+  Prueba la lectura de eventos SSE y send_message_stream contra un servidor HTTP
+  local que simula el endpoint streamGenerateContent: los fragmentos llegan a
+  on_chunk en orden, la respuesta es su concatenación, y un error a mitad del
+  stream se devuelve como error sin dejar el mensaje en el historial.
+  """
+  # Eventos de varias lineas, comentarios, lineas en blanco seguidas y un ultimo
+  # evento sin linea en blanco final
+  reader = BufferedReader(StringReader(u": comentario\ndata: uno\n\ndata: {\"a\":\ndata: 1}\n\n\ndata: fin"))
+  assert list(iter_sse_events(reader)) == [u"uno", u'{"a":1}', u"fin"]
+
+  handler = _StreamStandInHandler()
+  server = HttpServer.create(InetSocketAddress("127.0.0.1", 0), 0)
+  server.createContext("/", handler)
+  server.start()
+  try:
+    base_url = "http://127.0.0.1:%d/v1beta" % server.getAddress().getPort()
+    client = GeminiClient(model_name="gemini-test")
+    client.api_stream_url_base = base_url + "/models/%s:streamGenerateContent?alt=sse&key=%s"
+    client.context_cache = None
+    chunks = []
+    assert client.send_message_stream(u"saludo", u"Prompt inicial", on_chunk=chunks.append) == u"Hola, mundo"
+    assert chunks == [u"Hola", u", ", u"mundo"]
+    assert len(client.history) == 3
+    assert "alt=sse" in handler.calls[0]
+
+    # Un error notificado en el propio stream: el texto recibido no cuenta como respuesta
+    assert is_error_response(client.send_message_stream(u"fallo", on_chunk=chunks.append))
+    assert len(client.history) == 3
+    print "Streaming: %d peticiones al servidor local, todas las comprobaciones correctas" % len(handler.calls)
+  finally:
+    server.stop(0)
+
 def main(**args):
+  test_streaming_with_local_server()
+  benchmark_build_payload()
   print "Ok"
   
\ No newline at end of file
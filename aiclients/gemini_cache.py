@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: gemini_cache
+
+Descripción:
+Cache de contexto en el servidor (API cachedContents de Gemini).
+Permite subir una única vez el prefijo estático de la conversación (prompt base,
+secciones de los procesadores y DDL) y referenciarlo por nombre en las siguientes
+peticiones, de forma que no haya que reenviarlo en cada turno.
+El prefijo no incluye nada que cambie entre turnos (la extensión de la vista va
+con cada petición), así que su clave solo depende del modelo de IA, del modelo
+de datos (su DDL) y de las instrucciones de los procesadores.
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+"""
+
+import hashlib
+import json
+import threading
+import time
+
+from com.sun.net.httpserver import HttpHandler, HttpServer
+from java.io import InputStreamReader, StringReader
+from java.lang import String
+from java.net import InetSocketAddress
+from java.util.zip import GZIPInputStream
+from javax.json import Json
+
+from addons.chatagent_prototype.aiclients.transport import HttpError, HttpTransport, read_fully
+
+
+def context_cache_key(model_name, prefix_text):
+    """
+    Calcula la clave de la cache de contexto a partir del modelo y del texto del prefijo.
+    El prefijo incluye el DDL del modelo de datos, por lo que cualquier cambio en
+    el esquema produce una clave distinta.
+    """
+    digest = hashlib.sha256()
+    digest.update(model_name.encode("utf-8"))
+    digest.update("\n")
+    digest.update(prefix_text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class GeminiContextCache:
+    """
+    Gestiona los 'cachedContents' creados en Gemini, indexados por la clave
+    calculada con context_cache_key.
+
+    Cuando el TTL de una entrada está a punto de expirar se amplía en el servidor
+    (PATCH); si ya no existe se crea de nuevo. Al crear la cache de un prefijo
+    nuevo (por ejemplo, al cambiar de modelo de datos o leer de nuevo su
+    estructura) se borran del servidor las que quedan sustituidas.
+    Si el servidor rechaza la creación de la cache (por ejemplo, porque el
+    prefijo no alcanza el mínimo de tokens del modelo), no se vuelve a intentar
+    para ese prefijo hasta pasados 'retry_after' segundos.
+    """
+
+    def __init__(self, transport, api_base_url, api_key, ttl=3600, renew_margin=120, retry_after=600):
+        """
+        Args:
+            transport (aiclients.transport.HttpTransport): Transporte HTTP a utilizar.
+            api_base_url (str): URL base del API de Gemini.
+            api_key (str): Clave del API.
+            ttl (int, optional): Tiempo de vida en segundos de las caches creadas.
+            renew_margin (int, optional): Segundos antes de la expiración a partir de
+                                          los cuales la cache se renueva.
+            retry_after (int, optional): Segundos que se espera antes de volver a intentar
+                                         crear una cache que el servidor ha rechazado.
+        """
+        self.transport = transport
+        self.api_base_url = api_base_url
+        self.api_key = api_key
+        self.ttl = ttl
+        self.renew_margin = renew_margin
+        self.retry_after = retry_after
+        self.entries = {}  # clave -> (nombre de la cache, instante de expiración, modelo)
+        self.failed = {}  # clave -> instante a partir del cual se vuelve a intentar crearla
+        self.lock = threading.Lock()
+
+    def get(self, model_name, prefix_text):
+        """
+        Devuelve el nombre de la cache de contexto para el prefijo indicado,
+        creándola o renovándola si es necesario.
+
+        Args:
+            model_name (str): Nombre del modelo de Gemini.
+            prefix_text (unicode): Texto del prefijo estático de la conversación.
+
+        Returns:
+            str: El nombre de la cache ("cachedContents/...") o None si no se ha podido crear.
+        """
+        key = context_cache_key(model_name, prefix_text)
+        superseded = []
+        self.lock.acquire()
+        try:
+            now = time.time()
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] - self.renew_margin > now:
+                return entry[0]
+            if self.failed.get(key, 0) > now:
+                return None
+            self.failed.pop(key, None)
+            if entry is not None:
+                if entry[1] > now and self._renew(entry[0]):
+                    self.entries[key] = (entry[0], time.time() + self.ttl, model_name)
+                    return entry[0]
+                # Ha caducado o no se ha podido renovar; se crea de nuevo
+                del self.entries[key]
+                superseded.append(entry[0])
+            try:
+                name = self._create(model_name, prefix_text)
+            except Exception, e:
+                print u"Advertencia: no se ha podido crear la cache de contexto, se enviara el prompt completo. %s" % e
+                self.failed[key] = time.time() + self.retry_after
+                return None
+            # La nueva cache sustituye a las de los prefijos anteriores del mismo modelo
+            for other_key, other_entry in self.entries.items():
+                if other_entry[2] == model_name:
+                    del self.entries[other_key]
+                    superseded.append(other_entry[0])
+            self.entries[key] = (name, time.time() + self.ttl, model_name)
+            print u"Cache de contexto creada: %s" % name
+            return name
+        finally:
+            self.lock.release()
+            for old_name in superseded:
+                self._delete(old_name)
+
+    def invalidate(self, model_name, prefix_text, name=None):
+        """
+        Olvida la cache asociada al prefijo, por ejemplo cuando el servidor
+        indica que ya no existe. La siguiente llamada a get la volverá a crear.
+        Si se indica 'name', solo se olvida si sigue siendo esa cache (otro hilo
+        puede haberla creado de nuevo mientras tanto).
+        """
+        key = context_cache_key(model_name, prefix_text)
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None and (name is None or entry[0] == name):
+                del self.entries[key]
+        finally:
+            self.lock.release()
+
+    def _renew(self, name):
+        # Amplía el TTL de la cache en el servidor. HttpURLConnection no admite
+        # PATCH, así que se envía como POST con X-HTTP-Method-Override.
+        url_string = "%s/%s?updateMask=ttl&key=%s" % (self.api_base_url, name, self.api_key)
+        try:
+            self.transport.request(
+                "POST",
+                url_string,
+                u'{"ttl":"%ds"}' % self.ttl,
+                {"X-HTTP-Method-Override": "PATCH"}
+            )
+        except Exception, e:
+            print u"Advertencia: no se ha podido renovar la cache de contexto %s. %s" % (name, e)
+            return False
+        print u"Cache de contexto renovada: %s" % name
+        return True
+
+    def _delete(self, name):
+        # Borra del servidor una cache que ya no se va a usar; si ya no existe no importa
+        url_string = "%s/%s?key=%s" % (self.api_base_url, name, self.api_key)
+        try:
+            self.transport.request("DELETE", url_string)
+        except HttpError, e:
+            if e.code != 404:
+                print u"Advertencia: no se ha podido borrar la cache de contexto %s. %s" % (name, e)
+        except Exception, e:
+            print u"Advertencia: no se ha podido borrar la cache de contexto %s. %s" % (name, e)
+
+    def _create(self, model_name, prefix_text):
+        content_builder = Json.createObjectBuilder()
+        content_builder.add("role", "user")
+        content_builder.add("parts", Json.createArrayBuilder().add(Json.createObjectBuilder().add("text", prefix_text)))
+
+        payload_builder = Json.createObjectBuilder()
+        payload_builder.add("model", "models/%s" % model_name)
+        payload_builder.add("contents", Json.createArrayBuilder().add(content_builder))
+        payload_builder.add("ttl", "%ds" % self.ttl)
+
+        url_string = "%s/cachedContents?key=%s" % (self.api_base_url, self.api_key)
+        response = self.transport.post_json(url_string, payload_builder.build().toString())
+
+        json_reader = Json.createReader(StringReader(response))
+        response_json = json_reader.readObject()
+        json_reader.close()
+        if not response_json.containsKey("name"):
+            raise Exception(u"Respuesta inesperada al crear la cache de contexto: %s" % response)
+        return response_json.getString("name")
+
+
+def is_context_cache_error(error):
+    """
+    Indica si un HttpError de una petición que referencia una cache de contexto
+    se debe a la propia cache (ha caducado, se ha borrado o no es válida): un
+    400 o 404 cuya respuesta menciona el cachedContent. Los demás errores (por
+    ejemplo, 429 o 5xx) no se deben a la cache y no se reintentan sin ella.
+    """
+    if error.code not in (400, 404):
+        return False
+    body = (error.body or "").lower()
+    return "cachedcontent" in body or "cached content" in body
+
+
+class _StandInHandler(HttpHandler):
+  # Simula los endpoints cachedContents y generateContent del API de Gemini
+  def __init__(self):
+    self.caches = {}
+    self.calls = []
+    self.min_prefix = 10
+
+  def handle(self, exchange):
+    try:
+      method = exchange.getRequestHeaders().getFirst("X-HTTP-Method-Override") or exchange.getRequestMethod()
+      path = exchange.getRequestURI().getPath()
+      input_stream = exchange.getRequestBody()
+      if "gzip" == exchange.getRequestHeaders().getFirst("Content-Encoding"):
+        input_stream = GZIPInputStream(input_stream)
+      body = read_fully(InputStreamReader(input_stream, "UTF-8"))
+      self.calls.append((method, path))
+      code, response = self.respond(method, path, body)
+    except Exception, e:
+      code, response = 500, u'{"error":{"message":"%s"}}' % e
+    data = String(response).getBytes("UTF-8")
+    exchange.getResponseHeaders().set("Content-Type", "application/json")
+    exchange.sendResponseHeaders(code, len(data))
+    exchange.getResponseBody().write(data)
+    exchange.close()
+
+  def respond(self, method, path, body):
+    if path.endswith("/cachedContents") and method == "POST":
+      request = json.loads(body)
+      text = request["contents"][0]["parts"][0]["text"]
+      if len(text) < self.min_prefix:
+        return 400, u'{"error":{"message":"Cached content is too small"}}'
+      name = "cachedContents/c%d" % (len(self.calls))
+      self.caches[name] = text
+      return 200, u'{"name":"%s"}' % name
+    name = path[path.find("cachedContents/"):]
+    if "/cachedContents/" in path and method in ("PATCH", "DELETE"):
+      if name not in self.caches:
+        return 404, u'{"error":{"message":"CachedContent not found"}}'
+      if method == "DELETE":
+        del self.caches[name]
+      return 200, u'{}'
+    if path.endswith(":generateContent"):
+      request = json.loads(body)
+      if "cachedContent" in request and request["cachedContent"] not in self.caches:
+        return 404, u'{"error":{"message":"CachedContent not found (or permission denied)"}}'
+      if len(request["contents"]) > 1 and request["contents"][-1]["parts"][0]["text"] == u"limite":
+        return 429, u'{"error":{"message":"Resource has been exhausted"}}'
+      return 200, u'{"candidates":[{"content":{"parts":[{"text":"respuesta %d"}]}}]}' % len(request["contents"])
+    return 404, u'{"error":{"message":"Not found"}}'
+
+def test_with_local_server():
+  """
+  Prueba la cache de contexto contra un servidor HTTP local que simula el API
+  de Gemini: creación, reutilización, renovación, sustitución, reintento de las
+  creaciones rechazadas y reenvío del prompt completo cuando la cache ya no existe.
+  """
+  # Import diferido: gemini importa este módulo
+  from addons.chatagent_prototype.aiclients.gemini import GeminiClient
+
+  handler = _StandInHandler()
+  server = HttpServer.create(InetSocketAddress("127.0.0.1", 0), 0)
+  server.createContext("/", handler)
+  server.start()
+  try:
+    base_url = "http://127.0.0.1:%d/v1beta" % server.getAddress().getPort()
+    transport = HttpTransport()
+    cache = GeminiContextCache(transport, base_url, "test", ttl=600, renew_margin=60, retry_after=600)
+    prefix = u"Prompt inicial con el DDL del modelo de datos"
+
+    name = cache.get("gemini-test", prefix)
+    assert name is not None and cache.get("gemini-test", prefix) == name
+    assert handler.calls.count(("POST", "/v1beta/cachedContents")) == 1
+
+    # A punto de caducar: se renueva la misma cache
+    key = context_cache_key("gemini-test", prefix)
+    cache.entries[key] = (name, time.time() + 30, "gemini-test")
+    assert cache.get("gemini-test", prefix) == name
+    assert ("PATCH", "/v1beta/" + name) in handler.calls
+
+    # Un prefijo nuevo (otro DDL) sustituye a la cache anterior, que se borra
+    other = cache.get("gemini-test", prefix + u" cambiado")
+    assert other != name and name not in handler.caches and other in handler.caches
+
+    # Una creación rechazada no se reintenta hasta pasado retry_after
+    assert cache.get("gemini-test", u"corto") is None
+    assert cache.get("gemini-test", u"corto") is None
+    assert handler.calls.count(("POST", "/v1beta/cachedContents")) == 3
+    cache.failed[context_cache_key("gemini-test", u"corto")] = time.time() - 1
+    assert cache.get("gemini-test", u"corto") is None
+    assert handler.calls.count(("POST", "/v1beta/cachedContents")) == 4
+
+    # Si la cache se borra en el servidor la petición se repite con el prompt completo
+    client = GeminiClient(model_name="gemini-test")
+    client.api_url_base = base_url + "/models/%s:generateContent?key=%s"
+    client.context_cache = GeminiContextCache(client.transport, base_url, "test", ttl=600)
+    assert client.send_message(u"pregunta 1", prefix) == u"respuesta 1"
+    handler.caches.clear()
+    assert client.send_message(u"pregunta 2", prefix) == u"respuesta 4"
+    # Un error que no se debe a la cache (429) no se reintenta sin ella
+    assert client.send_message(u"limite", prefix).startswith("Error:")
+    print "Cache de contexto: %d peticiones al servidor local, todas las comprobaciones correctas" % len(handler.calls)
+  finally:
+    server.stop(0)
+
+
+def main(**args):
+  test_with_local_server()
+  print "Ok"
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: history
+
+Descripción:
+Historial de conversación de los clientes de IA.
+Los mensajes se guardan junto con su representación JSON ya serializada,
+de forma que al construir el payload de cada turno solo hay que serializar
+los mensajes nuevos y concatenar los fragmentos ya existentes.
+El historial puede compactarse para no superar un presupuesto de tokens:
+se eliminan de las respuestas antiguas los campos voluminosos (código Jython,
+diagramas PlantUML...) y, si no basta, se descartan los turnos más antiguos,
+conservando siempre el prompt inicial.
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+"""
+
+import json
+
+from collections import deque
+
+from javax.json import Json
+
+from addons.chatagent_prototype.utils import extraer_json_de_markdown
+
+# Campos de las respuestas del modelo que se eliminan de los turnos antiguos.
+BULKY_FIELDS = ("function", "diagram", "result_set_schema")
+
+OMITTED_VALUE = u"[omitido para ahorrar contexto]"
+
+# Caracteres por token que se asumen al estimar el tamaño de un texto.
+CHARS_PER_TOKEN = 4
+
+# Número máximo de registros de compactación que se conservan.
+MAX_METRICS = 100
+
+
+def serialize_gemini_message(message):
+    """
+    Serializa un mensaje del historial al formato 'contents' del API de Gemini.
+
+    Args:
+        message (dict): Mensaje con la forma {"role": ..., "parts": [{"text": ...}, ...]}.
+
+    Returns:
+        unicode: La representación JSON del mensaje.
+    """
+    message_builder = Json.createObjectBuilder()
+    message_builder.add("role", message["role"])
+
+    parts_array_builder = Json.createArrayBuilder()
+    # Itera sobre las partes de cada mensaje (asumiendo que cada parte tiene una clave 'text')
+    for part in message["parts"]:
+        parts_array_builder.add(Json.createObjectBuilder().add("text", part["text"]))
+
+    message_builder.add("parts", parts_array_builder)
+    return message_builder.build().toString()
+
+
+def estimate_tokens(text):
+    """
+    Estimación local y rápida del número de tokens de un texto.
+    """
+    return len(text) / CHARS_PER_TOKEN + 1
+
+def message_text(message):
+    """
+    Devuelve el texto completo de un mensaje del historial.
+    """
+    return u"".join([part["text"] for part in message["parts"]])
+
+def strip_bulky_fields(text):
+    """
+    Elimina de una respuesta del modelo los campos voluminosos (BULKY_FIELDS)
+    del JSON que contiene, dejando en su lugar una marca.
+
+    Args:
+        text (unicode): Texto de la respuesta del modelo.
+
+    Returns:
+        unicode: El texto compactado, o None si no había nada que eliminar.
+    """
+    stripped = text.strip()
+    if stripped.startswith("{"):
+        json_text, other_text = stripped, u""
+    else:
+        json_text, other_text = extraer_json_de_markdown(stripped)
+        if json_text is None:
+            return None
+    try:
+        response = json.loads(json_text)
+    except ValueError:
+        return None
+    if not isinstance(response, dict):
+        return None
+    changed = False
+    for field in BULKY_FIELDS:
+        if field in response and response[field] != OMITTED_VALUE:
+            response[field] = OMITTED_VALUE
+            changed = True
+    if not changed:
+        return None
+    compacted = u"```json\n%s\n```" % json.dumps(response, indent=2, ensure_ascii=False, sort_keys=True)
+    if other_text:
+        compacted = other_text + u"\n" + compacted
+    return compacted
+
+
+class ConversationHistory:
+    """
+    Historial de mensajes de una conversación, de solo añadir por el final.
+    Se comporta como una lista de mensajes (len, indices, iteracion, pop) y
+    además mantiene cacheado el fragmento JSON de cada mensaje.
+    """
+
+    def __init__(self, serializer=serialize_gemini_message, token_budget=None, keep_full_replies=1):
+        """
+        Args:
+            serializer (callable, optional): Función que recibe un mensaje y devuelve
+                                             su representación JSON. Por defecto el
+                                             formato de Gemini.
+            token_budget (int, optional): Número máximo de tokens (estimados) del historial.
+                                          Si es None el historial no se compacta.
+            keep_full_replies (int, optional): Número de respuestas del modelo más recientes
+                                               que se conservan sin compactar.
+        """
+        self.serializer = serializer
+        self.token_budget = token_budget
+        self.keep_full_replies = keep_full_replies
+        self.messages = []
+        self.fragments = []
+        self.tokens = []
+        self.pinned = 0  # Numero de mensajes iniciales que nunca se descartan
+        self.turns = 0  # Numero de compactaciones (turnos) de la conversacion actual
+        self.metrics = deque(maxlen=MAX_METRICS)  # Un registro por cada compactacion, los mas recientes
+
+    def append(self, message, pinned=False):
+        """
+        Añade un mensaje al final del historial, serializándolo una única vez.
+
+        Args:
+            message (dict): El mensaje a añadir.
+            pinned (bool, optional): Si el mensaje nunca debe descartarse al compactar
+                                     (por ejemplo, el prompt inicial con el DDL).
+                                     Solo puede fijarse mientras no haya mensajes sin fijar.
+        """
+        self.fragments.append(self.serializer(message))
+        self.tokens.append(estimate_tokens(message_text(message)))
+        self.messages.append(message)
+        if pinned and self.pinned == len(self.messages) - 1:
+            self.pinned += 1
+
+    def pop(self):
+        """
+        Elimina y devuelve el último mensaje del historial.
+        """
+        self.fragments.pop()
+        self.tokens.pop()
+        if self.pinned > len(self.fragments):
+            self.pinned = len(self.fragments)
+        return self.messages.pop()
+
+    def clear(self):
+        """
+        Vacía el historial y sus métricas.
+        """
+        self.messages = []
+        self.fragments = []
+        self.tokens = []
+        self.pinned = 0
+        self.turns = 0
+        self.metrics.clear()
+
+    def estimated_tokens(self):
+        """
+        Devuelve el número estimado de tokens de todo el historial.
+        """
+        return sum(self.tokens)
+
+    def payload_size(self):
+        """
+        Devuelve el tamaño en caracteres del historial serializado.
+        """
+        return sum([len(fragment) for fragment in self.fragments])
+
+    def compact(self):
+        """
+        Compacta el historial para ajustarlo al presupuesto de tokens.
+        Primero se eliminan los campos voluminosos de las respuestas antiguas
+        del modelo y, si no es suficiente, se descartan los turnos más antiguos.
+        Nunca se descartan los mensajes fijados ni el último mensaje.
+
+        Returns:
+            dict: Métricas de la compactación (tamaño antes y después), que
+                  también se guardan en self.metrics (las MAX_METRICS últimas).
+        """
+        self.turns += 1
+        record = {
+            "turn": self.turns,
+            "chars_before": self.payload_size(),
+            "tokens_before": self.estimated_tokens(),
+            "dropped_messages": 0,
+            "stripped_replies": 0
+        }
+        if self.token_budget is not None:
+            record["stripped_replies"] = self._strip_old_replies()
+            while self.estimated_tokens() > self.token_budget:
+                dropped = self._drop_oldest_turn()
+                if not dropped:
+                    break
+                record["dropped_messages"] += dropped
+        record["chars_after"] = self.payload_size()
+        record["tokens_after"] = self.estimated_tokens()
+        self.metrics.append(record)
+        return record
+
+    def _strip_old_replies(self):
+        stripped = 0
+        model_indexes = [i for i in range(self.pinned, len(self.messages)) if self.messages[i]["role"] == "model"]
+        if self.keep_full_replies > 0:
+            model_indexes = model_indexes[:-self.keep_full_replies]
+        for i in model_indexes:
+            message = self.messages[i]
+            if message.get("compacted"):
+                continue
+            message["compacted"] = True
+            text = strip_bulky_fields(message_text(message))
+            if text is None:
+                continue
+            message["parts"] = [{"text": text}]
+            self.fragments[i] = self.serializer(message)
+            self.tokens[i] = estimate_tokens(text)
+            stripped += 1
+        return stripped
+
+    def _drop_oldest_turn(self):
+        # Un turno es un mensaje del usuario seguido de la respuesta del modelo.
+        # Se descarta el primero tras los mensajes fijados, sin tocar el ultimo mensaje.
+        # Devuelve el numero de mensajes descartados.
+        start = self.pinned
+        if start + 2 >= len(self.messages):
+            return 0
+        end = start + 1
+        if self.messages[start]["role"] == "user" and self.messages[start + 1]["role"] == "model":
+            end = start + 2
+        del self.messages[start:end]
+        del self.fragments[start:end]
+        del self.tokens[start:end]
+        return end - start
+
+    def to_json_array(self, start=0):
+        """
+        Devuelve el historial como un array JSON (unicode), reutilizando los
+        fragmentos ya serializados.
+
+        Args:
+            start (int, optional): Indice del primer mensaje a incluir.
+        """
+        return u"[" + u",".join(self.fragments[start:]) + u"]"
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __nonzero__(self):
+        return len(self.messages) > 0
+
+    def __getitem__(self, index):
+        return self.messages[index]
+
+    def __iter__(self):
+        return iter(self.messages)
+
+
+def main(**args):
+  print "Ok"
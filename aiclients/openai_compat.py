@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: openai_compat
+
+Descripción:
+Cliente de IA para servidores que implementan el protocolo chat-completions
+compatible con OpenAI, como el servidor de llama.cpp, vLLM u Ollama.
+Permite usar un modelo local (on-premise) con la misma semántica de historial
+que GeminiClient, incluida la recepción de las respuestas en streaming.
+Utiliza la capa de transporte compartida (aiclients.transport).
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+"""
+
+import json
+
+from java.io import InputStreamReader, StringReader
+from java.lang import String, StringBuilder
+from java.net import InetSocketAddress
+from java.util.zip import GZIPInputStream
+from com.sun.net.httpserver import HttpHandler, HttpServer
+
+from javax.json import Json
+
+from addons.chatagent_prototype.aiclient import AIClient, with_turn_context, is_error_response
+from addons.chatagent_prototype.aiclients.history import ConversationHistory, message_text
+from addons.chatagent_prototype.aiclients.transport import HttpTransport, iter_sse_events, read_fully
+from addons.chatagent_prototype import config
+from addons.chatagent_prototype import tracing
+
+# Roles del historial (formato Gemini) y su equivalente en el protocolo de OpenAI
+OPENAI_ROLES = {"user": "user", "model": "assistant", "system": "system"}
+
+
+def serialize_openai_message(message):
+    """
+    Serializa un mensaje del historial al formato 'messages' de chat-completions.
+
+    Args:
+        message (dict): Mensaje con la forma {"role": ..., "parts": [{"text": ...}, ...]}.
+
+    Returns:
+        unicode: La representación JSON del mensaje.
+    """
+    message_builder = Json.createObjectBuilder()
+    message_builder.add("role", OPENAI_ROLES.get(message["role"], message["role"]))
+    message_builder.add("content", message_text(message))
+    return message_builder.build().toString()
+
+
+class OpenAICompatibleClient(AIClient):
+    """
+    Clase para interactuar con un servidor compatible con el API chat-completions
+    de OpenAI, gestionando el historial de mensajes.
+    """
+
+    def __init__(self, temperature=0.1):
+        """
+        Inicializa el cliente con el historial vacío.
+
+        Args:
+            temperature (float, optional): La temperatura de generación del modelo.
+        """
+        AIClient.__init__(self)
+        self.model_name = config.OPENAI_MODEL
+        # El historial guarda los mensajes con la misma estructura que GeminiClient,
+        # pero se serializa al formato de chat-completions.
+        self.history = ConversationHistory(
+            serializer=serialize_openai_message,
+            token_budget=config.HISTORY_TOKEN_BUDGETS.get(self.model_name, config.HISTORY_DEFAULT_TOKEN_BUDGET),
+            keep_full_replies=config.HISTORY_KEEP_FULL_REPLIES
+        )
+        self.api_url = config.OPENAI_BASE_URL + "/chat/completions"
+        self.api_key = config.OPENAI_API_KEY
+        self.temperature = temperature
+        self.transport = HttpTransport(gzip_requests=config.OPENAI_GZIP_REQUESTS)
+
+    def resetHistory(self):
+        """
+        Reinicia el historial de mensajes de la conversación.
+        """
+        self.history.clear()
+        print("Historial de mensajes reiniciado.")
+
+    def abort(self, thread=None):
+        """
+        Aborta la petición en curso cerrando su conexión (ver AIClient.abort).
+        """
+        self.transport.abort(thread)
+
+    def add_exchange(self, user_prompt, response, initial_prompt=None):
+        """
+        Añade al historial un intercambio obtenido sin llamar al modelo.
+        """
+        if not self.history and initial_prompt is not None:
+            self.history.append({"role": "system", "parts": [{"text": initial_prompt}]}, pinned=True)
+        self.history.append({"role": "user", "parts": [{"text": user_prompt}]})
+        self.history.append({"role": "model", "parts": [{"text": response}]})
+
+    def get_history_metrics(self):
+        """
+        Devuelve las métricas de compactación del historial, una por turno de la
+        conversación actual (como mucho las de los history.MAX_METRICS últimos).
+        """
+        return list(self.history.metrics)
+
+    def send_message(self, user_prompt, initial_prompt=None, temperature=None, turn_context=None):
+        """
+        Envía un mensaje al modelo, gestionando el historial de la conversación.
+        El prompt inicial se envía como mensaje de sistema.
+
+        Returns:
+            str: La respuesta generada por el modelo, o una cadena que indica el error.
+        """
+        return self._send(user_prompt, initial_prompt, temperature, None, turn_context)
+
+    def send_message_stream(self, user_prompt, initial_prompt=None, temperature=None, on_chunk=None, turn_context=None):
+        """
+        Igual que send_message, pero recibe la respuesta en streaming (SSE) y
+        notifica a 'on_chunk' cada fragmento de texto según llega.
+        """
+        if on_chunk is None:
+            on_chunk = lambda text: None
+        return self._send(user_prompt, initial_prompt, temperature, on_chunk, turn_context)
+
+    def _headers(self):
+        if not self.api_key:
+            return None
+        return {"Authorization": "Bearer %s" % self.api_key}
+
+    def _build_payload(self, current_temperature=None, stream=False):
+        temp_to_use = current_temperature if current_temperature is not None else self.temperature
+        response_format = u""
+        if self.response_schema is not None:
+            # Salida estructurada: el servidor restringe la respuesta al esquema
+            response_format = u',"response_format":%s' % json.dumps({
+                "type": "json_schema",
+                "json_schema": {"name": "respuesta", "schema": self.response_schema}
+            })
+        return u'{"model":%s,"messages":%s,"temperature":%s,"stream":%s%s}' % (
+            json.dumps(self.model_name),
+            self.history.to_json_array(),
+            repr(float(temp_to_use)),
+            "true" if stream else "false",
+            response_format
+        )
+
+    def _send(self, user_prompt, initial_prompt, temperature, on_chunk, turn_context=None):
+        try:
+            if not self.history and initial_prompt is not None:
+                self.history.append({"role": "system", "parts": [{"text": initial_prompt}]}, pinned=True)
+            self.history.append({"role": "user", "parts": [{"text": with_turn_context(turn_context, user_prompt)}]})
+            self.history.compact()
+
+            payload = self._build_payload(current_temperature=temperature, stream=on_chunk is not None)
+            with tracing.span("network", model=self.model_name, streaming=on_chunk is not None,
+                              payload_chars=len(payload)) as span:
+                if on_chunk is not None:
+                    generated_text = self._send_stream_request(payload, on_chunk, span)
+                else:
+                    generated_text = self._send_request(payload, span)
+                span.set(response_chars=len(generated_text))
+            if not generated_text:
+                generated_text = "Error: La respuesta del servidor no contenia texto."
+
+            if is_error_response(generated_text):
+                # Ni el mensaje ni las instrucciones del turno se quedan en el historial
+                self.history.pop()
+            else:
+                if turn_context:
+                    # Las instrucciones del turno no se conservan en el historial
+                    self.history.pop()
+                    self.history.append({"role": "user", "parts": [{"text": user_prompt}]})
+                self.history.append({"role": "model", "parts": [{"text": generated_text}]})
+            return generated_text
+
+        except Exception, e:
+            print(u"Error general en send_message: %s" % e)
+            if self.history and self.history[-1]["role"] == "user":
+                self.history.pop()
+            return u"Error: No se pudo procesar la solicitud o la respuesta del servidor. Detalles: %s" % e
+
+    def _send_request(self, payload, span=None):
+        response = self.transport.post_json(self.api_url, payload, self._headers())
+        json_reader = Json.createReader(StringReader(response))
+        response_json = json_reader.readObject()
+        json_reader.close()
+        if response_json.containsKey("error"):
+            raise Exception(u"Error del servidor: %s" % response_json.get("error").toString())
+        if span is not None and response_json.containsKey("usage") and not response_json.isNull("usage"):
+            span.set(**usage_fields(response_json.getJsonObject("usage")))
+        choices = response_json.getJsonArray("choices")
+        if choices is None or choices.isEmpty():
+            raise Exception(u"Estructura de respuesta inesperada: %s" % response)
+        message = choices.getJsonObject(0).getJsonObject("message")
+        return message.getString("content", u"")
+
+    def _send_stream_request(self, payload, on_chunk, span=None):
+        reader = self.transport.open_stream(self.api_url, payload, self._headers())
+        generated_text = StringBuilder()
+        try:
+            for event_data in iter_sse_events(reader):
+                if event_data == "[DONE]":
+                    break
+                json_reader = Json.createReader(StringReader(event_data))
+                chunk_json = json_reader.readObject()
+                json_reader.close()
+                if chunk_json.containsKey("error"):
+                    raise Exception(u"Error del servidor: %s" % chunk_json.get("error").toString())
+                if span is not None and chunk_json.containsKey("usage") and not chunk_json.isNull("usage"):
+                    span.set(**usage_fields(chunk_json.getJsonObject("usage")))
+                choices = chunk_json.getJsonArray("choices")
+                if choices is None or choices.isEmpty():
+                    continue
+                delta = choices.getJsonObject(0).getJsonObject("delta")
+                if delta is None or not delta.containsKey("content") or delta.isNull("content"):
+                    continue
+                text = delta.getString("content")
+                if text:
+                    if span is not None and generated_text.length() == 0:
+                        span.set(first_chunk_ms=span.elapsed_ms())
+                    generated_text.append(text)
+                    on_chunk(text)
+        finally:
+            self.transport.close_stream(reader)
+        return generated_text.toString()
+
+
+def usage_fields(usage_json):
+    """
+    Convierte el objeto usage de una respuesta de chat/completions en los
+    atributos de consumo de tokens de una traza.
+    """
+    return {
+        "prompt_tokens": usage_json.getInt("prompt_tokens", 0),
+        "output_tokens": usage_json.getInt("completion_tokens", 0),
+        "total_tokens": usage_json.getInt("total_tokens", 0)
+    }
+
+
+class _StreamStandInHandler(HttpHandler):
+  # Simula el endpoint chat/completions de un servidor compatible con OpenAI en
+  # modo streaming: un evento SSE por fragmento y el marcador [DONE] al final
+  def __init__(self):
+    self.calls = []
+
+  def handle(self, exchange):
+    input_stream = exchange.getRequestBody()
+    if "gzip" == exchange.getRequestHeaders().getFirst("Content-Encoding"):
+      input_stream = GZIPInputStream(input_stream)
+    request = json.loads(read_fully(InputStreamReader(input_stream, "UTF-8")))
+    self.calls.append(request)
+    if request["messages"][-1]["content"] == u"fallo":
+      events = [u'{"choices":[{"delta":{"content":"a medias"}}]}',
+                u'{"error":{"message":"Internal error"}}']
+    else:
+      events = [u'{"choices":[{"delta":{"role":"assistant"}}]}']
+      events.extend(u'{"choices":[{"delta":{"content":"%s"}}]}' % text for text in (u"Hola", u", ", u"mundo"))
+      events.append(u'{"choices":[{"delta":{},"finish_reason":"stop"}]}')
+      events.append(u'{"choices":[],"usage":{"prompt_tokens":12,"completion_tokens":3,"total_tokens":15}}')
+      # Lo que llega despues de [DONE] no forma parte de la respuesta
+      events.extend([u"[DONE]", u'{"choices":[{"delta":{"content":"ignorado"}}]}'])
+    exchange.getResponseHeaders().set("Content-Type", "text/event-stream")
+    exchange.sendResponseHeaders(200, 0)
+    output = exchange.getResponseBody()
+    for event in events:
+      output.write(String(u"data: %s\n\n" % event).getBytes("UTF-8"))
+      output.flush()
+    exchange.close()
+
+def test_with_local_server():
+  """
+  Prueba send_message_stream contra un servidor HTTP local que simula el
+  endpoint chat/completions: los fragmentos llegan a on_chunk en orden, la
+  lectura termina en [DONE], y un error a mitad del stream se devuelve como
+  error sin dejar el mensaje en el historial.
+  """
+  handler = _StreamStandInHandler()
+  server = HttpServer.create(InetSocketAddress("127.0.0.1", 0), 0)
+  server.createContext("/", handler)
+  server.start()
+  try:
+    client = OpenAICompatibleClient()
+    client.api_url = "http://127.0.0.1:%d/v1/chat/completions" % server.getAddress().getPort()
+    client.api_key = None
+    chunks = []
+    assert client.send_message_stream(u"saludo", u"Prompt inicial", on_chunk=chunks.append) == u"Hola, mundo"
+    assert chunks == [u"Hola", u", ", u"mundo"]
+    assert handler.calls[0]["stream"] is True
+    assert [message["role"] for message in handler.calls[0]["messages"]] == [u"system", u"user"]
+    assert len(client.history) == 3
+
+    # Un error notificado en el propio stream: el texto recibido no cuenta como respuesta
+    assert is_error_response(client.send_message_stream(u"fallo", on_chunk=chunks.append))
+    assert len(client.history) == 3
+    print "Streaming: %d peticiones al servidor local, todas las comprobaciones correctas" % len(handler.calls)
+  finally:
+    server.stop(0)
+
+def main(**args):
+  test_with_local_server()
+  print "Ok"
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: replay
+
+Descripción:
+Clientes de IA para grabar y reproducir conversaciones.
+RecordingAIClient envuelve a otro cliente y va añadiendo cada petición y su
+respuesta, con el tiempo que tardó, a un fichero JSONL (una línea JSON por
+intercambio). ReplayAIClient sirve después esas respuestas sin acceder a la red,
+con la latencia original o sin latencia, lo que permite medir el coste del
+propio panel de chat y de los procesadores y reproducir sesiones lentas.
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+"""
+
+import json
+import os
+import threading
+import time
+
+from addons.chatagent_prototype.aiclient import AIClient
+from addons.chatagent_prototype.aiclients.cached import normalize_text, hash_text
+
+
+class RecordingAIClient(AIClient):
+    """
+    Cliente de IA que delega en otro y graba cada intercambio en un fichero JSONL.
+    """
+
+    def __init__(self, delegate, transcript_path):
+        """
+        Args:
+            delegate (aiclient.AIClient): El cliente de IA cuyas respuestas se graban.
+            transcript_path (str): Ruta del fichero JSONL; los intercambios se añaden al final.
+        """
+        self.delegate = delegate
+        AIClient.__init__(self, delegate.executor)
+        self.transcript_path = transcript_path
+        directory = os.path.dirname(transcript_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.turn = 0
+        self.last_prompt_hash = None
+
+    def __getattr__(self, name):
+        if name == "delegate":
+            raise AttributeError(name)
+        return getattr(self.delegate, name)
+
+    def set_response_schema(self, schema):
+        AIClient.set_response_schema(self, schema)
+        self.delegate.set_response_schema(schema)
+
+    def abort(self, thread=None):
+        self.delegate.abort(thread)
+
+    def prewarm(self, initial_prompt):
+        self.delegate.prewarm(initial_prompt)
+
+    def resetHistory(self):
+        self.delegate.resetHistory()
+        self.turn = 0
+        self.last_prompt_hash = None
+
+    def add_exchange(self, user_prompt, response, initial_prompt=None):
+        self.delegate.add_exchange(user_prompt, response, initial_prompt)
+        self.turn += 1
+
+    def send_message(self, user_prompt, initial_prompt=None, temperature=None, turn_context=None):
+        start = time.time()
+        response = self.delegate.send_message(user_prompt, initial_prompt, temperature, turn_context)
+        self._record(user_prompt, initial_prompt, temperature, response, start, None, turn_context)
+        return response
+
+    def send_message_stream(self, user_prompt, initial_prompt=None, temperature=None, on_chunk=None, turn_context=None):
+        start = time.time()
+        first_chunk = []
+        def record_chunk(text):
+            if not first_chunk:
+                first_chunk.append(time.time())
+            if on_chunk is not None:
+                on_chunk(text)
+        response = self.delegate.send_message_stream(user_prompt, initial_prompt, temperature, record_chunk, turn_context)
+        first_chunk_time = first_chunk[0] if first_chunk else None
+        self._record(user_prompt, initial_prompt, temperature, response, start, first_chunk_time, turn_context)
+        return response
+
+    def _record(self, user_prompt, initial_prompt, temperature, response, start, first_chunk_time, turn_context=None):
+        end = time.time()
+        self.turn += 1
+        prompt_hash = hash_text(initial_prompt) if initial_prompt else None
+        record = {
+            "timestamp": start,
+            "turn": self.turn,
+            "model": getattr(self.delegate, "model_name", None),
+            "temperature": temperature,
+            "initial_prompt_hash": prompt_hash,
+            # El texto completo solo se graba cuando cambia respecto al intercambio anterior
+            "initial_prompt": initial_prompt if initial_prompt and prompt_hash != self.last_prompt_hash else None,
+            "turn_context_hash": hash_text(turn_context) if turn_context else None,
+            "user_prompt": user_prompt,
+            "response": response,
+            "elapsed_ms": int((end - start) * 1000),
+            "first_chunk_ms": int((first_chunk_time - start) * 1000) if first_chunk_time else None
+        }
+        if prompt_hash is not None:
+            self.last_prompt_hash = prompt_hash
+        line = json.dumps(record, ensure_ascii=False).encode("utf-8")
+        self.lock.acquire()
+        try:
+            f = open(self.transcript_path, "ab")
+            try:
+                f.write(line)
+                f.write("\n")
+            finally:
+                f.close()
+        except IOError, e:
+            print u"Advertencia: no se ha podido grabar el intercambio en '%s'. %s" % (self.transcript_path, e)
+        finally:
+            self.lock.release()
+
+
+class ReplayAIClient(AIClient):
+    """
+    Cliente de IA que reproduce las respuestas grabadas por RecordingAIClient.
+
+    Cada mensaje se busca en la grabación por su texto normalizado, empezando a
+    partir del último intercambio servido, de forma que una misma pregunta hecha
+    varias veces en la sesión original obtiene cada vez la respuesta que tuvo.
+    Si no se encuentra, se sirve el siguiente intercambio en orden.
+    """
+
+    def __init__(self, transcript_path, realtime=False):
+        """
+        Args:
+            transcript_path (str): Ruta del fichero JSONL grabado.
+            realtime (bool, optional): Si es True se reproduce la latencia original
+                                       de cada respuesta; si es False se responde
+                                       de inmediato.
+        """
+        AIClient.__init__(self)
+        self.transcript_path = transcript_path
+        self.realtime = realtime
+        self.records = load_transcript(transcript_path)
+        self.position = 0
+        self.model_name = self.records[0].get("model") if self.records else None
+        self.temperature = None
+        self.history = []
+
+    def resetHistory(self):
+        self.history = []
+
+    def add_exchange(self, user_prompt, response, initial_prompt=None):
+        self.history.append((user_prompt, response))
+
+    def send_message(self, user_prompt, initial_prompt=None, temperature=None, turn_context=None):
+        return self._replay(user_prompt, None)
+
+    def send_message_stream(self, user_prompt, initial_prompt=None, temperature=None, on_chunk=None, turn_context=None):
+        return self._replay(user_prompt, on_chunk)
+
+    def _replay(self, user_prompt, on_chunk):
+        record = self._find(user_prompt)
+        if record is None:
+            return u"Error: La grabación '%s' no contiene más respuestas." % self.transcript_path
+        response = record.get("response")
+        if self.realtime:
+            first_chunk_ms = record.get("first_chunk_ms")
+            elapsed_ms = record.get("elapsed_ms") or 0
+            if on_chunk is not None and first_chunk_ms is not None:
+                # Se respeta el tiempo hasta el primer fragmento y el resto de la respuesta
+                time.sleep(first_chunk_ms / 1000.0)
+                on_chunk(response)
+                time.sleep(max(elapsed_ms - first_chunk_ms, 0) / 1000.0)
+                self.history.append((user_prompt, response))
+                return response
+            time.sleep(elapsed_ms / 1000.0)
+        if on_chunk is not None:
+            on_chunk(response)
+        self.history.append((user_prompt, response))
+        return response
+
+    def _find(self, user_prompt):
+        normalized = normalize_text(user_prompt)
+        for i in range(self.position, len(self.records)):
+            if normalize_text(self.records[i].get("user_prompt")) == normalized:
+                self.position = i + 1
+                return self.records[i]
+        if self.position < len(self.records):
+            record = self.records[self.position]
+            print u"Advertencia: el mensaje no esta en la grabacion, se sirve el siguiente intercambio."
+            self.position += 1
+            return record
+        return None
+
+
+def load_transcript(transcript_path):
+    """
+    Lee un fichero JSONL de intercambios grabados.
+
+    Returns:
+        list: Los intercambios, en el orden en que se grabaron.
+    """
+    records = []
+    f = open(transcript_path, "rb")
+    try:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line.decode("utf-8")))
+    finally:
+        f.close()
+    return records
+
+
+def main(**args):
+  print "Ok"
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: routing
+
+Descripción:
+Enrutado de peticiones en dos niveles.
+Antes de llamar al modelo, un clasificador barato (local, por palabras clave, o
+una llamada corta a un modelo rápido) estima de qué tipo de procesador será la
+respuesta. Solo las peticiones que necesitan generación pesada (SQL, gráficos,
+diagramas) van al modelo potente; el resto, como un saludo o una respuesta de
+texto, las responde el modelo rápido. Los dos clientes mantienen el mismo
+historial, de forma que la conversación es continua sea cual sea el que responde.
+Cada decisión y la latencia de cada nivel se registran con tracing.
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+"""
+
+import json
+import re
+import threading
+import unicodedata
+
+from addons.chatagent_prototype.aiclient import AIClient, is_error_response
+from addons.chatagent_prototype import config
+from addons.chatagent_prototype import tracing
+from addons.chatagent_prototype import utils
+
+
+def normalize_intent_text(text):
+    """
+    Normaliza un texto para buscar palabras clave: minúsculas, sin tildes y
+    con las palabras separadas por un único espacio.
+    """
+    if text is None:
+        return u""
+    text = unicodedata.normalize("NFKD", unicode(text).lower())
+    text = u"".join([c for c in text if not unicodedata.combining(c)])
+    return u" ".join(re.findall(r"\w+", text, re.UNICODE))
+
+
+class KeywordIntentClassifier:
+    """
+    Clasificador local: cuenta las palabras clave de cada procesador
+    (Processor.get_intent_keywords) que aparecen en la petición.
+    No hace llamadas de red y tarda microsegundos.
+    """
+
+    def __init__(self, processors):
+        """
+        Args:
+            processors (list): Las instancias de Processor registradas.
+        """
+        self.keywords = []  # Pares (palabra clave normalizada, tipo)
+        for processor in processors:
+            for keyword in processor.get_intent_keywords():
+                self.keywords.append((normalize_intent_text(keyword), processor.get_type()))
+
+    def classify(self, user_prompt):
+        """
+        Devuelve el tipo de procesador más probable para la petición, o None si
+        ninguna palabra clave coincide o hay empate entre varios tipos.
+        """
+        text = u" %s " % normalize_intent_text(user_prompt)
+        scores = {}
+        for keyword, processor_type in self.keywords:
+            if (u" %s " % keyword) in text:
+                scores[processor_type] = scores.get(processor_type, 0) + 1
+        if not scores:
+            return None
+        best = max(scores.values())
+        winners = [processor_type for processor_type, score in scores.items() if score == best]
+        if len(winners) != 1:
+            return None
+        return winners[0]
+
+
+class ModelIntentClassifier:
+    """
+    Clasificador que pregunta el tipo de la respuesta a un modelo rápido, con un
+    prompt corto (solo las descripciones de los procesadores) y sin historial.
+    Recuerda las últimas clasificaciones, ya que en un mismo turno lo consultan
+    tanto el enrutado como la selección de las secciones del prompt.
+    Las consultas al modelo no se serializan: cada una usa un cliente propio,
+    tomado de los libres o creado con 'aiclient_factory'.
+    """
+
+    MAX_RECENT = 32
+
+    def __init__(self, aiclient_factory, processors):
+        """
+        Args:
+            aiclient_factory (callable): Crea un cliente del modelo rápido, dedicado al clasificador.
+            processors (list): Las instancias de Processor registradas.
+        """
+        self.aiclient_factory = aiclient_factory
+        self.idle_clients = []
+        self.lock = threading.Lock()
+        self.recent = {}  # Petición -> tipo estimado
+        self.types = sorted([processor.get_type() for processor in processors])
+        descriptions = u"".join([u"- %s: %s\n" % (processor.get_type(), processor.get_description())
+                                 for processor in sorted(processors, key=lambda p: p.get_type())])
+        # Por concatenación: las descripciones y la petición pueden contener '%'
+        self.prompt = (u"Clasifica la siguiente peticion de un usuario de un asistente de bases de datos "
+                       u"segun el tipo de respuesta que necesita. Los tipos posibles son:\n" + descriptions +
+                       u"\nResponde solo con un JSON de la forma {\"type\": \"<tipo>\"}.\n\n"
+                       u"Peticion: ")
+
+    def classify(self, user_prompt):
+        self.lock.acquire()
+        try:
+            if user_prompt in self.recent:
+                return self.recent[user_prompt]
+            aiclient = self.idle_clients.pop() if self.idle_clients else None
+        finally:
+            self.lock.release()
+        if aiclient is None:
+            aiclient = self._create_client()
+        try:
+            processor_type = self._classify(aiclient, user_prompt)
+        finally:
+            self.lock.acquire()
+            try:
+                self.idle_clients.append(aiclient)
+            finally:
+                self.lock.release()
+        self.lock.acquire()
+        try:
+            if len(self.recent) >= self.MAX_RECENT:
+                self.recent.clear()
+            self.recent[user_prompt] = processor_type
+            return processor_type
+        finally:
+            self.lock.release()
+
+    def _create_client(self):
+        aiclient = self.aiclient_factory()
+        aiclient.set_response_schema({
+            "type": "object",
+            "properties": {"type": {"type": "string", "enum": self.types}},
+            "required": ["type"]
+        })
+        return aiclient
+
+    def _classify(self, aiclient, user_prompt):
+        aiclient.resetHistory()
+        response = aiclient.send_message(self.prompt + user_prompt, None, 0.0)
+        if is_error_response(response):
+            return None
+        s, text = utils.extraer_json(response.strip())
+        if s is None:
+            return None
+        try:
+            processor_type = json.loads(s).get("type")
+        except ValueError:
+            return None
+        if processor_type not in self.types:
+            return None
+        return processor_type
+
+
+class RoutingAIClient(AIClient):
+    """
+    Cliente de IA que reparte las peticiones entre un modelo rápido y uno potente
+    según el tipo de respuesta que estima el clasificador. Las peticiones que no
+    se pueden clasificar van al modelo potente.
+    """
+
+    def __init__(self, fast_client, heavy_client, classifier, heavy_types=None):
+        """
+        Args:
+            fast_client (aiclient.AIClient): Cliente del modelo rápido.
+            heavy_client (aiclient.AIClient): Cliente del modelo potente.
+            classifier: Objeto con un método classify(user_prompt) que devuelve un tipo de procesador o None.
+            heavy_types (list, optional): Tipos que necesitan el modelo potente. Por defecto config.ROUTING_HEAVY_TYPES.
+        """
+        self.heavy_client = heavy_client
+        AIClient.__init__(self, heavy_client.executor)
+        if heavy_types is None:
+            heavy_types = config.ROUTING_HEAVY_TYPES
+        self.fast_client = fast_client
+        self.classifier = classifier
+        self.heavy_types = heavy_types
+        self.decisions = {"fast": 0, "heavy": 0}
+
+    def __getattr__(self, name):
+        # El resto de atributos (model_name, métricas del historial...) son los del modelo potente
+        if name == "heavy_client":
+            raise AttributeError(name)
+        return getattr(self.heavy_client, name)
+
+    def set_response_schema(self, schema):
+        AIClient.set_response_schema(self, schema)
+        self.fast_client.set_response_schema(schema)
+        self.heavy_client.set_response_schema(schema)
+
+    def abort(self, thread=None):
+        self.fast_client.abort(thread)
+        self.heavy_client.abort(thread)
+
+    def prewarm(self, initial_prompt):
+        self.fast_client.prewarm(initial_prompt)
+        self.heavy_client.prewarm(initial_prompt)
+
+    def resetHistory(self):
+        self.fast_client.resetHistory()
+        self.heavy_client.resetHistory()
+
+    def add_exchange(self, user_prompt, response, initial_prompt=None):
+        self.fast_client.add_exchange(user_prompt, response, initial_prompt)
+        self.heavy_client.add_exchange(user_prompt, response, initial_prompt)
+
+    def send_message(self, user_prompt, initial_prompt=None, temperature=None, turn_context=None):
+        return self._send(user_prompt, initial_prompt, temperature, None, turn_context)
+
+    def send_message_stream(self, user_prompt, initial_prompt=None, temperature=None, on_chunk=None, turn_context=None):
+        if on_chunk is None:
+            on_chunk = lambda text: None
+        return self._send(user_prompt, initial_prompt, temperature, on_chunk, turn_context)
+
+    def get_stats(self):
+        """
+        Devuelve el número de peticiones enviadas a cada nivel.
+
+        Returns:
+            dict: Con las claves fast y heavy.
+        """
+        return dict(self.decisions)
+
+    def _send(self, user_prompt, initial_prompt, temperature, on_chunk, turn_context=None):
+        with tracing.span("classify") as span:
+            intent = self.classifier.classify(user_prompt)
+            span.set(intent=intent)
+        if intent is None or intent in self.heavy_types:
+            tier, client, other = "heavy", self.heavy_client, self.fast_client
+        else:
+            tier, client, other = "fast", self.fast_client, self.heavy_client
+        self.decisions[tier] += 1
+        model_name = getattr(client, "model_name", None)
+        print u"Enrutado: tipo estimado %s -> modelo %s (%d rapido, %d potente)" % (
+            intent, model_name, self.decisions["fast"], self.decisions["heavy"]
+        )
+        with tracing.span("model_" + tier, intent=intent, model=model_name):
+            if on_chunk is not None:
+                response = client.send_message_stream(user_prompt, initial_prompt, temperature, on_chunk, turn_context)
+            else:
+                response = client.send_message(user_prompt, initial_prompt, temperature, turn_context)
+        if not is_error_response(response):
+            # El otro cliente recibe el intercambio para mantener el mismo historial
+            other.add_exchange(user_prompt, response, initial_prompt)
+        return response
+
+
+def main(**args):
+  print "Ok"
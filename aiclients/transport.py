@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: transport
+
+Descripción:
+Capa de transporte HTTP compartida por los clientes de IA.
+Utiliza java.net.HttpURLConnection aprovechando la reutilización de conexiones
+(keep-alive) de la propia JVM, comprime con gzip los cuerpos de las peticiones
+y de las respuestas, aplica timeouts configurables y lee las respuestas en bloque
+con un buffer, en tiempo lineal respecto a su tamaño.
+Las conexiones en curso pueden abortarse desde otro hilo con abort().
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+"""
+
+import jarray
+import threading
+
+from java.net import URL, HttpURLConnection
+from java.io import BufferedReader, InputStreamReader, ByteArrayOutputStream
+from java.lang import String, StringBuilder, System, Thread
+from java.util.zip import GZIPInputStream, GZIPOutputStream
+
+from addons.chatagent_prototype import config
+
+READ_BUFFER_SIZE = 16384
+
+
+class HttpError(Exception):
+    """
+    Error devuelto por el servidor HTTP (código de respuesta distinto de 2xx).
+    Conserva el código y el cuerpo de la respuesta para que el cliente pueda
+    decidir cómo tratarlo.
+    """
+    def __init__(self, code, body):
+        Exception.__init__(self, "Error de la API (Código: %d): %s" % (code, body))
+        self.code = code
+        self.body = body
+
+
+class HttpTransport:
+    """
+    Transporte HTTP para enviar peticiones JSON a un API REST.
+
+    Las conexiones no se cierran con disconnect(): al leer por completo y cerrar el
+    flujo de la respuesta la JVM devuelve el socket a su pool de conexiones keep-alive,
+    y las siguientes peticiones al mismo servidor se ahorran el establecimiento de
+    la conexión TCP y TLS.
+
+    Mientras una petición está en curso su conexión queda registrada junto con
+    el hilo que la ha abierto, de forma que abort() puede cerrar desde otro hilo
+    las conexiones de una petición concreta para cancelarla.
+    """
+
+    def __init__(self, connect_timeout=None, read_timeout=None, gzip_requests=None):
+        """
+        Inicializa el transporte.
+
+        Args:
+            connect_timeout (int, optional): Timeout de conexión en milisegundos.
+                                             Por defecto config.HTTP_CONNECT_TIMEOUT.
+            read_timeout (int, optional): Timeout de lectura en milisegundos.
+                                          Por defecto config.HTTP_READ_TIMEOUT.
+            gzip_requests (bool, optional): Si se comprimen con gzip los cuerpos de las peticiones.
+                                            Por defecto config.HTTP_GZIP_REQUESTS.
+        """
+        if connect_timeout is None:
+            connect_timeout = config.HTTP_CONNECT_TIMEOUT
+        if read_timeout is None:
+            read_timeout = config.HTTP_READ_TIMEOUT
+        if gzip_requests is None:
+            gzip_requests = config.HTTP_GZIP_REQUESTS
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.gzip_requests = gzip_requests
+        self.lock = threading.Lock()
+        self.active_connections = {}  # Conexión en curso -> hilo que la ha abierto
+        self.stream_connections = {}  # Lector devuelto por open_stream -> su conexión
+        # Numero de conexiones keep-alive que la JVM mantiene por servidor.
+        if System.getProperty("http.maxConnections") is None:
+            System.setProperty("http.maxConnections", str(config.HTTP_MAX_CONNECTIONS))
+
+    def post_json(self, url_string, body, headers=None):
+        """
+        Envía una petición POST con un cuerpo JSON y devuelve la respuesta completa.
+
+        Args:
+            url_string (str): La URL de la petición.
+            body (str): El cuerpo JSON de la petición.
+            headers (dict, optional): Cabeceras adicionales de la petición.
+
+        Returns:
+            str: El cuerpo de la respuesta.
+
+        Raises:
+            HttpError: Si el servidor responde con un código de error.
+        """
+        return self.request("POST", url_string, body, headers)
+
+    def request(self, method, url_string, body=None, headers=None):
+        """
+        Envía una petición HTTP y devuelve el cuerpo completo de la respuesta.
+
+        Args:
+            method (str): El método HTTP ("GET", "POST", "PATCH", "DELETE"...).
+            url_string (str): La URL de la petición.
+            body (str, optional): El cuerpo JSON de la petición, si lo tiene.
+            headers (dict, optional): Cabeceras adicionales de la petición.
+
+        Returns:
+            str: El cuerpo de la respuesta.
+
+        Raises:
+            HttpError: Si el servidor responde con un código de error.
+        """
+        conn = self._open(method, url_string, body, headers)
+        try:
+            reader = self._response_reader(conn, conn.getInputStream())
+            try:
+                return read_fully(reader)
+            finally:
+                reader.close()
+        finally:
+            self._release(conn)
+
+    def open_stream(self, url_string, body, headers=None):
+        """
+        Envía una petición POST con un cuerpo JSON y devuelve un lector sobre la
+        respuesta, para consumirla según va llegando (por ejemplo, SSE).
+        El llamante es responsable de cerrar el lector con close_stream.
+
+        Args:
+            url_string (str): La URL de la petición.
+            body (str): El cuerpo JSON de la petición.
+            headers (dict, optional): Cabeceras adicionales de la petición.
+
+        Returns:
+            java.io.BufferedReader: Lector sobre el cuerpo de la respuesta.
+
+        Raises:
+            HttpError: Si el servidor responde con un código de error.
+        """
+        conn = self._open("POST", url_string, body, headers)
+        try:
+            reader = self._response_reader(conn, conn.getInputStream())
+        except:
+            self._release(conn)
+            raise
+        self.lock.acquire()
+        try:
+            self.stream_connections[reader] = conn
+        finally:
+            self.lock.release()
+        return reader
+
+    def close_stream(self, reader):
+        """
+        Cierra un lector obtenido con open_stream y libera su conexión.
+        """
+        self.lock.acquire()
+        try:
+            conn = self.stream_connections.pop(reader, None)
+        finally:
+            self.lock.release()
+        try:
+            reader.close()
+        finally:
+            if conn is not None:
+                self._release(conn)
+
+    def abort(self, thread=None):
+        """
+        Aborta peticiones en curso cerrando sus conexiones. Los hilos que
+        estén esperando o leyendo la respuesta reciben una excepción de E/S.
+        Puede llamarse desde cualquier hilo.
+
+        Args:
+            thread (java.lang.Thread, optional): Solo se cierran las conexiones abiertas
+                                                 por este hilo. Por defecto, todas.
+
+        Returns:
+            int: El número de conexiones cerradas.
+        """
+        self.lock.acquire()
+        try:
+            connections = [conn for conn, owner in self.active_connections.items() if thread is None or owner == thread]
+            for conn in connections:
+                del self.active_connections[conn]
+            for reader, conn in self.stream_connections.items():
+                if conn in connections:
+                    del self.stream_connections[reader]
+        finally:
+            self.lock.release()
+        for conn in connections:
+            conn.disconnect()
+        return len(connections)
+
+    def _open(self, method, url_string, body, headers):
+        """
+        Abre la conexión, envía la petición y comprueba el código de respuesta.
+        Si el servidor rechaza un cuerpo comprimido, se reintenta una vez sin
+        comprimir y se desactiva la compresión de peticiones para este transporte.
+        """
+        try:
+            return self._do_open(method, url_string, body, headers, self.gzip_requests)
+        except HttpError, e:
+            if body is None or not self.gzip_requests or not rejects_compression(e):
+                raise
+            print "Advertencia: el servidor no acepta peticiones comprimidas, se envian sin comprimir."
+            self.gzip_requests = False
+            return self._do_open(method, url_string, body, headers, False)
+
+    def _do_open(self, method, url_string, body, headers, compress):
+        conn = URL(url_string).openConnection()
+        self.lock.acquire()
+        try:
+            self.active_connections[conn] = Thread.currentThread()
+        finally:
+            self.lock.release()
+        try:
+            return self._send_body(conn, method, body, headers, compress)
+        except:
+            self._release(conn)
+            raise
+
+    def _send_body(self, conn, method, body, headers, compress):
+        conn.setConnectTimeout(self.connect_timeout)
+        conn.setReadTimeout(self.read_timeout)
+        conn.setRequestMethod(method)
+        conn.setRequestProperty("Accept-Encoding", "gzip")
+        if headers:
+            for name, value in headers.items():
+                conn.setRequestProperty(name, value)
+        if body is not None:
+            data = String(body).getBytes("UTF-8")
+            if compress:
+                data = gzip_bytes(data)
+                conn.setRequestProperty("Content-Encoding", "gzip")
+            conn.setRequestProperty("Content-Type", "application/json; charset=utf-8")
+            conn.setDoOutput(True)
+            conn.setFixedLengthStreamingMode(len(data))
+            output_stream = conn.getOutputStream()
+            try:
+                output_stream.write(data)
+            finally:
+                output_stream.close()
+
+        response_code = conn.getResponseCode()
+        if response_code < 200 or response_code >= 300:
+            error_stream = conn.getErrorStream()
+            error_response_content = ""
+            if error_stream is not None:
+                reader = self._response_reader(conn, error_stream)
+                try:
+                    error_response_content = read_fully(reader)
+                finally:
+                    reader.close()
+            raise HttpError(response_code, error_response_content)
+        return conn
+
+    def _release(self, conn):
+        self.lock.acquire()
+        try:
+            self.active_connections.pop(conn, None)
+        finally:
+            self.lock.release()
+
+    def _response_reader(self, conn, input_stream):
+        if "gzip" == conn.getContentEncoding():
+            input_stream = GZIPInputStream(input_stream)
+        return BufferedReader(InputStreamReader(input_stream, "UTF-8"), READ_BUFFER_SIZE)
+
+
+def rejects_compression(error):
+    """
+    Indica si un HttpError se debe a que el servidor no acepta el cuerpo
+    comprimido: un 411 o 415, o un 400 cuya respuesta menciona la codificación.
+    Los demás 400 (por ejemplo, una petición mal formada) no se reintentan.
+    """
+    if error.code in (411, 415):
+        return True
+    if error.code != 400:
+        return False
+    body = (error.body or "").lower()
+    for word in ("encoding", "gzip", "compress", "codificaci"):
+        if word in body:
+            return True
+    return False
+
+def iter_sse_events(reader):
+    """
+    Recorre los eventos de una respuesta SSE (Server-Sent Events).
+    Cada evento está formado por una o varias lineas "data: ..." y termina
+    con una linea en blanco; se devuelve el contenido de sus lineas "data".
+
+    Args:
+        reader (java.io.BufferedReader): Lector sobre el cuerpo de la respuesta.
+
+    Returns:
+        generator: Los datos (unicode) de cada evento, según van llegando.
+    """
+    event_data = StringBuilder()
+    line = reader.readLine()
+    while line is not None:
+        if line.startswith("data:"):
+            event_data.append(line[5:].strip())
+        elif line.strip() == "" and event_data.length() > 0:
+            yield event_data.toString()
+            event_data.setLength(0)
+        line = reader.readLine()
+    if event_data.length() > 0:
+        yield event_data.toString()
+
+def gzip_bytes(data):
+    """
+    Comprime con gzip un array de bytes de Java.
+    """
+    buffer = ByteArrayOutputStream(max(len(data) / 4, 64))
+    gzip = GZIPOutputStream(buffer)
+    gzip.write(data)
+    gzip.close()
+    return buffer.toByteArray()
+
+def read_fully(reader):
+    """
+    Lee por completo un java.io.Reader en bloques, conservando los saltos de linea.
+    """
+    content = StringBuilder()
+    buf = jarray.zeros(READ_BUFFER_SIZE, 'c')
+    n = reader.read(buf, 0, READ_BUFFER_SIZE)
+    while n >= 0:
+        content.append(buf, 0, n)
+        n = reader.read(buf, 0, READ_BUFFER_SIZE)
+    return content.toString()
+
+
+def main(**args):
+  print "Ok"
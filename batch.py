@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: batch
+
+Descripción:
+Modo por lotes, sin interfaz de usuario, del asistente.
+Lee preguntas en lenguaje natural de un fichero JSONL, construye una sola vez
+el prompt inicial del modelo de datos (el mismo que usa el panel de chat) y
+envía las preguntas al modelo en paralelo, con un número máximo de preguntas
+simultáneas y de peticiones por minuto. Cada respuesta se pasa a la lógica sin
+interfaz de su procesador (Processor.process_headless) y el resultado, con los
+tiempos de cada fase, se escribe en un fichero JSONL de salida.
+Sirve, por ejemplo, para precalentar la cache de respuestas o para evaluar un
+modelo nuevo con un conjunto de preguntas.
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+
+Formato del fichero de preguntas, una por línea:
+    {"id": "q1", "question": "¿Cuántos municipios hay en la provincia?"}
+"""
+
+import Queue
+import json
+import threading
+import time
+
+import java
+from java.io import StringReader
+from java.util.concurrent import Callable, Executors, ExecutorCompletionService
+from javax.json import Json
+
+from addons.chatagent_prototype import config
+from addons.chatagent_prototype import tracing
+from addons.chatagent_prototype import utils
+from addons.chatagent_prototype.aiclient import is_error_response
+from addons.chatagent_prototype.chatagent import create_aiclient, create_processors, get_intent_classifier
+from addons.chatagent_prototype.gvsigdesktop.utils import getCurrentViewBboxAsWKT
+from addons.chatagent_prototype.processor import build_response_schema
+from addons.chatagent_prototype.prompt import build_initial_prompt, build_turn_context, build_schema_context
+
+
+class RateLimiter:
+    """
+    Limita el número de peticiones por minuto repartiéndolas de forma uniforme.
+    Es seguro usarlo desde varios hilos.
+    """
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Espera hasta que se pueda hacer la siguiente petición.
+
+        Returns:
+            float: Los segundos que se ha esperado.
+        """
+        if not self.interval:
+            return 0
+        self.lock.acquire()
+        try:
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        finally:
+            self.lock.release()
+        wait = start - now
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class BatchRunner:
+    """
+    Ejecuta un fichero de preguntas contra un modelo de datos.
+
+    Al empezar se crea un cliente de IA por cada pregunta que se procesa a la vez,
+    y cada uno se reutiliza para las siguientes preguntas, reiniciando su historial,
+    de forma que las preguntas son independientes entre sí y pueden enviarse a la
+    vez sin compartir el historial de la conversación. Así las conexiones y la
+    cache de contexto de cada cliente se aprovechan en todo el lote.
+    """
+
+    def __init__(self, aiclient_factory, processors, data_model, pool_size=None, requests_per_minute=None, view_bbox=None, intent_classifier=None):
+        """
+        Args:
+            aiclient_factory (callable): Función sin argumentos que devuelve un aiclient.AIClient nuevo.
+                                         Se llama una vez por cada pregunta simultánea.
+            processors (list): Las instancias de Processor a las que se despachan las respuestas.
+            data_model (str): El identificador del modelo de datos.
+            pool_size (int, optional): Preguntas que se procesan a la vez. Por defecto config.BATCH_POOL_SIZE.
+            requests_per_minute (int, optional): Máximo de peticiones por minuto al modelo.
+                                                 Por defecto config.BATCH_REQUESTS_PER_MINUTE.
+            view_bbox (str, optional): Extensión de la vista en WKT que se envía con cada pregunta.
+                                       Por defecto la de la vista actual de gvSIG al empezar.
+            intent_classifier (optional): Clasificador que selecciona las instrucciones de cada
+                                          pregunta con config.PROMPT_SECTIONS_ON_DEMAND.
+                                          Por defecto el de chatagent.get_intent_classifier.
+        """
+        if pool_size is None:
+            pool_size = config.BATCH_POOL_SIZE
+        if requests_per_minute is None:
+            requests_per_minute = config.BATCH_REQUESTS_PER_MINUTE
+        self.aiclient_factory = aiclient_factory
+        self.processors = dict([(processor.get_type(), processor) for processor in processors])
+        self.data_model = data_model
+        self.pool_size = pool_size
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self.view_bbox = view_bbox
+        if intent_classifier is None:
+            intent_classifier = get_intent_classifier(processors)
+        self.intent_classifier = intent_classifier
+        self.response_schema = None
+        if config.STRUCTURED_OUTPUT:
+            self.response_schema = build_response_schema(processors)
+        self.initial_prompt = None
+        self.current_view_bbox = None
+        self.aiclients = None  # Clientes de IA libres (Queue) durante la ejecución
+
+    def run(self, questions_path, output_path):
+        """
+        Procesa todas las preguntas del fichero y escribe los resultados según van terminando.
+
+        Args:
+            questions_path (str): Fichero JSONL de preguntas.
+            output_path (str): Fichero JSONL de resultados; se sobrescribe.
+
+        Returns:
+            dict: Resumen con las claves questions, ok, errors y elapsed_ms.
+        """
+        start = time.time()
+        questions = load_questions(questions_path)
+        with tracing.span("prompt_build") as span:
+            self.initial_prompt = build_initial_prompt(self.processors, self.data_model)
+            span.set(prompt_chars=len(self.initial_prompt or u""))
+        self.current_view_bbox = self.view_bbox
+        if self.current_view_bbox is None:
+            self.current_view_bbox = getCurrentViewBboxAsWKT()
+
+        pool_size = max(1, min(self.pool_size, len(questions)))
+        self.aiclients = Queue.Queue()
+        for n in range(pool_size):
+            aiclient = self.aiclient_factory()
+            if self.response_schema is not None:
+                aiclient.set_response_schema(self.response_schema)
+            self.aiclients.put(aiclient)
+
+        executor = Executors.newFixedThreadPool(pool_size)
+        errors = 0
+        output = open(output_path, "wb")
+        try:
+            completion = ExecutorCompletionService(executor)
+            for index, question in enumerate(questions):
+                completion.submit(QuestionTask(self, index, question))
+            for n in range(len(questions)):
+                record = completion.take().get()
+                if record.get("error"):
+                    errors += 1
+                output.write(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+                output.write("\n")
+                output.flush()
+                print u"Batch: %d/%d preguntas procesadas (%d errores)" % (n + 1, len(questions), errors)
+        finally:
+            executor.shutdownNow()
+            output.close()
+        return {
+            "questions": len(questions),
+            "ok": len(questions) - errors,
+            "errors": errors,
+            "elapsed_ms": int((time.time() - start) * 1000)
+        }
+
+    def run_question(self, index, question):
+        """
+        Envía una pregunta al modelo y procesa la respuesta.
+
+        Returns:
+            dict: El registro de resultado de la pregunta.
+        """
+        start = time.time()
+        record = {
+            "index": index,
+            "id": question.get("id", index),
+            "question": question["question"],
+            "type": None,
+            "response": None,
+            "result": None,
+            "error": None
+        }
+        timings = {}
+        record["timings"] = timings
+        aiclient = self.aiclients.get()
+        try:
+            # Cada pregunta empieza una conversación nueva
+            aiclient.resetHistory()
+            timings["wait_ms"] = int(self.rate_limiter.acquire() * 1000)
+
+            schema_context = build_schema_context(self.data_model, question["question"])[0]
+            turn_context = build_turn_context(self.processors, self.intent_classifier.classify(question["question"]), schema_context, self.current_view_bbox)
+            t = time.time()
+            response = aiclient.send_message(question["question"], self.initial_prompt, None, turn_context)
+            timings["model_ms"] = int((time.time() - t) * 1000)
+            if is_error_response(response):
+                record["error"] = response or u"Respuesta vacía"
+                return record
+
+            t = time.time()
+            s, text = utils.extraer_json(response.strip())
+            if s is None:
+                record["error"] = u"La respuesta no contiene un JSON: %s" % response
+                return record
+            json_reader = Json.createReader(StringReader(s))
+            json_response = json_reader.readObject()
+            json_reader.close()
+            timings["parse_ms"] = int((time.time() - t) * 1000)
+            record["response"] = json.loads(json_response.toString())
+            response_type = json_response.getString("type")
+            record["type"] = response_type
+
+            processor = self.processors.get(response_type)
+            if processor is None:
+                record["error"] = u"Tipo de respuesta desconocido: %s" % response_type
+                return record
+            t = time.time()
+            record["result"] = processor.process_headless(self.data_model, question["question"], json_response)
+            timings["processor_ms"] = int((time.time() - t) * 1000)
+        except Exception, e:
+            record["error"] = unicode(e)
+        except java.lang.Exception, e:
+            record["error"] = unicode(e)
+        finally:
+            self.aiclients.put(aiclient)
+            timings["total_ms"] = int((time.time() - start) * 1000)
+        return record
+
+
+class QuestionTask(Callable):
+    def __init__(self, runner, index, question):
+        self.runner = runner
+        self.index = index
+        self.question = question
+
+    def call(self):
+        return self.runner.run_question(self.index, self.question)
+
+
+def load_questions(questions_path):
+    """
+    Carga las preguntas de un fichero JSONL. Cada línea es un objeto con el
+    campo "question" (y opcionalmente "id") o directamente el texto de la pregunta.
+    """
+    questions = []
+    f = open(questions_path, "rb")
+    try:
+        for line in f:
+            line = line.decode("utf-8").strip()
+            if not line:
+                continue
+            question = json.loads(line)
+            if not isinstance(question, dict):
+                question = {"question": question}
+            questions.append(question)
+    finally:
+        f.close()
+    return questions
+
+def run_batch(questions_path, output_path, data_model, pool_size=None, requests_per_minute=None):
+    """
+    Ejecuta un fichero de preguntas con el cliente de IA y los procesadores de la aplicación.
+    """
+    runner = BatchRunner(create_aiclient, create_processors(), data_model, pool_size, requests_per_minute)
+    summary = runner.run(questions_path, output_path)
+    print u"Batch terminado: %(questions)d preguntas, %(ok)d correctas, %(errors)d errores en %(elapsed_ms)d ms" % summary
+    return summary
+
+
+def main(**args):
+  questions_path = args.get("questions")
+  output_path = args.get("output")
+  data_model = args.get("data_model")
+  if not (questions_path and output_path and data_model):
+    print "Uso: main(questions=<preguntas.jsonl>, output=<resultados.jsonl>, data_model=<id del modelo de datos>)"
+    print "Ok"
+    return
+  run_batch(questions_path, output_path, data_model, args.get("pool_size"), args.get("requests_per_minute"))
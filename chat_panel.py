@@ -9,15 +9,17 @@ import gvsig
 from gvsig.libs.formpanel import FormPanel
 
 import sys
+import time
 
 from javax.swing import JPanel, JButton, JTextArea, JScrollPane, JPopupMenu, JMenuItem
 from javax.swing.text import DefaultEditorKit, SimpleAttributeSet, StyleConstants
-from java.awt import BorderLayout, Dimension, Font
+from java.awt import BorderLayout, Dimension, Font, Color
 from java.awt.event import ActionListener, MouseAdapter
 from java.io import FileInputStream, StringReader
 from javax.json import Json
 from javax.swing import SwingWorker
-from java.lang import StringBuilder, Exception
+from java.lang import StringBuilder, Exception, Runnable, Thread
+from java.util.concurrent import CancellationException, Callable, ExecutionException, FutureTask
 from javax.swing import JTextArea, DefaultComboBoxModel
 from java.awt.event import KeyAdapter, KeyEvent
 from javax.swing.text import StyledEditorKit
@@ -25,22 +27,36 @@ from javax.swing.text import StyledEditorKit
 from java.io import StringReader
 from javax.json import Json
 
-import addons.chatagent_prototype.utils
-import addons.chatagent_prototype.config
+from addons.chatagent_prototype import utils
+from addons.chatagent_prototype import config
+from addons.chatagent_prototype import tracing
+from addons.chatagent_prototype.processor import build_response_schema
+from addons.chatagent_prototype.prompt import build_initial_prompt, build_turn_context, build_schema_context
+from addons.chatagent_prototype.aiclients.routing import KeywordIntentClassifier
 
-from addons.chatagent_prototype.gvsigdesktop.utils import getAvailableDataModels, getDDL, getCurrentViewBboxAsWKT
+from addons.chatagent_prototype.gvsigdesktop.explorerpool import format_pool_stats, close_stale_explorer_pools
+from addons.chatagent_prototype.gvsigdesktop.resultcache import invalidate_results, format_result_cache_stats
+from addons.chatagent_prototype.gvsigdesktop.utils import getAvailableDataModels, showConnectToDatabaseWorkspaceDialog, invalidateDDL, revalidateDDL, checkDataModelConnection
 
 class ChatPanel(FormPanel, ActionListener):
     """
     Panel principal de la aplicación de chat.
     """
-    def __init__(self, aiclient):
+    def __init__(self, aiclient, intent_classifier=None):
         FormPanel.__init__(self, gvsig.getResource(__file__, "chat_panel.xml"))
         self.aiclient = aiclient
+        self.intent_classifier = intent_classifier # Selecciona las secciones del prompt de cada turno
         self.dataModel = None
         
         self.processors = {} # Diccionario para almacenar los procesadores registrados
-        self.is_first_interaction = True # Para controlar si se envía el prompt inicial
+        self.initial_prompt = None # Prompt inicial del modelo de datos actual, se construye en el primer mensaje
+        self.prompt_future = None # Construccion en segundo plano del prompt inicial, lanzada al seleccionar el modelo
+        self.schema_tables = None # Tablas cuyo DDL se envio en el ultimo turno (modelos de datos grandes)
+        self.stream_start = None # Posicion en el historial donde empieza la respuesta en streaming
+        self.pending_worker = None # Peticion en curso, si la hay
+        self.statsMenuItem = None
+        self.refreshSchemaMenuItem = None
+        self.clearResultsMenuItem = None
         
         self._setup_components()
         self._add_context_menus()
@@ -73,11 +89,16 @@ class ChatPanel(FormPanel, ActionListener):
 
         if self.sendButton:
             self.sendButton.addActionListener(self) # Listener para el botón de enviar
+            self.sendButtonText = self.sendButton.getText()
 
     def updateDataModels(self, *args):
       model = DefaultComboBoxModel()
-      for dataModel in getAvailableDataModels():
+      dataModels = getAvailableDataModels()
+      for dataModel in dataModels:
           model.addElement(dataModel)
+      # Las conexiones abiertas con espacios de trabajo desconectados o
+      # reconectados con otros parametros ya no sirven
+      close_stale_explorer_pools([dataModel.getValue() for dataModel in dataModels])
       self.cboModelo.setModel(model)
       self.cboModelo.setSelectedIndex(-1)
 
@@ -90,9 +111,15 @@ class ChatPanel(FormPanel, ActionListener):
       if self.dataModel == dataModel:
           return
       self.dataModel = dataModel
+      self._cancel_pending_request()
       self.aiclient.resetHistory()
-      self.is_first_interaction = True
+      self.initial_prompt = None
+      self.schema_tables = None
       self.chatHistoryTextArea.setText("")
+      if dataModel:
+          # El esquema ha podido cambiar desde que se uso por ultima vez
+          revalidateDDL(dataModel)
+      self._start_prewarm()
       
     def getDataModel(self):
       return self.dataModel
@@ -110,6 +137,15 @@ class ChatPanel(FormPanel, ActionListener):
             copy_item = JMenuItem("Copiar")
             copy_item.addActionListener(DefaultEditorKit.CopyAction())
             history_popup.add(copy_item)
+            self.statsMenuItem = JMenuItem(u"Estadísticas")
+            self.statsMenuItem.addActionListener(self)
+            history_popup.add(self.statsMenuItem)
+            self.refreshSchemaMenuItem = JMenuItem("Actualizar estructura del modelo")
+            self.refreshSchemaMenuItem.addActionListener(self)
+            history_popup.add(self.refreshSchemaMenuItem)
+            self.clearResultsMenuItem = JMenuItem("Descartar resultados guardados")
+            self.clearResultsMenuItem.addActionListener(self)
+            history_popup.add(self.clearResultsMenuItem)
             self.chatHistoryTextArea.setComponentPopupMenu(history_popup)
 
         # Menú contextual para la entrada del usuario (cortar, copiar, pegar)
@@ -136,6 +172,10 @@ class ChatPanel(FormPanel, ActionListener):
         """
         self.processors[processor.get_type()] = processor
         print "Procesador registrado: %s" % processor.get_type()
+        if config.STRUCTURED_OUTPUT:
+            # Se pide al modelo que responda con un JSON que cumpla el esquema
+            # de alguno de los procesadores registrados.
+            self.aiclient.set_response_schema(build_response_schema(self.processors.values()))
 
     def append_message(self, sender, message, *components):
         text = "[%s]: %s\n" % (sender, message)
@@ -148,85 +188,266 @@ class ChatPanel(FormPanel, ActionListener):
         # Desplazar al final
         self.chatHistoryTextArea.setCaretPosition(self.chatHistoryTextArea.getDocument().getLength())
 
+    def append_stream_chunk(self, text):
+        """
+        Añade al historial un fragmento de la respuesta que se está recibiendo en streaming.
+        El texto se muestra atenuado y es provisional: se elimina con end_stream
+        cuando la respuesta completa se procesa.
+        """
+        doc = self.chatHistoryTextArea.getDocument()
+        attrs = SimpleAttributeSet()
+        StyleConstants.setForeground(attrs, Color.GRAY)
+        if self.stream_start is None:
+            self.stream_start = doc.getLength()
+            doc.insertString(doc.getLength(), "[%s]: " % self.getAgentName(), attrs)
+        doc.insertString(doc.getLength(), text, attrs)
+        self.chatHistoryTextArea.setCaretPosition(doc.getLength())
+
+    def end_stream(self):
+        """
+        Elimina del historial el texto provisional mostrado durante el streaming.
+        """
+        if self.stream_start is None:
+            return
+        doc = self.chatHistoryTextArea.getDocument()
+        doc.remove(self.stream_start, doc.getLength() - self.stream_start)
+        self.stream_start = None
+
     def getAgentName(self):
         return "Sistema"
 
-    def _build_initial_prompt_string(self):
-        if not self.dataModel or not self.is_first_interaction:
+    def show_stats(self):
+        """
+        Muestra en el historial los tiempos por etapa (p50/p95) de los últimos turnos
+        y el uso de los pools de conexiones con la base de datos y de la cache
+        de resultados de las SQL.
+        """
+        self.append_message(self.getAgentName(), u"Tiempos por etapa de los últimos turnos:\n%s" % tracing.get_tracer().format_stats())
+        self.append_message(self.getAgentName(), u"Conexiones con la base de datos:\n%s" % format_pool_stats())
+        self.append_message(self.getAgentName(), u"Cache de resultados: %s" % format_result_cache_stats())
+
+    def refresh_schema(self):
+        """
+        Descarta el DDL y los resultados guardados del modelo de datos actual. La conversación
+        empieza de nuevo para que el modelo reciba la estructura actualizada.
+        """
+        if not self.dataModel:
+            return
+        invalidateDDL(self.dataModel)
+        invalidate_results(self.dataModel)
+        self._cancel_pending_request()
+        self.aiclient.resetHistory()
+        self.initial_prompt = None
+        self.schema_tables = None
+        self._start_prewarm()
+        self.append_message(self.getAgentName(), u"La estructura del modelo se leerá de nuevo en el siguiente mensaje.")
+
+    def clear_results(self):
+        """
+        Descarta los resultados guardados de las SQL del modelo de datos actual,
+        para que las tablas y gráficos que se abran de nuevo lean los datos actuales.
+        """
+        if not self.dataModel:
+            return
+        invalidate_results(self.dataModel)
+        self.append_message(self.getAgentName(), u"Las consultas se lanzarán de nuevo contra la base de datos.")
+
+    def _start_prewarm(self):
+        """
+        Empieza a preparar en segundo plano la conversación con el modelo de datos
+        actual: construye el prompt inicial, comprueba la conexión con la base de
+        datos y prepara el cliente de IA (AIClient.prewarm). El primer mensaje
+        espera a que el prompt esté construido en lugar de construirlo de nuevo.
+        """
+        if self.prompt_future is not None:
+            # El resultado de una preparación anterior ya no sirve; se deja terminar y se descarta
+            self.prompt_future.cancel(False)
+            self.prompt_future = None
+        if not config.PREWARM_ON_SELECT or not self.dataModel:
+            return
+        self.prompt_future = FutureTask(InitialPromptTask(self, self.dataModel))
+        thread = Thread(PrewarmTask(self.prompt_future, self.aiclient, self.dataModel), "chatagent-prewarm")
+        thread.setDaemon(True)
+        thread.start()
+
+    def get_initial_prompt(self):
+        """
+        Devuelve el prompt inicial del modelo de datos actual, construyéndolo la
+        primera vez. Se pasa en cada mensaje; el cliente de IA solo lo usa cuando
+        su historial está vacío, así que una primera petición cancelada no deja
+        la conversación sin contexto.
+        """
+        if self.initial_prompt is None:
+            prompt_future = self.prompt_future
+            if prompt_future is not None and not prompt_future.isCancelled():
+                try:
+                    self.initial_prompt = prompt_future.get()
+                except ExecutionException, e:
+                    print u"Advertencia: no se ha podido preparar el prompt inicial en segundo plano. %s" % e.getCause()
+        if self.initial_prompt is None:
+            with tracing.span("prompt_build") as span:
+                self.initial_prompt = self._build_initial_prompt_string()
+                span.set(prompt_chars=len(self.initial_prompt or u""))
+        return self.initial_prompt
+
+    def get_turn_context(self, user_input):
+        """
+        Devuelve lo que se envía solo en este turno: la extensión de la vista
+        actual, las instrucciones detalladas del procesador que se estima que
+        atenderá la petición y, en modelos de datos grandes, el DDL de las
+        tablas relacionadas con ella.
+        """
+        processor_type = None
+        if config.PROMPT_SECTIONS_ON_DEMAND:
+            if self.intent_classifier is None:
+                self.intent_classifier = KeywordIntentClassifier(self.processors.values())
+            processor_type = self.intent_classifier.classify(user_input)
+        schema_context, tables = build_schema_context(self.dataModel, user_input, self.schema_tables)
+        if tables:
+            self.schema_tables = tables
+        return build_turn_context(self.processors, processor_type, schema_context)
+
+    def _build_initial_prompt_string(self, dataModel=None):
+        if dataModel is None:
+            dataModel = self.dataModel
+        full_prompt_text = build_initial_prompt(self.processors, dataModel)
+        if full_prompt_text is None:
             return None
-        supported_query_types = StringBuilder()
-        detailed_query_descriptions = StringBuilder()
-        for processor_type in sorted(self.processors.keys()): # Ordenar para una salida consistente
-            processor = self.processors[processor_type]
-            supported_query_types.append("- %s: %s\n" % (processor.get_type(), processor.get_description()))
-            detailed_query_descriptions.append(processor.get_initial_prompt_info())
-        ddl_info = getDDL(self.dataModel)
-        viewbbox = getCurrentViewBboxAsWKT()
-        full_prompt_text = config.BASE_INITIAL_PROMPT.replace("{supported_query_types}", supported_query_types.toString())
-        full_prompt_text = full_prompt_text.replace("{ddl_info}", ddl_info)
-        full_prompt_text = full_prompt_text.replace("{current_view_bbox}", viewbbox)
-        full_prompt_text = full_prompt_text.replace("{detailed_query_descriptions}", detailed_query_descriptions.toString())
 
         print full_prompt_text
         
-        self.is_first_interaction = False
         return full_prompt_text
 
     def actionPerformed(self, event):
         """
         Maneja los eventos de acción (e.g., clic en el botón Enviar).
         """
-        if event.getSource() == self.sendButton or event.getSource() == self.userInputTextArea:
+        if event.getSource() == self.statsMenuItem:
+            self.show_stats()
+        elif event.getSource() == self.refreshSchemaMenuItem:
+            self.refresh_schema()
+        elif event.getSource() == self.clearResultsMenuItem:
+            self.clear_results()
+        elif event.getSource() == self.sendButton and self.pending_worker is not None:
+            # Mientras hay una petición en curso el botón de enviar es el de detener
+            self._stop_request()
+        elif event.getSource() == self.sendButton or event.getSource() == self.userInputTextArea:
             self._send_message()
 
     def _send_message(self):
         """
         Envía el mensaje del usuario a Gemini y procesa la respuesta.
         Compondrá el prompt completo (inicial + histórico + usuario) antes de enviarlo.
+        Si hay una petición en curso se cancela: el nuevo mensaje la sustituye.
         """
         user_input = self.userInputTextArea.getText().strip()
         if not user_input:
             return
 
+        if self._cancel_pending_request():
+            self.append_message(self.getAgentName(), u"Petición anterior cancelada.")
         self.append_message("Usuario", user_input)
         self.userInputTextArea.setText("") # Limpiar el área de entrada
-        self.sendButton.setEnabled(False) # Deshabilitar el botón mientras se procesa
-        self.userInputTextArea.setEnabled(False) # Deshabilitar el área de texto
 
         # Usar SwingWorker para la llamada a la API
-        worker = GeminiApiWorker(user_input, self.is_first_interaction, self.processors, self)
+        tracing.get_tracer().new_turn()
+        worker = GeminiApiWorker(user_input, self.processors, self)
+        self._set_pending_worker(worker)
         worker.execute()
+
+    def _stop_request(self):
+        """
+        Cancela la petición en curso a petición del usuario.
+        """
+        if self._cancel_pending_request():
+            self.append_message(self.getAgentName(), u"Petición cancelada.")
+        self.userInputTextArea.requestFocusInWindow()
+
+    def _cancel_pending_request(self):
+        """
+        Cancela la petición en curso, si la hay, cerrando su conexión.
+
+        Returns:
+            bool: True si había una petición en curso.
+        """
+        worker = self.pending_worker
+        if worker is None:
+            return False
+        worker.cancel_request()
+        self.end_stream()
+        self._set_pending_worker(None)
+        return True
+
+    def _set_pending_worker(self, worker):
+        self.pending_worker = worker
+        if worker is None:
+            self.sendButton.setText(self.sendButtonText)
+        else:
+            self.sendButton.setText(u"Detener")
+
+    def request_finished(self, worker):
+        """
+        Llamado por el worker al terminar. Una petición cancelada o sustituida ya
+        no es la pendiente y no cambia el estado del panel.
+        """
+        if self.pending_worker is worker:
+            self._set_pending_worker(None)
+            self.userInputTextArea.requestFocusInWindow() # Darle el foco
         
 class GeminiApiWorker(SwingWorker):
-    def __init__(self, user_input, is_first_interaction, processors, chat_panel):
+    def __init__(self, user_input, processors, chat_panel):
         self.user_input = user_input
-        self.is_first_interaction = is_first_interaction
         self.processors = processors
         self.chat_panel = chat_panel
         self.aiclient = chat_panel.aiclient
+        self.turn = tracing.get_tracer().turn
+        self.start = time.time()
+        self.request = None
+        self.cancelled = False
+        self.finished = False # done ya se ha ejecutado
         self.response_json = None
+        self.response_text = None
         self.exception = None
 
+    def cancel_request(self):
+        """
+        Cancela la petición al modelo. Se llama desde el hilo de eventos de Swing.
+        """
+        self.cancelled = True
+        request = self.request
+        if request is not None:
+            request.cancel(True)
+
     def doInBackground(self):
         try:
-            # Construir el prompt inicial si es la primera interacción
-            initial_prompt_text = ""
-            if self.is_first_interaction:
-                initial_prompt_text = self.chat_panel._build_initial_prompt_string()
-            s = utils.send_message(self.aiclient,self.user_input,initial_prompt_text)
-            # Después de la primera interacción, no se vuelve a enviar el prompt inicial completo
-            self.is_first_interaction = False
-            s = s.strip()
-            s, text = utils.extraer_json_de_markdown(s)
-            if text:
-               self.chat_panel.append_message(self.chat_panel.getAgentName(), text)
-            print u"DEBUG: respuesta: %s\n " % s
-            
-            # Parsear la respuesta JSON
-            json_reader = Json.createReader(StringReader(s))
-            self.response_json = json_reader.readObject()
-            json_reader.close()
-
+            initial_prompt_text = self.chat_panel.get_initial_prompt()
+            turn_context = self.chat_panel.get_turn_context(self.user_input)
+            if self.cancelled:
+                return None
+            on_chunk = None
+            if config.GEMINI_STREAMING:
+                on_chunk = self._on_chunk
+            self.request = utils.send_message_async(self.aiclient,self.user_input,initial_prompt_text,on_chunk,turn_context)
+            if self.cancelled:
+                # Cancelada mientras se lanzaba la petición
+                self.request.cancel(True)
+                return None
+            s = self.request.get()
+            with tracing.span("parse", turn=self.turn, response_chars=len(s)):
+                s = s.strip()
+                s, text = utils.extraer_json(s)
+                if text:
+                   # Se muestra en done, una vez retirado el texto provisional del streaming
+                   self.response_text = text
+                print u"DEBUG: respuesta: %s\n " % s
+
+                # Parsear la respuesta JSON
+                json_reader = Json.createReader(StringReader(s))
+                self.response_json = json_reader.readObject()
+                json_reader.close()
+
+        except CancellationException:
+            self.cancelled = True
         except Exception as e:
             self.exception = e
             print "Error en doInBackground (GeminiApiWorker): %s" % e
@@ -234,8 +455,27 @@ class GeminiApiWorker(SwingWorker):
             traceback.print_exc(file=sys.stdout)
         return None
 
+    def _on_chunk(self, text):
+        # Se llama desde el hilo de fondo; publish lo hace llegar a process en el EDT
+        self.publish(text)
+
+    def process(self, chunks):
+        # SwingWorker agrupa las llamadas a process con un temporizador, y pueden
+        # llegar despues de done; entonces el texto provisional ya se ha retirado
+        if self.cancelled or self.finished:
+            return
+        self.chat_panel.append_stream_chunk(u"".join(chunks))
+
     def done(self):
+        self.finished = True
+        if self.cancelled:
+            # El panel ya ha retirado el texto provisional y avisado al usuario
+            self.chat_panel.request_finished(self)
+            return
+        self.chat_panel.end_stream()
         try:
+            if self.response_text:
+                self.chat_panel.append_message(self.chat_panel.getAgentName(), self.response_text)
             if self.exception:
                 self.chat_panel.append_message(self.chat_panel.getAgentName(),
                                                u"Error al comunicarse con Gemini: %s" % self.exception.getMessage())
@@ -243,7 +483,8 @@ class GeminiApiWorker(SwingWorker):
                 response_type = self.response_json.getString("type")
                 processor = self.chat_panel.processors.get(response_type)
                 if processor:
-                    processor.process_response(self.chat_panel, self.user_input, self.response_json)
+                    with tracing.span("processor", turn=self.turn, type=response_type):
+                        processor.process_response(self.chat_panel, self.user_input, self.response_json)
                 else:
                     self.chat_panel.append_message(self.chat_panel.getAgentName(),
                                                    u"Tipo de respuesta desconocido: %s" % response_type)
@@ -257,9 +498,57 @@ class GeminiApiWorker(SwingWorker):
             import traceback
             traceback.print_exc(file=sys.stdout)
         finally:
-            self.chat_panel.sendButton.setEnabled(True) # Habilitar el botón
-            self.chat_panel.userInputTextArea.setEnabled(True) # Habilitar el área de texto
-            self.chat_panel.userInputTextArea.requestFocusInWindow() # Darle el foco
+            tracing.record("turn", int((time.time() - self.start) * 1000), turn=self.turn,
+                           error=self.exception is not None)
+            self.chat_panel.request_finished(self)
+
+
+class InitialPromptTask(Callable):
+    """
+    Construye el prompt inicial de un modelo de datos (ver ChatPanel._start_prewarm).
+    """
+    def __init__(self, chat_panel, dataModel):
+        self.chat_panel = chat_panel
+        self.dataModel = dataModel
+
+    def call(self):
+        with tracing.span("prompt_build", prewarm=True) as span:
+            initial_prompt = self.chat_panel._build_initial_prompt_string(self.dataModel)
+            span.set(prompt_chars=len(initial_prompt or u""))
+        return initial_prompt
+
+
+class PrewarmTask(Runnable):
+    """
+    Preparación en segundo plano de un modelo de datos: primero el prompt
+    inicial, del que depende el primer mensaje, y después la conexión con la
+    base de datos y el cliente de IA.
+    """
+    def __init__(self, prompt_future, aiclient, dataModel):
+        self.prompt_future = prompt_future
+        self.aiclient = aiclient
+        self.dataModel = dataModel
+
+    def run(self):
+        self.prompt_future.run()
+        if self.prompt_future.isCancelled():
+            return
+        try:
+            initial_prompt = self.prompt_future.get()
+        except ExecutionException, e:
+            return
+        with tracing.span("prewarm", data_model=self.dataModel) as span:
+            try:
+                checkDataModelConnection(self.dataModel)
+                span.set(connection=True)
+            except:
+                span.set(connection=False)
+                print u"Advertencia: no se ha podido comprobar la conexión con el modelo de datos '%s'. %s" % (self.dataModel, sys.exc_info()[1])
+            if initial_prompt and not self.prompt_future.isCancelled():
+                try:
+                    self.aiclient.prewarm(initial_prompt)
+                except:
+                    print u"Advertencia: no se ha podido preparar el cliente de IA. %s" % sys.exc_info()[1]
 
 
 def configurar_shiftenter(textarea, funcion):
@@ -6,7 +6,12 @@ Lanza la interfaz de usuario del chat y registra los procesadores de respuesta.
 
 from addons.chatagent_prototype.gvsigdesktop.utils import showPanel
 
+from addons.chatagent_prototype import config
 from addons.chatagent_prototype.aiclients.gemini import GeminiClient
+from addons.chatagent_prototype.aiclients.openai_compat import OpenAICompatibleClient
+from addons.chatagent_prototype.aiclients.cached import CachedAIClient
+from addons.chatagent_prototype.aiclients.replay import RecordingAIClient, ReplayAIClient
+from addons.chatagent_prototype.aiclients.routing import RoutingAIClient, KeywordIntentClassifier, ModelIntentClassifier
 
 from addons.chatagent_prototype.chat_panel import ChatPanel
 from addons.chatagent_prototype.processors.text_processor import TextProcessor
@@ -35,17 +40,69 @@ Otros processors a implementar:
 
 """
 
+def create_aiclient(processors=None):
+    """
+    Crea el cliente de IA que usará el chat según la configuración.
+
+    Args:
+        processors (list, optional): Los procesadores registrados, que usa el
+                                     enrutado de peticiones. Por defecto los de create_processors.
+    """
+    if config.AICLIENT_MODE == "replay":
+        return ReplayAIClient(config.TRANSCRIPT_FILE, realtime=config.REPLAY_REALTIME)
+    if config.AI_BACKEND == "openai":
+        aiclient = OpenAICompatibleClient()
+    elif config.ROUTING_ENABLED:
+        if processors is None:
+            processors = create_processors()
+        aiclient = RoutingAIClient(GeminiClient(model_name=config.GEMINI_FAST_MODEL), GeminiClient(),
+                                   get_intent_classifier(processors))
+    else:
+        aiclient = GeminiClient()
+    if config.RESPONSE_CACHE_ENABLED:
+        aiclient = CachedAIClient(aiclient)
+    if config.AICLIENT_MODE == "record":
+        # La grabadora envuelve a la cache para que las respuestas cacheadas
+        # también queden en la transcripción y esta no tenga huecos.
+        aiclient = RecordingAIClient(aiclient, config.TRANSCRIPT_FILE)
+    return aiclient
+
+_intent_classifiers = {}
+
+def get_intent_classifier(processors):
+    """
+    Devuelve el clasificador de peticiones configurado (config.ROUTING_CLASSIFIER)
+    para los procesadores indicados. Se crea uno por lista de procesadores, de
+    forma que el enrutado y la selección de secciones del prompt comparten el
+    mismo y, con el clasificador "model", una misma petición se clasifica una sola vez.
+    """
+    key = tuple(sorted([processor.get_type() for processor in processors]))
+    classifier = _intent_classifiers.get(key)
+    if classifier is None:
+        if config.ROUTING_CLASSIFIER == "model":
+            classifier = ModelIntentClassifier(lambda: GeminiClient(temperature=0.0, model_name=config.GEMINI_FAST_MODEL),
+                                               processors)
+        else:
+            classifier = KeywordIntentClassifier(processors)
+        _intent_classifiers[key] = classifier
+    return classifier
+
+def create_processors():
+    """
+    Crea los procesadores de respuesta disponibles.
+    """
+    return [TextProcessor(), SqlProcessor(), ChartProcessor(), PlantUMLProcessor()]
+
 def main(**args):
     """
     Función principal que inicializa y lanza la aplicación de chat.
     """
-    chat_panel = ChatPanel(GeminiClient())
+    processors = create_processors()
+    chat_panel = ChatPanel(create_aiclient(processors), get_intent_classifier(processors))
 
     # Registrar los procesadores de respuesta
-    chat_panel.register_processor(TextProcessor())
-    chat_panel.register_processor(SqlProcessor())
-    chat_panel.register_processor(ChartProcessor())
-    chat_panel.register_processor(PlantUMLProcessor())
+    for processor in processors:
+        chat_panel.register_processor(processor)
 
     # Mostrar el panel de chat en una ventana
     showPanel(chat_panel, "[\u26A0\uFE0F PRUEBA CONCEPTUAL] Chat con el asistente virtual")
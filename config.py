@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import os
+
 from addons.chatagent_prototype.gvsigdesktop.utils import getProperty
 
 # API Key para acceder al servicio de Gemini.
@@ -12,6 +14,229 @@ if API_KEY == None:
 #GEMINI_MODEL = u"gemini-2.5-flash-preview-05-20"
 GEMINI_MODEL = u"gemini-2.5-pro-preview-05-06"
 
+# Enrutado de peticiones en dos niveles (aiclients.routing).
+# Si es True, antes de llamar al modelo se clasifica la peticion por el tipo de
+# procesador que la atendera. Las de los tipos de ROUTING_HEAVY_TYPES (o las que
+# no se pueden clasificar) van a GEMINI_MODEL; el resto, por ejemplo un saludo o
+# una respuesta de texto, las responde el modelo rapido GEMINI_FAST_MODEL.
+ROUTING_ENABLED = True
+GEMINI_FAST_MODEL = u"gemini-2.5-flash-preview-05-20"
+ROUTING_HEAVY_TYPES = ["sql", "chart", "plantuml"]
+# Clasificador de la peticion:
+# - "keywords": local, por las palabras clave de cada procesador; no hace llamadas.
+# - "model": pregunta el tipo al modelo rapido, sin historial y con un prompt corto.
+ROUTING_CLASSIFIER = "keywords"
+
+# Secciones del prompt bajo demanda.
+# Si es True el prompt inicial solo lleva la lista corta de tipos de consulta
+# (get_description de cada procesador). Las instrucciones detalladas de un
+# procesador (get_initial_prompt_info) se envian solo en el turno en que el
+# clasificador de la peticion lo selecciona, y no se guardan en el historial.
+# Si la peticion no se puede clasificar se envian las de todos los procesadores.
+PROMPT_SECTIONS_ON_DEMAND = True
+
+# Backend del cliente de IA:
+# - "gemini": API de Gemini de Google.
+# - "openai": servidor compatible con el API chat-completions de OpenAI
+#   (servidor de llama.cpp, vLLM, Ollama...), por ejemplo un modelo local.
+AI_BACKEND = getProperty("chatagent_backend")
+if AI_BACKEND == None:
+  AI_BACKEND = "gemini"
+
+# Configuracion del backend "openai".
+# URL base del API, sin "/chat/completions".
+OPENAI_BASE_URL = getProperty("chatagent_openai_base_url")
+if OPENAI_BASE_URL == None:
+  OPENAI_BASE_URL = u"http://localhost:8080/v1"
+OPENAI_MODEL = getProperty("chatagent_openai_model")
+if OPENAI_MODEL == None:
+  OPENAI_MODEL = u"local-model"
+# Clave del API; los servidores locales no suelen necesitarla.
+OPENAI_API_KEY = getProperty("chatagent_openai_api_key")
+# Comprimir con gzip los cuerpos de las peticiones. El servidor de llama.cpp, vLLM
+# y Ollama no aceptan peticiones comprimidas (responden 500 o 422), asi que por
+# defecto no se comprimen aunque HTTP_GZIP_REQUESTS sea True.
+OPENAI_GZIP_REQUESTS = False
+
+# URL base del API de Gemini.
+# Puede sobrescribirse con la propiedad "chatagent_gemini_api_base_url" para
+# apuntar a un servidor local de pruebas que simule el API.
+GEMINI_API_BASE_URL = getProperty("chatagent_gemini_api_base_url")
+if GEMINI_API_BASE_URL == None:
+  GEMINI_API_BASE_URL = u"https://generativelanguage.googleapis.com/v1beta"
+
+# Si es True las respuestas se piden en streaming (streamGenerateContent)
+# y el panel de chat las va mostrando segun llegan.
+GEMINI_STREAMING = True
+
+# Presupuesto de tokens (estimados localmente) del historial de la conversacion
+# por modelo. Al superarse se eliminan el codigo y los diagramas de las respuestas
+# antiguas y, si no basta, se descartan los turnos mas antiguos. El prompt inicial
+# con el DDL se conserva siempre.
+HISTORY_TOKEN_BUDGETS = {
+  u"gemini-2.5-pro-preview-05-06": 200000,
+  u"gemini-2.5-flash-preview-05-20": 200000,
+  u"gemini-2.0-flash": 100000,
+}
+HISTORY_DEFAULT_TOKEN_BUDGET = 100000
+# Numero de respuestas del modelo mas recientes que se conservan completas.
+HISTORY_KEEP_FULL_REPLIES = 1
+
+# Cache de contexto en el servidor (API cachedContents de Gemini).
+# Si es True el prompt inicial (prompt base, secciones de los procesadores y DDL)
+# se sube una sola vez y en los siguientes turnos se referencia por su nombre.
+# Gemini exige un minimo de tokens para cachear; si no se alcanza se envia el prompt completo.
+GEMINI_CONTEXT_CACHE = False
+# Tiempo de vida en segundos de la cache de contexto. Antes de expirar se renueva.
+GEMINI_CONTEXT_CACHE_TTL = 3600
+# Segundos que se espera antes de volver a intentar crear una cache de contexto
+# que el servidor ha rechazado (por ejemplo, por no alcanzar el minimo de tokens).
+GEMINI_CONTEXT_CACHE_RETRY = 600
+
+# Carpeta donde se guardan las caches persistentes del asistente.
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".gvsig-chatagent")
+
+# Cache persistente en disco de las respuestas del modelo.
+# Una pregunta repetida sobre el mismo modelo de datos (mismo prompt inicial)
+# y en el mismo punto de la conversacion se responde desde la cache.
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_DIR = os.path.join(CACHE_DIR, "responses")
+# Tamaño maximo en bytes; al superarse se eliminan las entradas usadas hace mas tiempo.
+RESPONSE_CACHE_MAX_BYTES = 50 * 1024 * 1024
+
+# Cache en memoria y en disco del DDL de cada modelo de datos.
+# Cada vez que se selecciona el modelo de datos se comprueba si han cambiado las
+# tablas, su estructura o el numero de filas de los diccionarios, y si es asi se
+# genera de nuevo; durante la sesion se reutiliza el de memoria. Para otros cambios,
+# o para cambios hechos mientras se usa el modelo, esta la accion "Actualizar
+# estructura del modelo".
+DDL_CACHE_ENABLED = True
+DDL_CACHE_DIR = os.path.join(CACHE_DIR, "ddl")
+# Hilos con los que se lee la estructura de las tablas y los valores de los
+# diccionarios al generar el DDL (en bases de datos remotas domina la latencia).
+DDL_POOL_SIZE = 4
+# Formato del DDL en el prompt (ver gvsigdesktop/ddlformat.py):
+# - "sql": sentencias CREATE TABLE con sus claves ajenas.
+# - "compact": una linea por tabla con columnas tipadas, PK y claves ajenas; ocupa menos tokens.
+# prompt.measure_ddl_formats compara los tokens de cada formato para un modelo de datos.
+DDL_FORMAT = "sql"
+
+# Seleccion de tablas por pregunta. En modelos con al menos SCHEMA_PRUNING_MIN_TABLES
+# tablas el prompt inicial solo lleva la lista de tablas, y cada peticion incluye el
+# DDL de las SCHEMA_PRUNING_TOP_K tablas mas relacionadas con ella (indice BM25 de
+# nombres, etiquetas y descripciones) mas las que alcanzan por sus claves ajenas.
+SCHEMA_PRUNING_ENABLED = True
+SCHEMA_PRUNING_MIN_TABLES = 50
+SCHEMA_PRUNING_TOP_K = 8
+
+# Diccionarios de lista cerrada grandes. Los que tienen mas de DICTIONARY_SAMPLE_SIZE
+# valores se incluyen en el DDL con una muestra de ese tamaño, y en cada peticion se
+# envian los valores (como mucho DICTIONARY_MATCH_MAX) cuya etiqueta se parece a algun
+# termino de la peticion con una similitud de al menos DICTIONARY_MATCH_MIN_SCORE (0 a 1).
+DICTIONARY_SAMPLE_SIZE = 30
+DICTIONARY_MATCH_MAX = 10
+DICTIONARY_MATCH_MIN_SCORE = 0.6
+
+# Al seleccionar un modelo de datos se prepara en segundo plano el prompt inicial
+# (DDL incluido), se comprueba la conexion con la base de datos y, si esta activa
+# GEMINI_CONTEXT_CACHE, se crea la cache de contexto; el primer mensaje solo espera
+# a que el prompt este construido.
+PREWARM_ON_SELECT = True
+
+# Pool de exploradores del servidor (conexiones con la base de datos) por modelo de datos,
+# compartido por las SQL de los procesadores y por getDDL.
+# Exploradores que se mantienen abiertos y maximo de abiertos a la vez.
+EXPLORER_POOL_MIN_SIZE = 1
+EXPLORER_POOL_MAX_SIZE = 4
+# Segundos ocioso tras los que se cierra un explorador que excede el minimo.
+EXPLORER_POOL_IDLE_TIMEOUT = 300
+# Segundos maximos de espera por un explorador libre cuando todos estan en uso.
+EXPLORER_POOL_BORROW_TIMEOUT = 30
+# Segundos ocioso a partir de los que se comprueba la conexion (SELECT 1) antes de usarla.
+EXPLORER_POOL_VALIDATE_AFTER = 60
+
+# Tabla de resultados de las SQL. Las filas se leen por paginas de RESULTSET_PAGE_SIZE
+# filas segun se desplaza la tabla, volviendo a lanzar la consulta con LIMIT/OFFSET,
+# y solo se conservan en memoria RESULTSET_MAX_PAGES paginas. El numero total de
+# filas se cuenta en segundo plano. RESULTSET_PAGE_THREADS hilos leen las paginas.
+# Una pagina que no se ha podido leer se vuelve a pedir pasados RESULTSET_PAGE_RETRY
+# segundos, el doble tras cada nuevo fallo.
+RESULTSET_PAGE_SIZE = 200
+RESULTSET_MAX_PAGES = 5
+RESULTSET_PAGE_THREADS = 2
+RESULTSET_PAGE_RETRY = 5
+
+# Cache de los resultados de las SQL de los procesadores de tablas y graficos, por
+# modelo de datos y SQL. Repetir una consulta (boton de la barra de herramientas, la
+# tabla y el grafico de una misma pregunta) antes de RESULT_CACHE_TTL segundos no la
+# vuelve a lanzar, y las consultas identicas que estan en curso a la vez se lanzan una
+# sola vez. Solo se guardan los resultados de hasta RESULT_CACHE_MAX_ROWS filas; si se
+# superan RESULT_CACHE_MAX_MB o RESULT_CACHE_MAX_ENTRIES se descartan los usados hace
+# mas tiempo. La tabla de resultados lee como mucho RESULTSET_PAGE_SIZE filas: si hay
+# mas, no se guardan y las filas se leen por paginas.
+RESULT_CACHE_ENABLED = True
+RESULT_CACHE_TTL = 300
+RESULT_CACHE_MAX_ROWS = 10000
+RESULT_CACHE_MAX_MB = 64
+RESULT_CACHE_MAX_ENTRIES = 100
+
+# Limites de las SQL: tiempo maximo de ejecucion en segundos y numero maximo de filas
+# que devuelve el driver (0 para no limitarlos). Al superar el tiempo la consulta se
+# cancela en la base de datos. SQL_LIMITS los fija para cada modelo de datos, por
+# ejemplo {"catastro": {"timeout": 120, "max_rows": 50000}}.
+SQL_TIMEOUT = 60
+SQL_MAX_ROWS = 100000
+SQL_LIMITS = {}
+# Filas que el driver lee del servidor en cada bloque al recorrer un resultado
+# (0 para usar el valor del driver). En PostgreSQL las consultas se lanzan fuera
+# del modo autocommit para que el driver no cargue todo el resultado de una vez.
+SQL_FETCH_SIZE = 500
+
+# Modo de funcionamiento del cliente de IA:
+# - "live": se llama al API del modelo.
+# - "record": se llama al API y cada intercambio se graba en TRANSCRIPT_FILE.
+# - "replay": no se accede a la red; se reproducen los intercambios de TRANSCRIPT_FILE.
+AICLIENT_MODE = getProperty("chatagent_aiclient_mode")
+if AICLIENT_MODE == None:
+  AICLIENT_MODE = "live"
+# Fichero JSONL con los intercambios grabados.
+TRANSCRIPT_FILE = getProperty("chatagent_transcript_file")
+if TRANSCRIPT_FILE == None:
+  TRANSCRIPT_FILE = os.path.join(CACHE_DIR, "transcript.jsonl")
+# En modo "replay", si es True se reproduce la latencia original de cada respuesta.
+REPLAY_REALTIME = False
+
+# Salida estructurada: si es True se envia al modelo el esquema JSON de la
+# respuesta construido a partir de los procesadores registrados, y el modelo
+# responde directamente con un objeto JSON en lugar de un bloque markdown.
+STRUCTURED_OUTPUT = True
+
+# Parametros de la capa de transporte HTTP de los clientes de IA.
+# Timeouts en milisegundos. El de lectura ha de cubrir el tiempo que el modelo
+# puede tardar en empezar a responder.
+HTTP_CONNECT_TIMEOUT = 15000
+HTTP_READ_TIMEOUT = 300000
+# Comprimir con gzip los cuerpos de las peticiones (el prompt puede ocupar cientos de KB).
+HTTP_GZIP_REQUESTS = True
+# Conexiones keep-alive que se mantienen abiertas por servidor.
+HTTP_MAX_CONNECTIONS = 5
+
+# Trazas de rendimiento: cada turno del chat registra la duracion de sus etapas
+# (construccion del prompt, red, parseo, procesador, SQL y representacion) con
+# los tokens consumidos y el tamaño de los datos, en un fichero JSONL rotativo.
+TRACE_ENABLED = True
+TRACE_FILE = os.path.join(CACHE_DIR, "traces.jsonl")
+# Tamaño maximo del fichero de trazas antes de rotarlo, y ficheros rotados que se conservan.
+TRACE_MAX_BYTES = 5 * 1024 * 1024
+TRACE_BACKUPS = 3
+# Numero de trazas por etapa que se conservan en memoria para las estadisticas (p50/p95).
+TRACE_STATS_WINDOW = 500
+
+# Modo por lotes (batch.py): numero de preguntas que se procesan a la vez y
+# maximo de peticiones por minuto al modelo (0 o None para no limitarlas).
+BATCH_POOL_SIZE = 4
+BATCH_REQUESTS_PER_MINUTE = 30
+
 
 # Estructura base del prompt inicial que se enviará a la IA.
 # Este prompt será completado dinámicamente con la información de los procesadores
@@ -24,8 +249,8 @@ Tu objetivo es responder a las preguntas del usuario utilizando la información
 o generando consultas SQL o gráficos según la intención del usuario.
 
 La aplicacion con la que interactuas tiene un tipo de documento llamado Vista que tiene una serie de capas y un mapa.
-El documento tipo Vista actual tiene un bounding-box que esta representado por el siguiente WKT:
-{current_view_bbox}
+El documento tipo Vista actual tiene un bounding-box; su WKT se incluira junto a cada peticion,
+en "Instrucciones para esta peticion", ya que puede cambiar durante la conversacion.
 Si no te lo pido expresamente no filtres por el area de la vista.
 
 A continuación se listan los tipos de consulta que puedes manejar:
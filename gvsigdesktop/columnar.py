@@ -0,0 +1,772 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: columnar
+
+Descripción:
+Almacenamiento por columnas de un resultado de SQL cargado entero en memoria.
+Una lista de listas con los valores de cada celda ocupa en Jython varios
+cientos de bytes por celda, y unos pocos resultados de 100.000 filas agotan
+la memoria de gvSIG. ColumnarResult guarda cada columna según su tipo:
+- números y booleanos en arrays de tipos primitivos,
+- decimales (BigDecimal) y enteros grandes (BigInteger) como su valor sin
+  escala en un array de long, sin perder precisión,
+- fechas y horas como milisegundos en un array de long,
+- textos codificados con un diccionario (cada valor distinto se guarda una vez),
+- geometrías como WKB (bytes),
+y los nulos en un BitSet por columna.
+Se puede mostrar en un JTable con ColumnarTableModel y recorrer como un
+java.sql.ResultSet (de solo lectura) con cursor(), que es lo que esperan las
+funciones que generan los gráficos.
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+"""
+
+import sys
+import time
+
+from array import array
+
+from java.lang import Class, Object, Runtime, System, Thread
+from java.math import BigDecimal, BigInteger, RoundingMode
+from java.sql import Date, ResultSet, ResultSetMetaData, SQLFeatureNotSupportedException, Statement, Time, Timestamp, Types
+from java.util import BitSet
+from javax.swing.table import AbstractTableModel
+
+
+class _Column:
+    # Columna de un ColumnarResult; las filas nulas se marcan en self.nulls
+    def __init__(self):
+        self.nulls = BitSet()
+        self.size = 0
+
+    def append(self, value):
+        if value is None:
+            self.nulls.set(self.size)
+            self._append_null()
+        else:
+            self._append(value)
+        self.size += 1
+
+    def get(self, row):
+        if self.nulls.get(row):
+            return None
+        return self._get(row)
+
+    def estimate_bytes(self):
+        return self.nulls.size() / 8 + self._estimate_bytes()
+
+
+class _NumberColumn(_Column):
+    def __init__(self, typecode, convert):
+        _Column.__init__(self)
+        self.values = array(typecode)
+        self.convert = convert
+
+    def _append_null(self):
+        self.values.append(0)
+
+    def _append(self, value):
+        if not isinstance(value, (int, long, float)):
+            # Number que Jython no convierte a un número de Python
+            if self.convert is float:
+                value = value.doubleValue()
+            else:
+                value = value.longValue()
+        self.values.append(self.convert(value))
+
+    def _get(self, row):
+        return self.values[row]
+
+    def _estimate_bytes(self):
+        return len(self.values) * self.values.itemsize
+
+
+class _DecimalColumn(_Column):
+    # BigDecimal como valor sin escala y escala, que es exacto; los valores cuyo
+    # valor sin escala no cabe en un long se guardan tal cual en self.big
+    def __init__(self):
+        _Column.__init__(self)
+        self.values = array("l")
+        self.scales = array("i")
+        self.big = {}  # Fila -> BigDecimal
+
+    def _append_null(self):
+        self.values.append(0)
+        self.scales.append(0)
+
+    def _append(self, value):
+        unscaled = value.unscaledValue()
+        if unscaled.bitLength() < 64:
+            self.values.append(unscaled.longValue())
+            self.scales.append(value.scale())
+        else:
+            self.big[self.size] = value
+            self._append_null()
+
+    def _get(self, row):
+        value = self.big.get(row)
+        if value is None:
+            value = BigDecimal.valueOf(self.values[row], self.scales[row])
+        return value
+
+    def _estimate_bytes(self):
+        return len(self.values) * (self.values.itemsize + self.scales.itemsize) + 64 * len(self.big)
+
+
+class _BigIntegerColumn(_DecimalColumn):
+    def _append(self, value):
+        if value.bitLength() < 64:
+            self.values.append(value.longValue())
+            self.scales.append(0)
+        else:
+            self.big[self.size] = value
+            self._append_null()
+
+    def _get(self, row):
+        value = self.big.get(row)
+        if value is None:
+            value = BigInteger.valueOf(self.values[row])
+        return value
+
+
+class _BooleanColumn(_NumberColumn):
+    def __init__(self):
+        _NumberColumn.__init__(self, "b", int)
+
+    def _get(self, row):
+        return bool(self.values[row])
+
+
+class _DateColumn(_Column):
+    # java.sql.Date, Time y Timestamp como milisegundos; se pierden los nanosegundos
+    def __init__(self):
+        _Column.__init__(self)
+        self.values = array("l")
+        self.factory = None
+
+    def _append_null(self):
+        self.values.append(0)
+
+    def _append(self, value):
+        if self.factory is None:
+            self.factory = type(value)
+        elif type(value) is not self.factory:
+            raise TypeError("Clase de fecha distinta en la columna: %s" % type(value))
+        self.values.append(value.getTime())
+
+    def _get(self, row):
+        return self.factory(self.values[row])
+
+    def _estimate_bytes(self):
+        return len(self.values) * self.values.itemsize
+
+
+class _StringColumn(_Column):
+    # Codificada con un diccionario: cada fila guarda la posición de su valor en self.values
+    def __init__(self):
+        _Column.__init__(self)
+        self.codes = array("i")
+        self.values = []
+        self.positions = {}  # Valor -> posición en self.values
+
+    def _append_null(self):
+        self.codes.append(-1)
+
+    def _append(self, value):
+        if not isinstance(value, basestring):
+            raise TypeError("Valor que no es un texto en la columna: %r" % value)
+        code = self.positions.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.positions[value] = code
+        self.codes.append(code)
+
+    def _get(self, row):
+        return self.values[self.codes[row]]
+
+    def _estimate_bytes(self):
+        # Cada valor distinto: la cadena (unos 40 bytes más 2 por carácter) y su entrada en el diccionario
+        return len(self.codes) * self.codes.itemsize + sum([80 + 2 * len(value) for value in self.values])
+
+
+class _GeometryColumn(_Column):
+    # Guarda el WKB de cada geometría y la reconstruye al leerla
+    def __init__(self):
+        _Column.__init__(self)
+        self.values = []
+        self.manager = None
+
+    def _append_null(self):
+        self.values.append(None)
+
+    def _append(self, value):
+        if hasattr(value, "convertToWKB"):
+            value = value.convertToWKB()
+        elif not hasattr(value, "__len__"):
+            raise TypeError("Valor que no es una geometria en la columna: %r" % value)
+        self.values.append(value)
+
+    def _get(self, row):
+        wkb = self.values[row]
+        try:
+            if self.manager is None:
+                from org.gvsig.fmap.geom import GeometryLocator
+                self.manager = GeometryLocator.getGeometryManager()
+            return self.manager.createFrom(wkb)
+        except:
+            return wkb
+
+    def get_wkb(self, row):
+        return self.values[row]
+
+    def _estimate_bytes(self):
+        return sum([16 + len(value) for value in self.values if value is not None]) + 8 * len(self.values)
+
+
+class _ObjectColumn(_Column):
+    # Para los tipos que no tienen una representación más compacta
+    def __init__(self):
+        _Column.__init__(self)
+        self.values = []
+
+    def _append_null(self):
+        self.values.append(None)
+
+    def _append(self, value):
+        self.values.append(value)
+
+    def _get(self, row):
+        return self.values[row]
+
+    def _estimate_bytes(self):
+        return 64 * len(self.values)
+
+
+_COLUMN_KINDS = {
+    "java.lang.Byte": "int",
+    "java.lang.Short": "int",
+    "java.lang.Integer": "int",
+    "java.lang.Long": "long",
+    "java.math.BigInteger": "biginteger",
+    "java.lang.Float": "double",
+    "java.lang.Double": "double",
+    "java.math.BigDecimal": "decimal",
+    "java.lang.Boolean": "boolean",
+    "java.sql.Date": "date",
+    "java.sql.Time": "date",
+    "java.sql.Timestamp": "date",
+    "java.lang.String": "string"
+}
+
+def column_kind(class_name, type_name):
+    """
+    Devuelve cómo se guarda una columna a partir de la clase y el nombre del tipo
+    de sus valores en los metadatos del ResultSet: int, long, double, decimal,
+    biginteger, boolean, date, string, geometry u object.
+    """
+    kind = _COLUMN_KINDS.get(class_name)
+    if kind is not None:
+        return kind
+    if "geom" in (type_name or "").lower() or "geom" in (class_name or "").lower():
+        return "geometry"
+    return "object"
+
+def _new_column(kind):
+    if kind == "int":
+        return _NumberColumn("i", int)
+    if kind == "long":
+        return _NumberColumn("l", long)
+    if kind == "double":
+        return _NumberColumn("d", float)
+    if kind == "decimal":
+        return _DecimalColumn()
+    if kind == "biginteger":
+        return _BigIntegerColumn()
+    if kind == "boolean":
+        return _BooleanColumn()
+    if kind == "date":
+        return _DateColumn()
+    if kind == "string":
+        return _StringColumn()
+    if kind == "geometry":
+        return _GeometryColumn()
+    return _ObjectColumn()
+
+
+class ColumnarResult:
+    """
+    Resultado de una SQL almacenado por columnas.
+    """
+
+    def __init__(self, names, class_names, type_names, column_types=None):
+        """
+        Args:
+            names (list): Los nombres (etiquetas) de las columnas.
+            class_names (list): La clase Java de los valores de cada columna.
+            type_names (list): El nombre del tipo SQL de cada columna.
+            column_types (list, optional): El tipo JDBC (java.sql.Types) de cada columna.
+                                           Por defecto Types.OTHER.
+        """
+        self.names = list(names)
+        self.class_names = list(class_names)
+        self.type_names = list(type_names)
+        if column_types is None:
+            column_types = [Types.OTHER] * len(self.names)
+        self.column_types = list(column_types)
+        self.columns = [_new_column(column_kind(class_name, type_name))
+                        for class_name, type_name in zip(self.class_names, self.type_names)]
+        self.row_count = 0
+        self.truncated = False  # Se dejaron filas sin leer por max_rows
+
+    @staticmethod
+    def from_result_set(resultSet, close=True, max_rows=None):
+        """
+        Lee las filas de un ResultSet.
+
+        Args:
+            resultSet (ResultSet): El resultado a leer.
+            close (bool, optional): Cerrar el ResultSet al terminar.
+            max_rows (int, optional): Leer como mucho estas filas; si quedan más,
+                                      el resultado tiene truncated a True.
+        """
+        try:
+            metaData = resultSet.getMetaData()
+            count = metaData.getColumnCount()
+            result = ColumnarResult(
+                [metaData.getColumnLabel(i) for i in range(1, count + 1)],
+                [metaData.getColumnClassName(i) for i in range(1, count + 1)],
+                [metaData.getColumnTypeName(i) for i in range(1, count + 1)],
+                [metaData.getColumnType(i) for i in range(1, count + 1)])
+            while resultSet.next():
+                if max_rows is not None and result.row_count >= max_rows:
+                    result.truncated = True
+                    break
+                result.append_row([resultSet.getObject(i) for i in range(1, count + 1)])
+            return result
+        finally:
+            if close:
+                resultSet.close()
+
+    def append_row(self, values):
+        for n, value in enumerate(values):
+            column = self.columns[n]
+            try:
+                column.append(value)
+            except (TypeError, ValueError, AttributeError, OverflowError):
+                # El valor no encaja en la representación elegida por los metadatos
+                print u"Advertencia: la columna '%s' se guarda sin compactar. %s" % (self.names[n], sys.exc_info()[1])
+                column = self._to_objects(n)
+                column.append(value)
+        self.row_count += 1
+
+    def _to_objects(self, n):
+        column = _ObjectColumn()
+        previous = self.columns[n]
+        for row in range(previous.size):
+            column.append(previous.get(row))
+        self.columns[n] = column
+        self.class_names[n] = "java.lang.Object"
+        return column
+
+    def get_column_count(self):
+        return len(self.names)
+
+    def get_row_count(self):
+        return self.row_count
+
+    def get_value(self, row, col):
+        """
+        Devuelve el valor de una celda; row y col empiezan en 0.
+        """
+        return self.columns[col].get(row)
+
+    def get_column_values(self, col):
+        """
+        Devuelve la lista de valores de una columna, por ejemplo para la serie de un gráfico.
+        """
+        column = self.columns[col]
+        return [column.get(row) for row in range(self.row_count)]
+
+    def find_column(self, name):
+        """
+        Devuelve la posición (desde 0) de la columna, sin distinguir mayúsculas y minúsculas.
+        """
+        lower = name.lower()
+        for n, column_name in enumerate(self.names):
+            if column_name.lower() == lower:
+                return n
+        raise KeyError(u"No existe la columna '%s' en el resultado" % name)
+
+    def estimate_bytes(self):
+        """
+        Estimación aproximada de la memoria que ocupan los datos.
+        """
+        return sum([column.estimate_bytes() for column in self.columns])
+
+    def cursor(self):
+        """
+        Devuelve un cursor con la interfaz de java.sql.ResultSet sobre los datos.
+        """
+        return ColumnarCursor(self)
+
+
+def _unsupported(name):
+    def method(self, *args):
+        raise SQLFeatureNotSupportedException(u"%s no admite %s" % (self.__class__.__name__, name))
+    method.__name__ = name
+    return method
+
+def _unsupported_missing(cls, interface):
+    # Añade a la clase los métodos de la interfaz Java que no define; lanzan
+    # SQLFeatureNotSupportedException, como hacen los drivers de solo lectura
+    for name in set([method.getName() for method in Class.forName(interface).getMethods()]):
+        if name not in cls.__dict__:
+            setattr(cls, name, _unsupported(name))
+
+
+class _ColumnarMetaData(ResultSetMetaData):
+    # Los metadatos de un ColumnarCursor
+    def __init__(self, result):
+        self.result = result
+
+    def getColumnCount(self):
+        return self.result.get_column_count()
+
+    def getColumnName(self, column):
+        return self.result.names[column - 1]
+
+    def getColumnLabel(self, column):
+        return self.result.names[column - 1]
+
+    def getColumnClassName(self, column):
+        return self.result.class_names[column - 1]
+
+    def getColumnTypeName(self, column):
+        return self.result.type_names[column - 1]
+
+    def getColumnType(self, column):
+        return self.result.column_types[column - 1]
+
+    def isReadOnly(self, column):
+        return True
+
+    def isNullable(self, column):
+        return ResultSetMetaData.columnNullableUnknown
+
+
+class _ColumnarStatement(Statement):
+    # Las funciones de los gráficos pueden cerrar el Statement del ResultSet
+    def close(self):
+        pass
+
+    def isClosed(self):
+        return False
+
+
+class ColumnarCursor(ResultSet):
+    """
+    Recorre un ColumnarResult con la interfaz de java.sql.ResultSet, de solo
+    lectura y desplazable (absolute, relative, previous...), con los getXXX de
+    los tipos habituales. Las columnas se indican por su posición (desde 1) o
+    por su nombre. Los métodos que no tienen sentido sobre datos en memoria
+    (updateXXX, getBlob...) lanzan SQLFeatureNotSupportedException.
+    """
+
+    def __init__(self, result):
+        self.result = result
+        self.row = -1
+        self.closed = False
+        self.last_was_null = False
+        self.fetch_size = 0
+        self.fetch_direction = ResultSet.FETCH_FORWARD
+
+    def next(self):
+        return self.absolute(self.row + 2)
+
+    def previous(self):
+        return self.absolute(self.row)
+
+    def beforeFirst(self):
+        self.row = -1
+
+    def afterLast(self):
+        self.row = self.result.row_count
+
+    def first(self):
+        return self.absolute(1)
+
+    def last(self):
+        return self.absolute(-1)
+
+    def absolute(self, row):
+        # Como en JDBC: desde 1, negativo desde el final; fuera del resultado
+        # queda antes de la primera fila o después de la última
+        count = self.result.row_count
+        if row < 0:
+            row = count + row + 1
+        self.row = min(max(row - 1, -1), count)
+        return 0 <= self.row < count
+
+    def relative(self, rows):
+        return self.absolute(self.row + 1 + rows)
+
+    def getRow(self):
+        if 0 <= self.row < self.result.row_count:
+            return self.row + 1
+        return 0
+
+    def isBeforeFirst(self):
+        return self.row < 0 and self.result.row_count > 0
+
+    def isAfterLast(self):
+        return self.row >= self.result.row_count and self.result.row_count > 0
+
+    def isFirst(self):
+        return self.row == 0 and self.result.row_count > 0
+
+    def isLast(self):
+        return self.row == self.result.row_count - 1 and self.result.row_count > 0
+
+    def getType(self):
+        return ResultSet.TYPE_SCROLL_INSENSITIVE
+
+    def getConcurrency(self):
+        return ResultSet.CONCUR_READ_ONLY
+
+    def getHoldability(self):
+        return ResultSet.HOLD_CURSORS_OVER_COMMIT
+
+    def getFetchSize(self):
+        return self.fetch_size
+
+    def setFetchSize(self, rows):
+        self.fetch_size = rows
+
+    def getFetchDirection(self):
+        return self.fetch_direction
+
+    def setFetchDirection(self, direction):
+        self.fetch_direction = direction
+
+    def getWarnings(self):
+        return None
+
+    def clearWarnings(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def isClosed(self):
+        return self.closed
+
+    def getStatement(self):
+        return _ColumnarStatement()
+
+    def getMetaData(self):
+        return _ColumnarMetaData(self.result)
+
+    def findColumn(self, name):
+        return self.result.find_column(name) + 1
+
+    def wasNull(self):
+        return self.last_was_null
+
+    def getObject(self, column, type=None):
+        value = self.result.get_value(self._check_row(), self._column(column))
+        self.last_was_null = value is None
+        return value
+
+    def getString(self, column):
+        value = self.getObject(column)
+        if value is None:
+            return None
+        return unicode(value)
+
+    def getNString(self, column):
+        return self.getString(column)
+
+    def getInt(self, column):
+        return self._number(column, int)
+
+    def getShort(self, column):
+        return self._number(column, int)
+
+    def getByte(self, column):
+        return self._number(column, int)
+
+    def getLong(self, column):
+        return self._number(column, long)
+
+    def getDouble(self, column):
+        return self._number(column, float)
+
+    def getFloat(self, column):
+        return self._number(column, float)
+
+    def getBigDecimal(self, column, scale=None):
+        value = self.getObject(column)
+        if value is None:
+            return None
+        if not isinstance(value, BigDecimal):
+            value = BigDecimal(unicode(value))
+        if scale is not None:
+            value = value.setScale(scale, RoundingMode.HALF_UP)
+        return value
+
+    def getBoolean(self, column):
+        value = self.getObject(column)
+        return bool(value)
+
+    def getDate(self, column, calendar=None):
+        return self._date(column, Date)
+
+    def getTime(self, column, calendar=None):
+        return self._date(column, Time)
+
+    def getTimestamp(self, column, calendar=None):
+        return self._date(column, Timestamp)
+
+    def getBytes(self, column):
+        col = self._column(column)
+        stored = self.result.columns[col]
+        if hasattr(stored, "get_wkb"):
+            value = stored.get_wkb(self._check_row())
+            self.last_was_null = value is None
+            return value
+        return self.getObject(column)
+
+    def _check_row(self):
+        if not 0 <= self.row < self.result.row_count:
+            raise IndexError("El cursor no esta sobre ninguna fila")
+        return self.row
+
+    def _column(self, column):
+        if isinstance(column, basestring):
+            return self.result.find_column(column)
+        return column - 1
+
+    def _date(self, column, factory):
+        value = self.getObject(column)
+        if value is None or isinstance(value, factory):
+            return value
+        return factory(value.getTime())
+
+    def _number(self, column, convert):
+        value = self.getObject(column)
+        if value is None:
+            return convert(0)
+        if hasattr(value, "doubleValue"):
+            value = value.doubleValue()
+        return convert(value)
+
+
+_unsupported_missing(_ColumnarMetaData, "java.sql.ResultSetMetaData")
+_unsupported_missing(_ColumnarStatement, "java.sql.Statement")
+_unsupported_missing(ColumnarCursor, "java.sql.ResultSet")
+
+
+class ColumnarTableModel(AbstractTableModel):
+    """
+    Modelo de tabla para mostrar un ColumnarResult en un JTable.
+    """
+    def __init__(self, result):
+        self.result = result
+
+    def getColumnCount(self):
+        return self.result.get_column_count()
+
+    def getRowCount(self):
+        return self.result.get_row_count()
+
+    def getColumnName(self, col):
+        return self.result.names[col]
+
+    def getValueAt(self, row, col):
+        return self.result.get_value(row, col)
+
+    def getColumnClass(self, col):
+        try:
+            return Class.forName(self.result.class_names[col])
+        except:
+            return Object
+
+
+class _BenchmarkResultSet:
+    # ResultSet sintético con un entero, dos textos repetidos, un número real,
+    # una fecha y una geometría (WKB de un punto)
+    def __init__(self, rows):
+        from java.sql import Timestamp
+        import jarray
+        self.rows = rows
+        self.row = -1
+        self.names = ("id", "municipio", "tipo", "superficie", "fecha", "geom")
+        self.classes = ("java.lang.Integer", "java.lang.String", "java.lang.String",
+                        "java.lang.Double", "java.sql.Timestamp", "[B")
+        self.types = ("int4", "varchar", "varchar", "float8", "timestamp", "geometry")
+        self.timestamp = Timestamp
+        self.wkb = jarray.array([1, 1, 0, 0, 0] + [0] * 16, "b")
+
+    def getMetaData(self):
+        return self
+
+    def getColumnCount(self):
+        return len(self.names)
+
+    def getColumnLabel(self, i):
+        return self.names[i - 1]
+
+    def getColumnClassName(self, i):
+        return self.classes[i - 1]
+
+    def getColumnTypeName(self, i):
+        return self.types[i - 1]
+
+    def next(self):
+        self.row += 1
+        return self.row < self.rows
+
+    def getObject(self, i):
+        n = self.row
+        if i == 1:
+            return n
+        if i == 2:
+            return u"Municipio %d" % (n % 542)
+        if i == 3:
+            return (u"urbana", u"rustica", u"mixta")[n % 3]
+        if i == 4:
+            return n * 1.5
+        if i == 5:
+            return self.timestamp(1500000000000L + n * 60000L)
+        return self.wkb
+
+    def close(self):
+        pass
+
+def _used_heap():
+    runtime = Runtime.getRuntime()
+    for n in range(3):
+        System.gc()
+        Thread.sleep(100)
+    return runtime.totalMemory() - runtime.freeMemory()
+
+def benchmark_columnar(rows=100000):
+    """
+    Compara la memoria ocupada y el tiempo de carga de un resultado sintético
+    en ResultSetTableModel (listas de valores) y en ColumnarResult.
+    """
+    from addons.chatagent_prototype.processors.sql_processor.resultsetpanel import ResultSetTableModel
+    print "%-20s %8s %10s %10s" % ("modelo", "filas", "carga ms", "memoria MB")
+    for name, load in (("listas", ResultSetTableModel), ("columnas", ColumnarResult.from_result_set)):
+        before = _used_heap()
+        start = time.time()
+        model = load(_BenchmarkResultSet(rows))
+        load_ms = (time.time() - start) * 1000.0
+        used = _used_heap() - before
+        print "%-20s %8d %10.0f %10.1f" % (name, rows, load_ms, used / 1048576.0)
+        del model
+
+
+def main(**args):
+  benchmark_columnar()
+  print "Ok"
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: ddlcache
+
+Descripción:
+Cache en memoria y en disco del DDL que genera getDDL para cada modelo de datos.
+Generar el DDL obliga a abrir un explorador del servidor, pedir las sentencias
+CREATE TABLE de cada tabla y leer completos los diccionarios de lista cerrada,
+lo que en modelos con muchas tablas tarda varios segundos.
+Cada entrada se indexa por el ID del repositorio y se acompaña de una huella
+barata del esquema: la lista de tablas, un hash de la definición de cada tipo
+de entidad y el número de filas de cada diccionario. Si la huella cambia, la
+entrada se descarta y el DDL se genera de nuevo. Los cambios en los valores de
+un diccionario que no alteran su número de filas no se detectan; para ellos
+está invalidate (la acción "Actualizar estructura del modelo" del chat).
+Junto al DDL se guardan, con la misma huella, los valores de los diccionarios,
+que usa el índice de valores de dictindex sin tener que leerlos de la base de datos.
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from org.gvsig.tools.dispose import DisposeUtils
+
+from addons.chatagent_prototype import config
+from addons.chatagent_prototype.gvsigdesktop.ddlformat import DDL_FORMATS
+
+
+def feature_type_signature(ft):
+    """
+    Devuelve un texto que describe la definición de un tipo de entidad:
+    nombre, tipo y tamaño de cada atributo, su clave primaria y sus claves ajenas.
+    """
+    parts = []
+    for attr in ft:
+        fk = ""
+        if attr.isForeingKey():
+            fk = "%s:%s" % (attr.getForeingKey().getTableName(), attr.getForeingKey().isClosedList())
+        parts.append("%s|%s|%s|%s|%s|%s|%s" % (
+            attr.getName(), attr.getDataTypeName(), attr.getSize(), attr.getPrecision(),
+            attr.isPrimaryKey(), attr.allowNull(), fk
+        ))
+    return "\n".join(parts)
+
+def schema_fingerprint(repo):
+    """
+    Calcula la huella del esquema de un repositorio sin abrir el explorador del
+    servidor ni leer los datos de las tablas (de los diccionarios solo se cuentan las filas).
+
+    Args:
+        repo: El repositorio (StoresRepository) del modelo de datos.
+
+    Returns:
+        str: El hash SHA-256 de la huella.
+    """
+    digest = hashlib.sha256()
+    dictionaries = set()
+    for table in sorted(repo.keySet()):
+        ft = repo.getFeatureType(table)
+        digest.update("table:%s\n" % table)
+        digest.update(feature_type_signature(ft).encode("utf-8"))
+        digest.update("\n")
+        for attr in ft:
+            if attr.isForeingKey() and attr.getForeingKey().isClosedList():
+                dictionaries.add(attr.getForeingKey().getTableName())
+    for table in sorted(dictionaries):
+        digest.update("dictionary:%s:%s\n" % (table, _count_rows(repo, table)))
+    return digest.hexdigest()
+
+def _count_rows(repo, table):
+    store = None
+    try:
+        store = repo.getStore(table)
+        return store.getFeatureCount()
+    except:
+        # Un diccionario ilegible no impide usar la cache; getDDL informará del error
+        return -1
+    finally:
+        DisposeUtils.dispose(store)
+
+
+class DDLCache:
+    """
+    Cache del DDL de los modelos de datos. Las entradas se guardan en memoria
+    y en un fichero JSON por entrada en el directorio indicado.
+    Es segura para usarla desde varios hilos.
+    """
+
+    def __init__(self, directory=None):
+        """
+        Args:
+            directory (str, optional): Directorio de la cache en disco. Por defecto config.DDL_CACHE_DIR.
+        """
+        if directory is None:
+            directory = config.DDL_CACHE_DIR
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.entries = {}  # Clave -> registro (repository, fingerprint, created y ddl o dictionaries)
+
+    def get(self, repository_id, include_datadicts, fingerprint, ddl_format="sql"):
+        """
+        Devuelve el DDL guardado para el repositorio, o None si no existe o si
+        se generó con otra huella del esquema (en ese caso se descarta).
+        """
+        record = self._get(self._key(repository_id, self._ddl_kind(include_datadicts, ddl_format)), repository_id, fingerprint)
+        if record is None:
+            return None
+        return record["ddl"]
+
+    def put(self, repository_id, include_datadicts, fingerprint, ddl, ddl_format="sql"):
+        self._put(self._key(repository_id, self._ddl_kind(include_datadicts, ddl_format)), repository_id, fingerprint, ddl=ddl)
+
+    def get_dictionaries(self, repository_id, fingerprint):
+        """
+        Devuelve los valores de los diccionarios guardados para el repositorio,
+        o None si no existen o se leyeron con otra huella del esquema.
+
+        Returns:
+            dict: Tabla -> (nombre de la clave, lista de pares (clave, etiqueta)).
+        """
+        record = self._get(self._key(repository_id, "dictionaries"), repository_id, fingerprint)
+        if record is None:
+            return None
+        return dict([(table, (keyname, [tuple(pair) for pair in values]))
+                     for table, (keyname, values) in record["dictionaries"].items()])
+
+    def put_dictionaries(self, repository_id, fingerprint, dictionaries):
+        self._put(self._key(repository_id, "dictionaries"), repository_id, fingerprint, dictionaries=dictionaries)
+
+    def invalidate(self, repository_id):
+        """
+        Descarta el DDL, en todos los formatos y con y sin diccionarios, y los
+        valores de los diccionarios guardados de un repositorio.
+        """
+        kinds = ["dictionaries"]
+        for ddl_format in DDL_FORMATS:
+            kinds.extend([self._ddl_kind(True, ddl_format), self._ddl_kind(False, ddl_format)])
+        self.lock.acquire()
+        try:
+            for kind in kinds:
+                self._remove(self._key(repository_id, kind))
+        finally:
+            self.lock.release()
+
+    def _get(self, key, repository_id, fingerprint):
+        self.lock.acquire()
+        try:
+            record = self.entries.get(key)
+            if record is None:
+                record = self._load(key)
+            if record is None:
+                return None
+            if record.get("fingerprint") != fingerprint:
+                print "DDL del modelo '%s' obsoleto: el esquema ha cambiado." % repository_id
+                self._remove(key)
+                return None
+            self.entries[key] = record
+            return record
+        finally:
+            self.lock.release()
+
+    def _put(self, key, repository_id, fingerprint, **data):
+        record = {
+            "repository": repository_id,
+            "fingerprint": fingerprint,
+            "created": time.time()
+        }
+        record.update(data)
+        self.lock.acquire()
+        try:
+            self.entries[key] = record
+            self._save(key, record)
+        finally:
+            self.lock.release()
+
+    def _ddl_kind(self, include_datadicts, ddl_format):
+        # El DDL con diccionarios depende del tamaño de la muestra de los grandes
+        return "%s|%s|%s" % (bool(include_datadicts), config.DICTIONARY_SAMPLE_SIZE, ddl_format)
+
+    def _key(self, repository_id, kind):
+        # kind: el de _ddl_kind o "dictionaries"
+        return hashlib.sha256((u"%s|%s" % (repository_id, kind)).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def _load(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            f = open(path, "rb")
+            try:
+                return json.loads(f.read().decode("utf-8"))
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            print "Advertencia: entrada de la cache de DDL ilegible '%s'. %s" % (path, e)
+            return None
+
+    def _save(self, key, record):
+        path = self._path(key)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            tmp_path = path + ".tmp"
+            f = open(tmp_path, "wb")
+            try:
+                f.write(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+            finally:
+                f.close()
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError), e:
+            print "Advertencia: no se ha podido guardar el DDL en la cache '%s'. %s" % (path, e)
+
+    def _remove(self, key):
+        self.entries.pop(key, None)
+        path = self._path(key)
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError, e:
+            print "Advertencia: no se ha podido borrar la entrada de la cache de DDL '%s'. %s" % (path, e)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_ddl_cache():
+    """
+    Devuelve la cache de DDL compartida por toda la aplicación.
+    """
+    global _cache
+    if _cache is None:
+        _cache_lock.acquire()
+        try:
+            if _cache is None:
+                _cache = DDLCache()
+        finally:
+            _cache_lock.release()
+    return _cache
+
+
+def main(**args):
+  print "Ok"
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: ddlformat
+
+Descripción:
+Formatos en los que getDDL describe las tablas del modelo de datos en el prompt.
+- "sql": las sentencias CREATE TABLE que genera el explorador del servidor,
+  con sus FOREIGN KEY ... REFERENCES, y los diccionarios como JSON indentado.
+- "compact": una línea por tabla con sus columnas tipadas, la clave primaria,
+  las claves ajenas y si es una entidad o un diccionario, y los valores de los
+  diccionarios en una sola línea. Se construye directamente del tipo de entidad,
+  sin abrir el explorador del servidor, y ocupa bastantes menos tokens.
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+"""
+
+import json
+
+DDL_FORMATS = ("sql", "compact")
+
+COMPACT_LEGEND = u"""-- Esquema en formato compacto, una linea por tabla:
+-- @tabla T: columna tipo [PK] [NN] [>tabla.columna], ...
+-- T es E (entidad) o D (diccionario); PK clave primaria; NN no admite nulos; >tabla.columna clave ajena.
+-- La linea "valores" de un diccionario da sus claves y etiquetas; las claves son los unicos valores
+-- permitidos en las columnas que lo referencian. Si es una muestra, los valores que coincidan con la
+-- peticion del usuario se indicaran junto a ella.
+
+"""
+
+COMPACT_TYPES = {
+    "string": "varchar",
+    "integer": "int",
+    "int": "int",
+    "long": "bigint",
+    "double": "double",
+    "float": "real",
+    "decimal": "numeric",
+    "boolean": "bool",
+    "date": "date",
+    "time": "time",
+    "timestamp": "timestamp",
+    "geometry": "geometry"
+}
+
+def _call(obj, *methods):
+    # Encadena llamadas opcionales; devuelve None si alguna falla o no existe
+    try:
+        for method in methods:
+            obj = getattr(obj, method)()
+            if obj is None:
+                return None
+        return obj
+    except:
+        return None
+
+def compact_column_type(attr):
+    """
+    Devuelve el tipo de una columna en el formato compacto, por ejemplo
+    varchar(100) o geometry(MultiPolygon,EPSG:25830).
+    """
+    name = (attr.getDataTypeName() or "").lower()
+    column_type = COMPACT_TYPES.get(name, name)
+    if column_type == "varchar" and attr.getSize() > 0:
+        return "varchar(%d)" % attr.getSize()
+    if column_type == "geometry":
+        details = [detail for detail in (_call(attr, "getGeomType", "getName"), _call(attr, "getSRS", "getAbrev")) if detail]
+        if details:
+            return "geometry(%s)" % ",".join(details)
+    return column_type
+
+def render_compact_table(table, ft, is_dictionary):
+    """
+    Devuelve la línea del formato compacto de una tabla.
+    """
+    columns = []
+    for attr in ft:
+        column = "%s %s" % (attr.getName(), compact_column_type(attr))
+        if attr.isPrimaryKey():
+            column += " PK"
+        elif not attr.allowNull():
+            column += " NN"
+        if attr.isForeingKey():
+            fk = attr.getForeingKey()
+            code = _call(fk, "getCodeName")
+            if code:
+                column += " >%s.%s" % (fk.getTableName(), code)
+            else:
+                column += " >%s" % fk.getTableName()
+        columns.append(column)
+    return u"@%s %s: %s\n" % (table, "D" if is_dictionary else "E", ", ".join(columns))
+
+def sample_values(values, sample_size):
+    """
+    Devuelve como mucho sample_size valores repartidos entre todos los de la lista.
+    """
+    if not sample_size or len(values) <= sample_size:
+        return values
+    step = len(values) / float(sample_size)
+    return [values[int(n * step)] for n in range(sample_size)]
+
+def render_compact_dictionary(table, keyname, values, sample_size):
+    """
+    Devuelve la línea de valores de un diccionario en el formato compacto.
+    """
+    sample = sample_values(values, sample_size)
+    s = json.dumps(dict(sample), ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    if len(sample) < len(values):
+        return u"  valores %s (muestra de %d de %d): %s\n" % (keyname, len(sample), len(values), s)
+    return u"  valores %s: %s\n" % (keyname, s)
+
+def estimate_tokens(text):
+    """
+    Estimación aproximada de los tokens de un texto (unos 4 caracteres por token)
+    para cuando no se puede preguntar al modelo.
+    """
+    return (len(text) + 3) / 4
+
+
+def main(**args):
+  print "Ok"
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: dictindex
+
+Descripción:
+Índice local de trigramas sobre las etiquetas de los diccionarios de lista
+cerrada de un modelo de datos.
+Los diccionarios grandes (municipios, códigos de especies...) solo aparecen en
+el DDL con una muestra de sus valores. Antes de enviar cada petición se buscan
+en el índice los términos del usuario, tolerando tildes, mayúsculas y pequeñas
+erratas, y se envían con ella solo las entradas que coinciden, de forma que el
+modelo conoce los códigos que necesita sin recibir el diccionario completo.
+Los valores se leen con getDictionaries, que los guarda en disco junto al DDL.
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+"""
+
+import re
+import threading
+import time
+import unicodedata
+
+from addons.chatagent_prototype.gvsigdesktop.schemaindex import STOPWORDS
+
+MAX_PHRASE_WORDS = 4
+
+def normalize_label(text):
+    """
+    Normaliza un texto para compararlo: minúsculas, sin tildes y solo letras y
+    números separados por un espacio.
+    """
+    if text is None:
+        return u""
+    text = unicodedata.normalize("NFKD", unicode(text).lower())
+    text = u"".join([c for c in text if not unicodedata.combining(c)])
+    return u" ".join(re.findall(r"[a-z0-9]+", text))
+
+def trigrams(text):
+    """
+    Devuelve el conjunto de trigramas de un texto ya normalizado.
+    """
+    text = u"  %s " % text
+    return set([text[n:n + 3] for n in range(len(text) - 2)])
+
+
+class DictionaryIndex:
+    """
+    Índice de trigramas de las etiquetas de los diccionarios. Cada entrada se
+    puntúa con el coeficiente de Dice entre sus trigramas y los de cada frase
+    de hasta MAX_PHRASE_WORDS palabras de la petición.
+    """
+
+    def __init__(self, dictionaries):
+        """
+        Args:
+            dictionaries (dict): Tabla -> (nombre de la clave, lista de pares (clave, etiqueta)),
+                                 como los devuelve getDictionaries.
+        """
+        self.entries = []  # (tabla, nombre de la clave, clave, etiqueta, número de trigramas)
+        self.postings = {}  # Trigrama -> posiciones de las entradas
+        for table in sorted(dictionaries.keys()):
+            keyname, values = dictionaries[table]
+            for key, label in values:
+                grams = trigrams(normalize_label(label))
+                if not grams:
+                    continue
+                position = len(self.entries)
+                self.entries.append((table, keyname, key, label, len(grams)))
+                for gram in grams:
+                    self.postings.setdefault(gram, []).append(position)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def match(self, text, max_matches=10, min_score=0.6, tables=None):
+        """
+        Busca en el índice las entradas que coinciden con algún término del texto.
+
+        Args:
+            text (str): La petición del usuario.
+            max_matches (int, optional): Número máximo de entradas a devolver.
+            min_score (float, optional): Similitud mínima (0 a 1) para considerar que coinciden.
+            tables (list, optional): Limitar la búsqueda a estos diccionarios.
+
+        Returns:
+            list: Tuplas (tabla, nombre de la clave, clave, etiqueta, similitud) de mayor a menor similitud.
+        """
+        words = normalize_label(text).split()
+        best = {}  # Posición de la entrada -> mejor similitud
+        for size in range(1, MAX_PHRASE_WORDS + 1):
+            for start in range(len(words) - size + 1):
+                phrase = words[start:start + size]
+                if phrase[0] in STOPWORDS or phrase[-1] in STOPWORDS or len(u" ".join(phrase)) < 3:
+                    continue
+                grams = trigrams(u" ".join(phrase))
+                hits = {}
+                for gram in grams:
+                    for position in self.postings.get(gram, ()):
+                        hits[position] = hits.get(position, 0) + 1
+                for position, count in hits.items():
+                    score = 2.0 * count / (len(grams) + self.entries[position][4])
+                    if score >= min_score and score > best.get(position, 0):
+                        best[position] = score
+        matches = []
+        for position, score in sorted(best.items(), key=lambda item: (-item[1], item[0])):
+            table, keyname, key, label, size = self.entries[position]
+            if tables is not None and table not in tables:
+                continue
+            matches.append((table, keyname, key, label, score))
+            if len(matches) >= max_matches:
+                break
+        return matches
+
+
+def format_matches(matches):
+    """
+    Devuelve las entradas encontradas como texto para incluirlo en la petición,
+    agrupadas por diccionario.
+    """
+    lines = []
+    current = None
+    for table, keyname, key, label, score in sorted(matches, key=lambda m: (m[0], -m[4])):
+        if table != current:
+            lines.append(u"-- Diccionario: %s (clave '%s')" % (table, keyname))
+            current = table
+        lines.append(u"--   %s: %s" % (key, label))
+    return u"\n".join(lines)
+
+
+_indexes = {}  # Modelo de datos -> DictionaryIndex
+_indexes_lock = threading.Lock()
+
+def get_dictionary_index(modelName, min_entries=0):
+    """
+    Devuelve el índice de los diccionarios del modelo de datos con más de
+    min_entries valores, construyéndolo la primera vez que se pide.
+    """
+    from addons.chatagent_prototype.gvsigdesktop.utils import getDictionaries
+    _indexes_lock.acquire()
+    try:
+        index = _indexes.get((modelName, min_entries))
+        if index is None:
+            dictionaries = dict([(table, value) for table, value in getDictionaries(modelName).items()
+                                 if len(value[1]) > min_entries])
+            index = DictionaryIndex(dictionaries)
+            _indexes[(modelName, min_entries)] = index
+        return index
+    finally:
+        _indexes_lock.release()
+
+def invalidate_dictionary_index(modelName):
+    """
+    Descarta los índices del modelo de datos; se construirán de nuevo al pedirlos.
+    """
+    _indexes_lock.acquire()
+    try:
+        for key in [key for key in _indexes.keys() if key[0] == modelName]:
+            del _indexes[key]
+    finally:
+        _indexes_lock.release()
+
+
+def benchmark_dictionary_index(entries=8000, lookups=200):
+    """
+    Mide la construcción del índice y la búsqueda sobre un diccionario sintético
+    del tamaño de uno de municipios.
+    """
+    words = (u"San", u"Villa", u"Torre", u"Puebla", u"Vall", u"Benicàssim", u"Alcalà",
+             u"Castellón", u"Onda", u"Vinaròs", u"del", u"Río", u"Nueva", u"Alta", u"Baja")
+    values = [(n, u"%s %s %d" % (words[n % len(words)], words[(n * 7) % len(words)], n)) for n in range(entries)]
+    start = time.time()
+    index = DictionaryIndex({"municipios": ("id", values)})
+    build_ms = (time.time() - start) * 1000.0
+    start = time.time()
+    found = 0
+    for n in range(lookups):
+        label = values[(n * 37) % entries][1]
+        if index.match(u"¿Cuántas parcelas hay en %s?" % label.lower(), 5):
+            found += 1
+    query_ms = (time.time() - start) * 1000.0 / lookups
+    print "Diccionario de %d valores: indice %.1f ms, busqueda %.2f ms, %d/%d encontrados" % (
+        entries, build_ms, query_ms, found, lookups)
+
+
+def main(**args):
+  benchmark_dictionary_index()
+  print "Ok"
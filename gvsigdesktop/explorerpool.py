@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: explorerpool
+
+Descripción:
+Pool de exploradores del servidor (y de sus conexiones JDBC) por modelo de datos.
+Abrir un explorador para cada consulta obliga a establecer la conexión cada vez;
+el pool mantiene abiertos entre min_size y max_size exploradores por modelo,
+los comprueba con una consulta trivial antes de prestarlos si llevan tiempo sin
+usarse, cierra los que sobran tras un tiempo ociosos y hace esperar, como mucho
+borrow_timeout, a quien pide uno cuando todos están en uso.
+Lo comparten executeSQL (procesadores de SQL y de gráficos) y getDDL.
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+
+Uso:
+    with borrowed_explorer(data_model) as server:
+        server.execute(sql)
+"""
+
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+from java.util import Timer, TimerTask
+from org.gvsig.fmap.dal import DALLocator
+from org.gvsig.tools.dispose import DisposeUtils
+
+from addons.chatagent_prototype import config
+
+
+class ExplorerPoolTimeout(Exception):
+    """
+    No se ha podido obtener un explorador del pool en el tiempo de espera.
+    """
+    pass
+
+
+class ExplorerPool:
+    """
+    Pool de exploradores del servidor de un modelo de datos.
+    Es seguro usarlo desde varios hilos.
+    """
+
+    def __init__(self, data_model, min_size=None, max_size=None, idle_timeout=None, borrow_timeout=None, validate_after=None):
+        """
+        Args:
+            data_model (str): El identificador del modelo de datos.
+            min_size (int, optional): Exploradores que se mantienen abiertos aunque estén ociosos.
+                                      Por defecto config.EXPLORER_POOL_MIN_SIZE.
+            max_size (int, optional): Máximo de exploradores abiertos. Por defecto config.EXPLORER_POOL_MAX_SIZE.
+            idle_timeout (float, optional): Segundos ocioso tras los que se cierra un explorador
+                                            que excede min_size. Por defecto config.EXPLORER_POOL_IDLE_TIMEOUT.
+            borrow_timeout (float, optional): Segundos máximos de espera por un explorador libre.
+                                              Por defecto config.EXPLORER_POOL_BORROW_TIMEOUT.
+            validate_after (float, optional): Segundos ocioso a partir de los que se comprueba
+                                              un explorador antes de prestarlo. Por defecto
+                                              config.EXPLORER_POOL_VALIDATE_AFTER.
+        """
+        if min_size is None:
+            min_size = config.EXPLORER_POOL_MIN_SIZE
+        if max_size is None:
+            max_size = config.EXPLORER_POOL_MAX_SIZE
+        if idle_timeout is None:
+            idle_timeout = config.EXPLORER_POOL_IDLE_TIMEOUT
+        if borrow_timeout is None:
+            borrow_timeout = config.EXPLORER_POOL_BORROW_TIMEOUT
+        if validate_after is None:
+            validate_after = config.EXPLORER_POOL_VALIDATE_AFTER
+        self.data_model = data_model
+        self.min_size = min_size
+        self.max_size = max(1, max_size)
+        self.idle_timeout = idle_timeout
+        self.borrow_timeout = borrow_timeout
+        self.validate_after = validate_after
+        self.condition = threading.Condition(threading.Lock())
+        self.idle = []  # Pares (explorador, instante en que se devolvió), el más reciente al final
+        self.size = 0  # Exploradores abiertos, prestados u ociosos
+        self.closed = False
+        self.signature = None  # Parámetros de conexión con los que se abrió el primer explorador
+        self.stats = {
+            "created": 0,
+            "destroyed": 0,
+            "borrows": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "failed_validations": 0,
+            "wait_ms_total": 0,
+            "wait_ms_max": 0
+        }
+
+    def borrow(self, timeout=None):
+        """
+        Presta un explorador; hay que devolverlo con release.
+
+        Raises:
+            ExplorerPoolTimeout: Si no queda ninguno libre en el tiempo de espera.
+        """
+        if timeout is None:
+            timeout = self.borrow_timeout
+        start = time.time()
+        waited = False
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.idle and self.size >= self.max_size:
+                    remaining = timeout - (time.time() - start)
+                    if remaining <= 0:
+                        self.stats["timeouts"] += 1
+                        raise ExplorerPoolTimeout(
+                            u"No hay conexiones libres con el modelo de datos '%s' tras esperar %s s" % (self.data_model, timeout))
+                    waited = True
+                    self.condition.wait(remaining)
+                if self.idle:
+                    server, returned = self.idle.pop()
+                else:
+                    server, returned = None, None
+                    self.size += 1  # Se reserva el hueco antes de abrirlo fuera del cerrojo
+            finally:
+                self.condition.release()
+
+            if server is None:
+                try:
+                    server = self._open()
+                except:
+                    self._discard(None)
+                    raise
+            elif time.time() - returned >= self.validate_after and not self._validate(server):
+                self._discard(server)
+                continue
+            self._count_borrow(start, waited)
+            return server
+
+    def release(self, server, broken=False, suspect=False):
+        """
+        Devuelve un explorador prestado. Si 'broken' es True, o el pool está
+        cerrado, se cierra en lugar de guardarlo. Si 'suspect' es True se
+        comprobará antes de volver a prestarlo.
+        """
+        if broken or self.closed:
+            self._discard(server)
+            return
+        self.condition.acquire()
+        try:
+            self.idle.append((server, 0 if suspect else time.time()))
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def prefill(self):
+        """
+        Abre exploradores hasta tener min_size.
+        """
+        while True:
+            self.condition.acquire()
+            try:
+                if self.size >= self.min_size:
+                    return
+                self.size += 1
+            finally:
+                self.condition.release()
+            try:
+                server = self._open()
+            except:
+                self._discard(None)
+                raise
+            self.release(server)
+
+    def evict_idle(self):
+        """
+        Cierra los exploradores que llevan más de idle_timeout ociosos y exceden min_size.
+        """
+        now = time.time()
+        evicted = []
+        self.condition.acquire()
+        try:
+            keep = []
+            for server, returned in self.idle:
+                # self.idle va del más antiguo al más reciente
+                excess = self.size - len(evicted) > self.min_size
+                if excess and now - returned >= self.idle_timeout:
+                    evicted.append(server)
+                else:
+                    keep.append((server, returned))
+            self.idle = keep
+        finally:
+            self.condition.release()
+        for server in evicted:
+            self._discard(server)
+        return len(evicted)
+
+    def close(self):
+        """
+        Cierra los exploradores ociosos; los prestados se cierran al devolverlos.
+        """
+        self.condition.acquire()
+        try:
+            self.closed = True
+            idle = [server for server, returned in self.idle]
+            self.idle = []
+        finally:
+            self.condition.release()
+        for server in idle:
+            self._discard(server)
+
+    def get_stats(self):
+        """
+        Devuelve las estadísticas del pool.
+
+        Returns:
+            dict: Con las claves size, idle, in_use, min_size, max_size, created, destroyed,
+                  borrows, waits, timeouts, failed_validations, wait_ms_avg y wait_ms_max.
+        """
+        self.condition.acquire()
+        try:
+            stats = dict(self.stats)
+            stats["size"] = self.size
+            stats["idle"] = len(self.idle)
+            stats["in_use"] = self.size - len(self.idle)
+        finally:
+            self.condition.release()
+        stats["min_size"] = self.min_size
+        stats["max_size"] = self.max_size
+        stats["wait_ms_avg"] = stats["wait_ms_total"] / stats["borrows"] if stats["borrows"] else 0
+        del stats["wait_ms_total"]
+        return stats
+
+    def _open(self):
+        dataManager = DALLocator.getDataManager()
+        repo = dataManager.getStoresRepository().getSubrepository(self.data_model)
+        try:
+            serverparams = repo.getServerParameters()
+            server = dataManager.openServerExplorer(serverparams.getProviderName(), serverparams)
+        finally:
+            DisposeUtils.dispose(repo)
+        self.condition.acquire()
+        try:
+            self.stats["created"] += 1
+            if self.signature is None:
+                self.signature = parameters_signature(serverparams)
+        finally:
+            self.condition.release()
+        return server
+
+    def _validate(self, server):
+        try:
+            r = server.execute("SELECT 1")
+            if hasattr(r, "close"):
+                r.close()
+            return True
+        except:
+            print u"Advertencia: conexión con el modelo de datos '%s' no válida, se abre otra. %s" % (self.data_model, sys.exc_info()[1])
+            self.condition.acquire()
+            try:
+                self.stats["failed_validations"] += 1
+            finally:
+                self.condition.release()
+            return False
+
+    def _discard(self, server):
+        if server is not None:
+            try:
+                DisposeUtils.dispose(server)
+            except:
+                pass
+        self.condition.acquire()
+        try:
+            self.size -= 1
+            if server is not None:
+                self.stats["destroyed"] += 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def _count_borrow(self, start, waited):
+        wait_ms = int((time.time() - start) * 1000)
+        self.condition.acquire()
+        try:
+            self.stats["borrows"] += 1
+            if waited:
+                self.stats["waits"] += 1
+            self.stats["wait_ms_total"] += wait_ms
+            self.stats["wait_ms_max"] = max(self.stats["wait_ms_max"], wait_ms)
+        finally:
+            self.condition.release()
+
+
+class _EvictionTask(TimerTask):
+    def run(self):
+        for pool in get_explorer_pools():
+            try:
+                pool.evict_idle()
+            except:
+                print u"Advertencia: error cerrando conexiones ociosas. %s" % sys.exc_info()[1]
+
+
+_pools = {}  # Modelo de datos -> ExplorerPool
+_pools_lock = threading.Lock()
+_eviction_timer = None
+
+def get_explorer_pool(data_model):
+    """
+    Devuelve el pool de exploradores del modelo de datos, creándolo si no existe.
+    """
+    global _eviction_timer
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(data_model)
+        if pool is None:
+            pool = ExplorerPool(data_model)
+            _pools[data_model] = pool
+            if _eviction_timer is None:
+                period = max(1000, int(config.EXPLORER_POOL_IDLE_TIMEOUT * 500))
+                _eviction_timer = Timer("chatagent-explorerpool", True)
+                _eviction_timer.schedule(_EvictionTask(), period, period)
+        return pool
+    finally:
+        _pools_lock.release()
+
+def get_explorer_pools():
+    _pools_lock.acquire()
+    try:
+        return list(_pools.values())
+    finally:
+        _pools_lock.release()
+
+def close_explorer_pool(data_model):
+    """
+    Cierra y olvida el pool del modelo de datos, por ejemplo si cambian sus parámetros de conexión.
+    """
+    _pools_lock.acquire()
+    try:
+        pool = _pools.pop(data_model, None)
+    finally:
+        _pools_lock.release()
+    if pool is not None:
+        pool.close()
+
+def parameters_signature(serverparams):
+    """
+    Devuelve un texto que identifica los parámetros de conexión de un explorador,
+    para saber si han cambiado desde que se abrieron los exploradores de un pool.
+    """
+    return u"%s %s" % (serverparams.getProviderName(), serverparams.toString())
+
+def _current_signature(data_model):
+    dataManager = DALLocator.getDataManager()
+    repo = dataManager.getStoresRepository().getSubrepository(data_model)
+    if repo is None:
+        return None
+    try:
+        return parameters_signature(repo.getServerParameters())
+    finally:
+        DisposeUtils.dispose(repo)
+
+def close_stale_explorer_pools(data_models):
+    """
+    Cierra los pools de los modelos de datos que ya no están disponibles o cuyos
+    parámetros de conexión han cambiado. Se llama al conectar o desconectar un
+    espacio de trabajo, para no seguir usando conexiones con el servidor anterior.
+
+    Args:
+        data_models (list): Los identificadores de los modelos de datos disponibles.
+
+    Returns:
+        list: Los modelos de datos cuyo pool se ha cerrado.
+    """
+    _pools_lock.acquire()
+    try:
+        pools = _pools.items()
+    finally:
+        _pools_lock.release()
+    closed = []
+    for data_model, pool in pools:
+        stale = data_model not in data_models
+        if not stale:
+            try:
+                stale = _current_signature(data_model) != pool.signature
+            except:
+                stale = True
+        if stale:
+            close_explorer_pool(data_model)
+            closed.append(data_model)
+    return closed
+
+@contextmanager
+def borrowed_explorer(data_model):
+    """
+    Presta un explorador del pool del modelo de datos durante el bloque 'with'.
+    Si el bloque lanza una excepción (por ejemplo, una SQL incorrecta) el
+    explorador se comprueba antes de volver a prestarlo, por si su conexión ha
+    quedado inservible.
+    """
+    pool = get_explorer_pool(data_model)
+    server = pool.borrow()
+    try:
+        yield server
+    except:
+        pool.release(server, suspect=True)
+        raise
+    else:
+        pool.release(server)
+
+def format_pool_stats():
+    """
+    Devuelve las estadísticas de todos los pools como una tabla de texto.
+    """
+    pools = get_explorer_pools()
+    if not pools:
+        return u"No hay conexiones abiertas con ningún modelo de datos."
+    lines = [u"%-20s %5s %5s %5s %7s %6s %8s %8s %8s" % (
+        u"modelo", u"abier", u"uso", u"max", u"prest", u"esper", u"timeout", u"esp. ms", u"max ms")]
+    for pool in sorted(pools, key=lambda p: p.data_model):
+        s = pool.get_stats()
+        lines.append(u"%-20s %5d %5d %5d %7d %6d %8d %8d %8d" % (
+            pool.data_model[:20], s["size"], s["in_use"], s["max_size"], s["borrows"],
+            s["waits"], s["timeouts"], s["wait_ms_avg"], s["wait_ms_max"]))
+    return u"\n".join(lines)
+
+
+def main(**args):
+  print format_pool_stats()
+  print "Ok"
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: querylimits
+
+Descripción:
+Límites y cancelación de las SQL que genera el modelo.
+Una SQL mal generada (por ejemplo, un producto cartesiano) puede tener ocupado
+un proceso de la base de datos y un hilo de gvSIG durante minutos. executeSQL
+lanza cada consulta en un Statement propio sobre la conexión JDBC del
+explorador, con un tiempo máximo (setQueryTimeout) y un número máximo de filas
+(setMaxRows) que aplica el driver, y la registra en un QueryHandle desde el que
+la ventana del chat puede cancelarla (Statement.cancel).
+Los límites se configuran en config.SQL_TIMEOUT y config.SQL_MAX_ROWS, y para
+cada modelo de datos en config.SQL_LIMITS.
+Las filas se leen del servidor en bloques de config.SQL_FETCH_SIZE. Con stream=True
+(solo para quien cierra siempre el ResultSet) en PostgreSQL las consultas se lanzan
+además fuera del modo autocommit, que es la condición del driver para no cargar
+todo el resultado en memoria al ejecutarlas.
+El explorador no vuelve al pool hasta que se cierra el ResultSet, ya que este
+sigue usando su conexión; si no se cierra, se libera cuando el recolector de
+basura lo descarta.
+Si el explorador no da acceso a su conexión JDBC la consulta se lanza con
+server.execute, limitando las filas con LIMIT pero sin tiempo máximo ni cancelación.
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+"""
+
+import math
+import re
+import sys
+import threading
+
+from java.lang import Class
+from java.sql import Connection, ResultSet, SQLException, SQLTimeoutException, Statement
+
+from addons.chatagent_prototype import config
+
+
+class QueryTimeout(Exception):
+    """
+    La consulta ha superado su tiempo máximo y se ha cancelado.
+    """
+    pass
+
+
+class QueryCancelled(Exception):
+    """
+    La consulta se ha cancelado a petición del usuario.
+    """
+    pass
+
+
+def get_query_limits(data_model):
+    """
+    Devuelve los límites de las consultas del modelo de datos.
+
+    Returns:
+        tuple: (tiempo máximo en segundos, número máximo de filas); 0 si no hay límite.
+    """
+    limits = config.SQL_LIMITS.get(data_model, {})
+    return (limits.get("timeout", config.SQL_TIMEOUT), limits.get("max_rows", config.SQL_MAX_ROWS))
+
+
+class QueryHandle:
+    """
+    Permite cancelar desde otro hilo la consulta a la que se asocia.
+    Si se cancela antes de que la consulta empiece, no llega a lanzarse.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statement = None
+        self.cancelled = False
+
+    def attach(self, statement):
+        self.lock.acquire()
+        try:
+            self.statement = statement
+            cancelled = self.cancelled
+        finally:
+            self.lock.release()
+        if cancelled:
+            self._cancel_statement(statement)
+
+    def detach(self, statement):
+        self.lock.acquire()
+        try:
+            if self.statement is statement:
+                self.statement = None
+        finally:
+            self.lock.release()
+
+    def cancel(self):
+        self.lock.acquire()
+        try:
+            self.cancelled = True
+            statement = self.statement
+        finally:
+            self.lock.release()
+        if statement is not None:
+            self._cancel_statement(statement)
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def _cancel_statement(self, statement):
+        try:
+            statement.cancel()
+        except:
+            print u"Advertencia: no se ha podido cancelar la consulta. %s" % sys.exc_info()[1]
+
+
+def _delegate(attr, name):
+    def method(self, *args):
+        return getattr(getattr(self, attr), name)(*args)
+    method.__name__ = name
+    return method
+
+def _delegate_missing(cls, interface, attr):
+    # Añade a la clase los métodos de la interfaz Java que no define, pasándolos
+    # al objeto de su atributo 'attr'
+    for name in set([method.getName() for method in Class.forName(interface).getMethods()]):
+        if name not in cls.__dict__:
+            setattr(cls, name, _delegate(attr, name))
+
+
+class _StatementResultSet(ResultSet):
+    # ResultSet que al cerrarse cierra también su Statement (si lo hay) y devuelve la conexión.
+    # Todos los métodos de java.sql.ResultSet salvo close, isClosed y getStatement se pasan
+    # al ResultSet del driver (ver _delegate_missing), de forma que el código de los
+    # gráficos puede usar cualquiera de ellos.
+    def __init__(self, resultSet, statement, release, handle):
+        self.resultSet = resultSet
+        self.statement = statement
+        self.release = release
+        self.handle = handle
+        self.closed = False
+
+    def getStatement(self):
+        if self.statement is None:
+            return None
+        return _ResultSetStatement(self)
+
+    def isClosed(self):
+        return self.closed
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.handle is not None:
+            self.handle.detach(self.statement)
+        try:
+            self.resultSet.close()
+            if self.statement is not None:
+                self.statement.close()
+        finally:
+            self.release()
+
+    def __del__(self):
+        # Red de seguridad: si quien lo ha recibido no lo cierra, la transacción y
+        # el explorador se liberan cuando el recolector de basura lo descarta
+        if not self.closed:
+            print u"Advertencia: se libera un resultado de una SQL que no se ha cerrado."
+            try:
+                self.close()
+            except:
+                pass
+
+
+class _ResultSetStatement(Statement):
+    # El Statement de un _StatementResultSet: cerrarlo cierra el ResultSet, que
+    # devuelve la conexión; el resto de métodos se pasan al Statement del driver
+    def __init__(self, resultSet):
+        self.resultSet = resultSet
+        self.statement = resultSet.statement
+
+    def close(self):
+        self.resultSet.close()
+
+    def isClosed(self):
+        return self.resultSet.isClosed()
+
+
+_delegate_missing(_StatementResultSet, "java.sql.ResultSet", "resultSet")
+_delegate_missing(_ResultSetStatement, "java.sql.Statement", "statement")
+
+
+def _jdbc_connection(server):
+    # Devuelve (conexión JDBC, función que la libera) del explorador, o None si no da acceso a ella
+    try:
+        connection = server.getHelper().getConnection()
+    except:
+        return None
+    if connection is None:
+        return None
+    wrapper = connection
+    if not isinstance(connection, Connection) and hasattr(connection, "get"):
+        connection = connection.get()  # JDBCConnection de gvSIG
+    if not isinstance(connection, Connection):
+        return None
+    def release():
+        try:
+            if hasattr(wrapper, "closeQuietly"):
+                wrapper.closeQuietly()
+            else:
+                wrapper.close()
+        except:
+            pass
+    return connection, release
+
+# Estados SQL con los que los drivers notifican que se ha superado el tiempo
+# máximo: 57014 (PostgreSQL, "canceling statement due to statement timeout")
+# y HYT00/HYT01 (ODBC y otros). Se comprueban además de SQLTimeoutException,
+# que no todos los drivers lanzan.
+TIMEOUT_SQL_STATES = ("57014", "HYT00", "HYT01")
+
+def _is_timeout(e):
+    if isinstance(e, SQLTimeoutException):
+        return True
+    try:
+        return e.getSQLState() in TIMEOUT_SQL_STATES
+    except:
+        return False
+
+def _is_query(sql):
+    return re.match(r"(?is)\s*(select|with)\b", sql) is not None
+
+def _begin_streaming(connection, sql):
+    # En PostgreSQL el driver solo lee el resultado por bloques (setFetchSize)
+    # fuera del modo autocommit. Devuelve la función que restaura la conexión.
+    try:
+        if not _is_query(sql) or not connection.getAutoCommit():
+            return None
+        if connection.getMetaData().getDatabaseProductName() != "PostgreSQL":
+            return None
+        connection.setAutoCommit(False)
+    except:
+        return None
+    def restore(ok=True):
+        # Termina la transacción de la consulta antes de volver al modo autocommit
+        try:
+            if ok:
+                connection.commit()
+            else:
+                connection.rollback()
+        except:
+            pass
+        try:
+            connection.setAutoCommit(True)
+        except:
+            print u"Advertencia: no se ha podido restaurar el modo autocommit de la conexion. %s" % sys.exc_info()[1]
+    return restore
+
+_fallback_warned = False
+
+def _execute_without_jdbc(server, sql, max_rows):
+    global _fallback_warned
+    if not _fallback_warned:
+        print u"Advertencia: el explorador no da acceso a su conexion JDBC; las SQL se lanzan sin tiempo maximo ni cancelacion."
+        _fallback_warned = True
+    sql = sql.strip().rstrip(";").strip()
+    if max_rows and _is_query(sql):
+        sql = u"SELECT * FROM (%s) AS chatagent_limit LIMIT %d" % (sql, max_rows)
+    return server.execute(sql)
+
+def execute_with_limits(server, sql, timeout=0, max_rows=0, handle=None, on_close=None, stream=False):
+    """
+    Lanza una SQL en el explorador con un tiempo máximo y un número máximo de filas.
+
+    Args:
+        server: El explorador del servidor, prestado por el pool.
+        sql (str): La consulta.
+        timeout (float, optional): Segundos máximos de ejecución; 0 sin límite.
+        max_rows (int, optional): Filas máximas que devuelve el driver; 0 sin límite.
+        handle (QueryHandle, optional): Para cancelar la consulta desde otro hilo.
+        on_close (callable, optional): Se llama al cerrar el ResultSet devuelto o,
+                                       si no se devuelve ninguno, antes de volver.
+                                       No se llama si se lanza una excepción.
+                                       executeSQL lo usa para devolver el explorador al pool.
+        stream (bool, optional): Leer el resultado por bloques también en PostgreSQL,
+                                 lo que deja abierta una transacción hasta cerrar el
+                                 ResultSet. Solo para quien lo cierra siempre.
+
+    Returns:
+        Un ResultSet (al cerrarlo se libera el Statement) o el número de filas modificadas.
+
+    Raises:
+        QueryTimeout: Si se supera el tiempo máximo.
+        QueryCancelled: Si se cancela con el handle.
+    """
+    if handle is not None and handle.is_cancelled():
+        raise QueryCancelled(u"Consulta cancelada")
+    jdbc = _jdbc_connection(server)
+    if jdbc is None:
+        result = _execute_without_jdbc(server, sql, max_rows)
+        if isinstance(result, ResultSet) and on_close is not None:
+            return _StatementResultSet(result, None, on_close, None)
+        if on_close is not None:
+            on_close()
+        return result
+    connection, release_connection = jdbc
+    restore = None
+    if stream:
+        restore = _begin_streaming(connection, sql)
+    def release():
+        try:
+            if restore is not None:
+                restore()
+            release_connection()
+        finally:
+            if on_close is not None:
+                on_close()
+    statement = None
+    try:
+        statement = connection.createStatement()
+        if timeout:
+            statement.setQueryTimeout(int(math.ceil(timeout)))
+        if max_rows:
+            statement.setMaxRows(max_rows)
+        if config.SQL_FETCH_SIZE:
+            statement.setFetchSize(config.SQL_FETCH_SIZE)
+        if handle is not None:
+            handle.attach(statement)
+        try:
+            has_result_set = statement.execute(sql)
+        except SQLException, e:
+            if handle is not None and handle.is_cancelled():
+                raise QueryCancelled(u"Consulta cancelada")
+            if timeout and _is_timeout(e):
+                raise QueryTimeout(u"La consulta ha superado el tiempo maximo de %s s" % timeout)
+            raise
+        if has_result_set:
+            # El Statement, la conexión y el explorador se liberan al cerrar el ResultSet
+            return _StatementResultSet(statement.getResultSet(), statement, release, handle)
+        count = statement.getUpdateCount()
+    except:
+        # Con una excepción el explorador lo devuelve el llamante (ver on_close)
+        _close_statement(statement, handle)
+        if restore is not None:
+            restore(False)
+        release_connection()
+        raise
+    _close_statement(statement, handle)
+    release()
+    return count
+
+def _close_statement(statement, handle):
+    if statement is None:
+        return
+    if handle is not None:
+        handle.detach(statement)
+    try:
+        statement.close()
+    except:
+        pass
+
+def main(**args):
+  print get_query_limits(None)
+  print "Ok"
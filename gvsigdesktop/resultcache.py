@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: resultcache
+
+Descripción:
+Cache en memoria de los resultados de las SQL que lanzan los procesadores de
+tablas y gráficos, indexada por el modelo de datos y la SQL normalizada.
+Los botones que se añaden a la barra de herramientas vuelven a lanzar la misma
+consulta en cada clic, y abrir la tabla y el gráfico de una misma pregunta la
+lanza dos veces. Cada resultado se guarda (como ColumnarResult) durante
+config.RESULT_CACHE_TTL segundos, y si se supera el tamaño máximo se descartan
+los usados hace más tiempo. Si se pide una consulta que ya está en curso, se
+espera a ella en lugar de lanzarla de nuevo (por ejemplo, con un doble clic en
+"Abrir"). Solo se guardan los resultados de las consultas (ColumnarResult)
+completos y de hasta config.RESULT_CACHE_MAX_ROWS filas. Las sentencias que
+modifican datos no se guardan, y al lanzarlas con executeSQL se descartan los
+resultados guardados de su modelo de datos.
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+
+Uso:
+    result = execute_cached(data_model, sql)
+"""
+
+import re
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+from java.sql import ResultSet
+
+from addons.chatagent_prototype import config
+from addons.chatagent_prototype.gvsigdesktop.columnar import ColumnarResult
+from addons.chatagent_prototype.gvsigdesktop.querylimits import QueryCancelled
+from addons.chatagent_prototype.gvsigdesktop.utils import executeSQL
+
+
+def normalize_sql(sql):
+    """
+    Normaliza una SQL para usarla como clave: sin espacios al principio y al
+    final, sin el ';' final y con cada serie de espacios, tabuladores y saltos
+    de línea fuera de las cadenas reducida a un espacio.
+    """
+    parts = re.split(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""", sql.strip().rstrip(";").strip())
+    for n in range(0, len(parts), 2):
+        parts[n] = re.sub(r"\s+", " ", parts[n])
+    return "".join(parts)
+
+
+class _Flight:
+    # Una consulta en curso y quienes esperan su resultado
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ResultCache:
+    """
+    Cache de resultados de SQL. Es segura para usarla desde varios hilos.
+    """
+
+    def __init__(self, ttl=None, max_bytes=None, max_entries=None, max_rows=None):
+        """
+        Args:
+            ttl (float, optional): Segundos que se conserva cada resultado. Por defecto config.RESULT_CACHE_TTL.
+            max_bytes (int, optional): Memoria máxima estimada de los resultados guardados.
+                                       Por defecto config.RESULT_CACHE_MAX_MB.
+            max_entries (int, optional): Número máximo de resultados guardados.
+                                         Por defecto config.RESULT_CACHE_MAX_ENTRIES.
+            max_rows (int, optional): Filas máximas de un resultado para guardarlo.
+                                      Por defecto config.RESULT_CACHE_MAX_ROWS.
+        """
+        if ttl is None:
+            ttl = config.RESULT_CACHE_TTL
+        if max_bytes is None:
+            max_bytes = config.RESULT_CACHE_MAX_MB * 1024 * 1024
+        if max_entries is None:
+            max_entries = config.RESULT_CACHE_MAX_ENTRIES
+        if max_rows is None:
+            max_rows = config.RESULT_CACHE_MAX_ROWS
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # Clave -> (resultado, bytes, instante de expiración), el usado más recientemente al final
+        self.flights = {}  # Clave -> _Flight de las consultas en curso
+        self.bytes = 0
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "evictions": 0
+        }
+
+    def get(self, data_model, sql, load, handle=None):
+        """
+        Devuelve el resultado guardado de la SQL. Si no lo hay, o ha caducado,
+        llama a load() para obtenerlo y lo guarda; si otro hilo ya está
+        obteniéndolo, espera a su resultado.
+
+        Args:
+            data_model (str): El modelo de datos.
+            sql (str): La consulta.
+            load (callable): Función sin argumentos que lanza la consulta.
+            handle (QueryHandle, optional): Si se cancela, se deja de esperar a la
+                                            consulta que ha lanzado otro hilo.
+
+        Returns:
+            El resultado de load().
+        """
+        key = (data_model, normalize_sql(sql))
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[2] > time.time():
+                    self.entries[key] = self.entries.pop(key)  # Pasa a ser el usado más recientemente
+                    self.stats["hits"] += 1
+                    return entry[0]
+                self._remove(key)
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self.flights[key] = flight
+                self.stats["misses"] += 1
+            else:
+                self.stats["coalesced"] += 1
+        finally:
+            self.lock.release()
+
+        if not leader:
+            while not flight.event.isSet():
+                if handle is not None and handle.is_cancelled():
+                    raise QueryCancelled(u"Consulta cancelada")
+                flight.event.wait(0.5)
+            if isinstance(flight.error, QueryCancelled):
+                # Se canceló la consulta de otro hilo, no la de este: se lanza de nuevo
+                return self.get(data_model, sql, load, handle)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = load()
+        except:
+            flight.error = sys.exc_info()[1]
+            raise
+        finally:
+            self.lock.acquire()
+            try:
+                del self.flights[key]
+                if flight.error is None and self._is_cacheable(flight.result):
+                    self._put(key, flight.result)
+            finally:
+                self.lock.release()
+            flight.event.set()
+        return flight.result
+
+    def invalidate(self, data_model=None):
+        """
+        Descarta los resultados guardados del modelo de datos, o todos si no se indica.
+        Las consultas en curso no se ven afectadas.
+        """
+        self.lock.acquire()
+        try:
+            for key in [key for key in self.entries.keys() if data_model is None or key[0] == data_model]:
+                self._remove(key)
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        """
+        Devuelve las estadísticas de la cache.
+
+        Returns:
+            dict: Con las claves entries, bytes, in_flight, hits, misses, coalesced y evictions.
+        """
+        self.lock.acquire()
+        try:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+            stats["bytes"] = self.bytes
+            stats["in_flight"] = len(self.flights)
+        finally:
+            self.lock.release()
+        return stats
+
+    def _is_cacheable(self, result):
+        # Solo resultados de consultas, completos y no demasiado grandes
+        return isinstance(result, ColumnarResult) and not result.truncated and \
+            result.get_row_count() <= self.max_rows
+
+    def _put(self, key, result):
+        size = result.estimate_bytes()
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (result, size, time.time() + self.ttl)
+        self.bytes += size
+        now = time.time()
+        for old_key in [old_key for old_key, entry in self.entries.items() if entry[2] <= now]:
+            self._remove(old_key)
+        while self.bytes > self.max_bytes or len(self.entries) > self.max_entries:
+            self._remove(self.entries.keys()[0])
+            self.stats["evictions"] += 1
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_result_cache():
+    """
+    Devuelve la cache de resultados compartida por toda la aplicación.
+    """
+    global _cache
+    if _cache is None:
+        _cache_lock.acquire()
+        try:
+            if _cache is None:
+                _cache = ResultCache()
+        finally:
+            _cache_lock.release()
+    return _cache
+
+def _execute(data_model, sql, handle, max_rows):
+    # from_result_set cierra siempre el ResultSet
+    result = executeSQL(data_model, sql, handle=handle, stream=True)
+    if isinstance(result, ResultSet):
+        return ColumnarResult.from_result_set(result, max_rows=max_rows or None)
+    return result
+
+def execute_cached(data_model, sql, handle=None, max_rows=None):
+    """
+    Ejecuta una SQL a través de la cache de resultados, con los límites del
+    modelo de datos. Con 'handle' (un QueryHandle) se puede cancelar.
+    Con 'max_rows' se leen solo las primeras filas, para no cargar en memoria
+    un resultado grande que se va a leer por otro camino (por ejemplo, por
+    páginas); un resultado guardado se devuelve entero aunque tenga más.
+    Con max_rows=0 se lee entero (hasta el máximo de filas del modelo de datos),
+    y solo se guarda si no pasa de config.RESULT_CACHE_MAX_ROWS filas.
+
+    Returns:
+        Un ColumnarResult si la consulta devuelve un ResultSet (con truncated a
+        True si tenía más de max_rows filas, por defecto config.RESULT_CACHE_MAX_ROWS;
+        entonces no se guarda), o el valor que devuelva executeSQL en otro caso,
+        que nunca se guarda.
+    """
+    if max_rows is None:
+        max_rows = config.RESULT_CACHE_MAX_ROWS
+    if not config.RESULT_CACHE_ENABLED:
+        return _execute(data_model, sql, handle, max_rows)
+    return get_result_cache().get(data_model, sql, lambda: _execute(data_model, sql, handle, max_rows), handle)
+
+def invalidate_results(data_model=None):
+    """
+    Descarta los resultados guardados del modelo de datos, o todos si no se indica.
+    """
+    get_result_cache().invalidate(data_model)
+
+def format_result_cache_stats():
+    """
+    Devuelve las estadísticas de la cache de resultados como texto.
+    """
+    s = get_result_cache().get_stats()
+    return u"%d resultados guardados (%.1f MB), %d aciertos, %d fallos, %d consultas repetidas en curso, %d descartados" % (
+        s["entries"], s["bytes"] / 1048576.0, s["hits"], s["misses"], s["coalesced"], s["evictions"])
+
+
+def main(**args):
+  print format_result_cache_stats()
+  print "Ok"
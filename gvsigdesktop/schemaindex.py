@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: schemaindex
+
+Descripción:
+Índice local del esquema de un modelo de datos para seleccionar las tablas
+relacionadas con una pregunta.
+Cada tabla se indexa como un documento con su nombre, su etiqueta y
+descripción, los nombres, etiquetas y descripciones de sus columnas y los
+nombres de las tablas vecinas en el grafo de claves ajenas, todo ello obtenido
+de repo.getFeatureType sin acceder a los datos. Las preguntas se puntúan con
+BM25 y se seleccionan las mejores tablas más las que alcanzan por sus claves
+ajenas (cierre transitivo), que son las que luego necesita el modelo para
+construir los JOIN o interpretar los diccionarios.
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+"""
+
+import math
+import re
+import threading
+import time
+import unicodedata
+
+from org.gvsig.fmap.dal import DALLocator
+from org.gvsig.tools.dispose import DisposeUtils
+
+# Peso de cada campo en el documento de una tabla
+NAME_WEIGHT = 3
+LABEL_WEIGHT = 2
+COLUMN_WEIGHT = 1
+NEIGHBOUR_WEIGHT = 1
+
+STOPWORDS = set(u"""
+a al algun alguna algunos cada como con cual cuales cuando cuanta cuantas cuanto
+cuantos da dame de del desde donde dime e el en entre es esta estan este estos ha
+hay la las lo los me mas muestra muestrame o para pero por que quien se sin sobre
+su sus tiene tienen todo todos un una uno unos y
+""".split())
+
+def tokenize(text):
+    """
+    Divide un texto en términos para el índice: separa los identificadores en
+    mayúsculas/minúsculas y con guiones bajos, elimina tildes y palabras vacías,
+    y reduce cada palabra a una raíz aproximada (sin la "s" final y con como
+    máximo seis letras) para que coincidan singulares y plurales.
+    """
+    if not text:
+        return []
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", unicode(text))
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = u"".join([c for c in text if not unicodedata.combining(c)])
+    terms = []
+    for word in re.findall(r"[a-z0-9]+", text):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s"):
+            word = word[:-1]
+        terms.append(word[:6])
+    return terms
+
+
+class SchemaIndex:
+    """
+    Índice BM25 de las tablas de un modelo de datos.
+    """
+
+    def __init__(self, tables, k1=1.2, b=0.75):
+        """
+        Args:
+            tables (list): Un dict por tabla, en el orden del repositorio, con las claves
+                           name, label, description, columns (lista de tuplas
+                           (nombre, etiqueta, descripción)) y references (nombres de
+                           las tablas a las que apuntan sus claves ajenas).
+            k1 (float, optional): Saturación de la frecuencia de los términos.
+            b (float, optional): Normalización por la longitud del documento.
+        """
+        self.k1 = k1
+        self.b = b
+        self.tables = [table["name"] for table in tables]
+        self.positions = dict([(name, n) for n, name in enumerate(self.tables)])
+        self.labels = dict([(table["name"], table.get("label")) for table in tables])
+        self.references = dict([(table["name"], [ref for ref in table.get("references", []) if ref in self.positions])
+                                for table in tables])
+        referenced_by = dict([(name, []) for name in self.tables])
+        for name, references in self.references.items():
+            for ref in references:
+                referenced_by[ref].append(name)
+
+        self.postings = {}  # Término -> lista de (posición de la tabla, frecuencia ponderada)
+        self.lengths = []
+        for table in tables:
+            terms = {}
+            def add(text, weight):
+                for term in tokenize(text):
+                    terms[term] = terms.get(term, 0) + weight
+            add(table["name"], NAME_WEIGHT)
+            add(table.get("label"), LABEL_WEIGHT)
+            add(table.get("description"), LABEL_WEIGHT)
+            for column in table.get("columns", []):
+                for text in column:
+                    add(text, COLUMN_WEIGHT)
+            for neighbour in self.references[table["name"]] + referenced_by[table["name"]]:
+                add(neighbour, NEIGHBOUR_WEIGHT)
+            position = len(self.lengths)
+            for term, frequency in terms.items():
+                self.postings.setdefault(term, []).append((position, frequency))
+            self.lengths.append(sum(terms.values()))
+        self.average_length = float(sum(self.lengths)) / len(self.lengths) if self.lengths else 0.0
+
+    def __len__(self):
+        return len(self.tables)
+
+    def search(self, query, top_k=None):
+        """
+        Puntúa las tablas para una pregunta.
+
+        Returns:
+            list: Pares (tabla, puntuación) de las tablas con puntuación positiva,
+                  de mayor a menor; como mucho top_k si se indica.
+        """
+        count = len(self.tables)
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1.0 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for position, frequency in postings:
+                norm = self.k1 * (1.0 - self.b + self.b * self.lengths[position] / self.average_length)
+                scores[position] = scores.get(position, 0.0) + idf * frequency * (self.k1 + 1.0) / (frequency + norm)
+        ranking = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        if top_k is not None:
+            ranking = ranking[:top_k]
+        return [(self.tables[position], score) for position, score in ranking]
+
+    def select_tables(self, query, top_k):
+        """
+        Devuelve las top_k tablas más relacionadas con la pregunta más las que
+        se alcanzan desde ellas siguiendo las claves ajenas, en el orden del
+        repositorio. Si ninguna tabla está relacionada devuelve una lista vacía.
+        """
+        selected = set()
+        pending = [name for name, score in self.search(query, top_k)]
+        while pending:
+            name = pending.pop()
+            if name in selected:
+                continue
+            selected.add(name)
+            pending.extend(self.references[name])
+        return sorted(selected, key=lambda name: self.positions[name])
+
+    def catalog(self):
+        """
+        Devuelve la lista de tablas del modelo con su etiqueta, una por línea.
+        """
+        lines = []
+        for name in self.tables:
+            label = self.labels.get(name)
+            if label and label != name:
+                lines.append(u"- %s: %s" % (name, label))
+            else:
+                lines.append(u"- %s" % name)
+        return u"\n".join(lines)
+
+
+def _describe(obj, method):
+    # Etiquetas y descripciones son opcionales y no todas las versiones de gvSIG las tienen
+    try:
+        value = getattr(obj, method)()
+    except:
+        return None
+    if value is None:
+        return None
+    return unicode(value)
+
+def read_tables(repo):
+    """
+    Lee de un repositorio la información que indexa SchemaIndex.
+    """
+    tables = []
+    for name in repo.keySet():
+        ft = repo.getFeatureType(name)
+        columns = []
+        references = []
+        for attr in ft:
+            columns.append((attr.getName(), _describe(attr, "getLabel"), _describe(attr, "getDescription")))
+            if attr.isForeingKey():
+                references.append(attr.getForeingKey().getTableName())
+        tables.append({
+            "name": name,
+            "label": _describe(ft, "getLabel"),
+            "description": _describe(ft, "getDescription"),
+            "columns": columns,
+            "references": references
+        })
+    return tables
+
+
+_indexes = {}  # Modelo de datos -> SchemaIndex
+_indexes_lock = threading.Lock()
+
+def get_schema_index(modelName):
+    """
+    Devuelve el índice del esquema del modelo de datos, construyéndolo la
+    primera vez que se pide.
+    """
+    _indexes_lock.acquire()
+    try:
+        index = _indexes.get(modelName)
+        if index is None:
+            repo = None
+            try:
+                repo = DALLocator.getDataManager().getStoresRepository().getSubrepository(modelName)
+                index = SchemaIndex(read_tables(repo))
+            finally:
+                DisposeUtils.dispose(repo)
+            _indexes[modelName] = index
+        return index
+    finally:
+        _indexes_lock.release()
+
+def invalidate_schema_index(modelName):
+    """
+    Descarta el índice del modelo de datos; se construirá de nuevo al pedirlo.
+    """
+    _indexes_lock.acquire()
+    try:
+        _indexes.pop(modelName, None)
+    finally:
+        _indexes_lock.release()
+
+
+BENCHMARK_WORDS = (
+    u"municipio", u"provincia", u"carretera", u"parcela", u"edificio", u"rio", u"embalse",
+    u"estacion", u"sensor", u"incidencia", u"licencia", u"vivienda", u"calle", u"barrio",
+    u"colegio", u"hospital", u"farmacia", u"arbol", u"contenedor", u"farola", u"parada",
+    u"linea", u"tramo", u"obra", u"expediente", u"titular", u"empresa", u"actividad"
+)
+
+def _benchmark_tables(count):
+    # Tablas sintéticas: un nombre de dos palabras, diez columnas y claves
+    # ajenas a dos tablas anteriores y a uno de cinco diccionarios
+    tables = []
+    for n in range(count):
+        if n < 5:
+            name = u"dic_tipo_%s" % BENCHMARK_WORDS[n]
+            references = []
+        else:
+            name = u"%s_%s_%d" % (BENCHMARK_WORDS[n % len(BENCHMARK_WORDS)],
+                                  BENCHMARK_WORDS[(n * 7) % len(BENCHMARK_WORDS)], n)
+            references = [tables[(n * 3) % n]["name"], tables[(n * 5) % n]["name"], tables[n % 5]["name"]]
+        columns = [(u"%s_%d" % (BENCHMARK_WORDS[(n + c) % len(BENCHMARK_WORDS)], c), None, None) for c in range(10)]
+        tables.append({"name": name, "label": name.replace(u"_", u" "), "description": None,
+                       "columns": columns, "references": references})
+    return tables
+
+def _benchmark_ddl(table):
+    columns = u",\n    ".join([u'"%s" VARCHAR(100)' % column[0] for column in table["columns"]])
+    keys = u"".join([u',\n    FOREIGN KEY ("%s_id") REFERENCES "%s" ("id")' % (ref, ref) for ref in table["references"]])
+    return u'-- Tabla: %s tipo ENTIDAD\nCREATE TABLE "%s" (\n    "id" INTEGER NOT NULL PRIMARY KEY,\n    %s%s\n);\n\n' % (
+        table["name"], table["name"], columns, keys)
+
+def benchmark_schema_pruning(table_counts=(50, 100, 200, 400, 800), top_k=8):
+    """
+    Compara el tamaño de la sección de tablas del prompt con el DDL completo y
+    con la selección de tablas por pregunta, para modelos sintéticos de distinto
+    número de tablas.
+
+    Returns:
+        list: Un dict por tamaño de modelo con las claves tables, full_chars,
+              catalog_chars, turn_chars (media por pregunta), selected (media de
+              tablas por pregunta), build_ms y query_ms (media por pregunta).
+    """
+    questions = [u"¿Cuántas %ss hay en cada %s?" % (BENCHMARK_WORDS[n], BENCHMARK_WORDS[(n * 3) % len(BENCHMARK_WORDS)])
+                 for n in range(len(BENCHMARK_WORDS))]
+    results = []
+    print "%7s %12s %12s %12s %9s %9s %9s" % ("tablas", "DDL completo", "catalogo", "por turno", "tablas/t", "indice ms", "busq. ms")
+    for count in table_counts:
+        tables = _benchmark_tables(count)
+        ddl = dict([(table["name"], _benchmark_ddl(table)) for table in tables])
+        start = time.time()
+        index = SchemaIndex(tables)
+        build_ms = (time.time() - start) * 1000.0
+        turn_chars = 0
+        selected_count = 0
+        start = time.time()
+        for question in questions:
+            selected = index.select_tables(question, top_k)
+            selected_count += len(selected)
+            turn_chars += sum([len(ddl[name]) for name in selected])
+        query_ms = (time.time() - start) * 1000.0 / len(questions)
+        result = {
+            "tables": count,
+            "full_chars": sum([len(text) for text in ddl.values()]),
+            "catalog_chars": len(index.catalog()),
+            "turn_chars": turn_chars / len(questions),
+            "selected": float(selected_count) / len(questions),
+            "build_ms": build_ms,
+            "query_ms": query_ms
+        }
+        results.append(result)
+        print "%(tables)7d %(full_chars)12d %(catalog_chars)12d %(turn_chars)12d %(selected)9.1f %(build_ms)9.1f %(query_ms)9.2f" % result
+    return results
+
+
+def main(**args):
+  benchmark_schema_pruning()
+  print "Ok"
@@ -7,11 +7,13 @@ from java.lang import StringBuilder
 from java.util import Properties
 from java.util import Collections
 from java.util import UUID
+from java.util.concurrent import Callable, Executors, ExecutionException
 
 from java.io import FileInputStream
 from java.io import File 
 from java.io import StringReader
 from java.net import URL 
+from java.sql import ResultSet
 
 from java.awt import Dimension
 from java.awt import GridBagConstraints
@@ -39,24 +41,61 @@ from org.gvsig.app import ApplicationLocator
 
 from org.gvsig.scripting.app.extension import ScriptingExtension
 
+from addons.chatagent_prototype.gvsigdesktop.ddlformat import COMPACT_LEGEND, render_compact_table, render_compact_dictionary, sample_values
+
 
 import os
 import json
+import time
 
 MODEL_NAME="TALLER_MODELOS_DATOS"
 
-def executeSQL(dataModel, sql):
+def executeSQL(dataModel, sql, timeout=None, max_rows=None, handle=None, stream=False):
+    """
+    Lanza una SQL contra el modelo de datos con un tiempo maximo y un numero
+    maximo de filas (ver gvsigdesktop/querylimits.py). Si no se indican se usan
+    los del modelo de datos; 0 es sin limite. Con 'handle' (un QueryHandle) la
+    consulta se puede cancelar desde otro hilo.
+    Si devuelve un ResultSet hay que cerrarlo: hasta entonces el explorador con
+    el que se ha lanzado no vuelve al pool. Con stream=True, solo para quien lo
+    cierra siempre (por ejemplo en un finally), el resultado se lee por bloques
+    tambien en PostgreSQL (ver querylimits).
+    """
     print "DEBUG: executeSQL dataModel: %s, SQL:  %s" % (dataModel, sql)
-    server = None
+    # Import diferido: explorerpool y querylimits importan config, que importa este modulo
+    from addons.chatagent_prototype.gvsigdesktop.explorerpool import get_explorer_pool
+    from addons.chatagent_prototype.gvsigdesktop.querylimits import get_query_limits, execute_with_limits
+    default_timeout, default_max_rows = get_query_limits(dataModel)
+    if timeout is None:
+      timeout = default_timeout
+    if max_rows is None:
+      max_rows = default_max_rows
+    pool = get_explorer_pool(dataModel)
+    server = pool.borrow()
     try:
-      dataManager =  DALLocator.getDataManager()
-      repo = dataManager.getStoresRepository().getSubrepository(dataModel)
-      serverparams = repo.getServerParameters()
-      server = dataManager.openServerExplorer(serverparams.getProviderName(), serverparams)    
-      r = server.execute(sql)
-      return r
-    finally:
-      DisposeUtils.dispose(server)
+      result = execute_with_limits(server, sql, timeout, max_rows, handle, lambda: pool.release(server), stream)
+    except:
+      # El explorador se comprueba antes de volver a prestarlo, por si su conexion ha quedado inservible
+      pool.release(server, suspect=True)
+      raise
+    if not isinstance(result, ResultSet):
+      # La sentencia ha podido modificar datos: los resultados guardados del modelo ya no valen.
+      # Import diferido: resultcache importa este modulo
+      from addons.chatagent_prototype.gvsigdesktop.resultcache import invalidate_results
+      invalidate_results(dataModel)
+    return result
+
+def checkDataModelConnection(dataModel):
+  """
+  Abre las conexiones minimas del pool de exploradores del modelo de datos y
+  lanza una consulta trivial, de forma que la conexion queda establecida y
+  comprobada antes de la primera SQL del usuario.
+  """
+  from addons.chatagent_prototype.gvsigdesktop.explorerpool import get_explorer_pool
+  get_explorer_pool(dataModel).prefill()
+  r = executeSQL(dataModel, "SELECT 1")
+  if hasattr(r, "close"):
+    r.close()
 
 def showPanel(panel, title):
     manager = ToolsSwingLocator.getWindowManager()
@@ -75,46 +114,264 @@ def __getValuesOfDic(repo, table, fk):
       key = f.get(keyname)
       value = fk.getLabel(None,f)
       d[key] = value
-    s = json.dumps(d, indent=2,ensure_ascii=False,sort_keys=True)
-    return (keyname,s)
+    return (keyname,sorted(d.items()))
   except Exception as e:
     print "Error obteniendo los valores del diccionario '%s'. %s" % (table, str(e))
     return None
   finally:
     DisposeUtils.dispose(store)
-    
-def getDDL(modelName=MODEL_NAME, include_datadicts=True):
-  server = None
+
+def __renderDictionary(table, keyname, values, sampleSize):
+  # Los diccionarios grandes se muestran con una muestra repartida entre todos sus valores;
+  # los que coinciden con cada peticion se envian con ella (ver dictindex)
+  header = "-- Diccionario: %s\n-- La clave de este diccionario es el valor de la columna '%s'\n-- IMPORTANTE: Las claves del diccionario son los unicos valores permitidos para referenciar al campo '%s'\n" % (table, keyname, keyname)
+  sample = sample_values(values, sampleSize)
+  if len(sample) < len(values):
+    header += "-- Este diccionario tiene muchos valores y solo se muestran algunos. Los que coincidan con la peticion del usuario se indicaran junto a ella.\n"
+  s = json.dumps(dict(sample), indent=2,ensure_ascii=False,sort_keys=True)
+  return header + "-- Valores: %s\n" % s.replace("\n","\n-- ") + "\n"
+
+def getDDL(modelName=MODEL_NAME, include_datadicts=True, use_cache=None, tables=None, ddl_format=None):
+  """
+  Devuelve el DDL de las tablas del modelo de datos.
+  Con config.DDL_CACHE_ENABLED (o use_cache=True) se reutiliza el generado
+  anteriormente mientras no cambie la huella del esquema (ver ddlcache).
+  En cualquier caso el DDL se guarda en memoria para la sesión; revalidateDDL
+  (al seleccionar el modelo de datos) hace que se compruebe de nuevo la huella,
+  e invalidateDDL que se genere de nuevo.
+  Si se indica 'tables' solo se devuelve el de esas tablas, en el orden del modelo.
+  El formato ("sql" o "compact", ver ddlformat) es por defecto config.DDL_FORMAT.
+  """
+  ddl = __getFullDDL(modelName, include_datadicts, use_cache, ddl_format)
+  if tables is not None:
+    ddl = __filterDDL(ddl, tables)
+  return ddl
+
+def __filterDDL(ddl, tables):
+  # Cada tabla empieza con la linea "-- Tabla: <nombre> tipo ..." o, en el formato
+  # compacto, "@<nombre> ..." (ver __generateDDL); lo anterior a la primera tabla se conserva
+  tables = set(tables)
+  builder = StringBuilder()
+  include = True
+  for line in ddl.splitlines(True):
+    if line.startswith("-- Tabla: "):
+      include = line[len("-- Tabla: "):].split(" tipo ")[0] in tables
+    elif line.startswith("@"):
+      include = line[1:].split(" ")[0] in tables
+    if include:
+      builder.append(line)
+  return builder.toString()
+
+# DDL completos y diccionarios ya obtenidos en esta sesion. Calcular la huella
+# cuenta las filas de los diccionarios, asi que no se hace en cada peticion sino
+# al seleccionar el modelo de datos (revalidateDDL); invalidateDDL los descarta.
+__sessionDDLs = {}  # (modelo, include_datadicts, formato) -> DDL
+__sessionDictionaries = {}  # modelo -> diccionarios
+__sessionFingerprints = {}  # modelo -> ultima huella del esquema calculada
+
+def __checkFingerprint(modelName, fingerprint):
+  # Si el esquema ha cambiado desde la ultima comprobacion, lo obtenido a partir
+  # de el (el resto de DDL de la sesion y los indices) ya no vale
+  previous = __sessionFingerprints.get(modelName)
+  __sessionFingerprints[modelName] = fingerprint
+  if previous is not None and previous != fingerprint:
+    print "DEBUG: el esquema del modelo '%s' ha cambiado" % modelName
+    __forgetSession(modelName)
+    __invalidateIndexes(modelName)
+
+def __forgetSession(modelName):
+  for key in [key for key in __sessionDDLs.keys() if key[0] == modelName]:
+    __sessionDDLs.pop(key, None)
+  __sessionDictionaries.pop(modelName, None)
+
+def __invalidateIndexes(modelName):
+  from addons.chatagent_prototype.gvsigdesktop.schemaindex import invalidate_schema_index
+  from addons.chatagent_prototype.gvsigdesktop.dictindex import invalidate_dictionary_index
+  invalidate_schema_index(modelName)
+  invalidate_dictionary_index(modelName)
+
+def __getFullDDL(modelName, include_datadicts, use_cache, ddl_format):
+  # Import diferido: config importa este modulo
+  from addons.chatagent_prototype import config
+  from addons.chatagent_prototype.gvsigdesktop.ddlcache import get_ddl_cache, schema_fingerprint
+  if use_cache is None:
+    use_cache = config.DDL_CACHE_ENABLED
+  if ddl_format is None:
+    ddl_format = config.DDL_FORMAT
+  key = (modelName, include_datadicts, ddl_format)
+  if key in __sessionDDLs:
+    return __sessionDDLs[key]
+  repo = None
+  try:
+    dataManager =  DALLocator.getDataManager()
+    repo = dataManager.getStoresRepository().getSubrepository(modelName)
+    if not use_cache:
+      ddl = __generateDDL(repo, include_datadicts, ddl_format)[0]
+    else:
+      fingerprint = schema_fingerprint(repo)
+      __checkFingerprint(modelName, fingerprint)
+      ddl = get_ddl_cache().get(modelName, include_datadicts, fingerprint, ddl_format)
+      if ddl is not None:
+        print "DEBUG: getDDL '%s' leido de la cache" % modelName
+      else:
+        ddl = __generateAndCache(modelName, repo, include_datadicts, fingerprint, ddl_format)[0]
+    __sessionDDLs[key] = ddl
+    return ddl
+  finally:
+    DisposeUtils.dispose(repo)
+
+def getDictionaries(modelName=MODEL_NAME, use_cache=None):
+  """
+  Devuelve los valores de los diccionarios de lista cerrada del modelo de datos.
+  Se guardan en la cache de DDL junto al DDL y con la misma huella del esquema.
+
+  Returns:
+    dict: Tabla -> (nombre de la clave, lista de pares (clave, etiqueta) ordenada por clave).
+  """
+  from addons.chatagent_prototype import config
+  from addons.chatagent_prototype.gvsigdesktop.ddlcache import get_ddl_cache, schema_fingerprint
+  if use_cache is None:
+    use_cache = config.DDL_CACHE_ENABLED
+  if modelName in __sessionDictionaries:
+    return __sessionDictionaries[modelName]
   repo = None
   try:
     dataManager =  DALLocator.getDataManager()
     repo = dataManager.getStoresRepository().getSubrepository(modelName)
-    serverparams = repo.getServerParameters()
-    server = dataManager.openServerExplorer(serverparams.getProviderName(), serverparams)
+    if not use_cache:
+      dics = __generateDDL(repo, True, config.DDL_FORMAT)[1]
+    else:
+      fingerprint = schema_fingerprint(repo)
+      __checkFingerprint(modelName, fingerprint)
+      dics = get_ddl_cache().get_dictionaries(modelName, fingerprint)
+      if dics is None:
+        dics = __generateAndCache(modelName, repo, True, fingerprint, config.DDL_FORMAT)[1]
+    __sessionDictionaries[modelName] = dics
+    return dics
+  finally:
+    DisposeUtils.dispose(repo)
 
+def __generateAndCache(modelName, repo, include_datadicts, fingerprint, ddl_format):
+  from addons.chatagent_prototype.gvsigdesktop.ddlcache import get_ddl_cache
+  ddl, dics = __generateDDL(repo, include_datadicts, ddl_format)
+  get_ddl_cache().put(modelName, include_datadicts, fingerprint, ddl, ddl_format)
+  get_ddl_cache().put_dictionaries(modelName, fingerprint, dics)
+  return (ddl, dics)
+
+def invalidateDDL(modelName=MODEL_NAME):
+  """
+  Descarta el DDL guardado en la cache y los indices del esquema y de los
+  diccionarios del modelo de datos, de forma que la siguiente llamada a getDDL
+  vuelva a comprobar la huella del esquema y los genere de nuevo.
+  """
+  from addons.chatagent_prototype.gvsigdesktop.ddlcache import get_ddl_cache
+  __forgetSession(modelName)
+  __sessionFingerprints.pop(modelName, None)
+  get_ddl_cache().invalidate(modelName)
+  __invalidateIndexes(modelName)
+
+def revalidateDDL(modelName=MODEL_NAME):
+  """
+  Hace que la siguiente llamada a getDDL o getDictionaries vuelva a comprobar la
+  huella del esquema del modelo de datos. Si ha cambiado se generan de nuevo el
+  DDL, los diccionarios y los indices; si no, se leen de la cache en disco.
+  Sin la cache de DDL no hay huella que comprobar y se generan de nuevo.
+  """
+  from addons.chatagent_prototype import config
+  __forgetSession(modelName)
+  if not config.DDL_CACHE_ENABLED:
+    __invalidateIndexes(modelName)
+
+class _TimedTask(Callable):
+  # Tarea del pool de getDDL: ejecuta la funcion y devuelve (resultado, milisegundos)
+  def __init__(self, function, *args):
+    self.function = function
+    self.args = args
+
+  def call(self):
+    start = time.time()
+    result = self.function(*self.args)
+    return (result, int((time.time() - start) * 1000))
+
+def __runInPool(pool, tasks):
+  # Devuelve los resultados en el mismo orden que las tareas
+  results = list()
+  for future in pool.invokeAll(tasks):
+    try:
+      results.append(future.get())
+    except ExecutionException, e:
+      raise e.getCause()
+  return results
+
+def __getTableSQLs(repo, ddl_format, table):
+  # Import diferido: explorerpool importa config, que importa este modulo
+  from addons.chatagent_prototype.gvsigdesktop.explorerpool import borrowed_explorer
+  ft = repo.getFeatureType(table).getEditable()
+  dics = list()
+  for attr in ft:
+    if attr.isForeingKey():
+      # Nos aseguramos que se vayan a declarar las foreign keys
+      attr.getForeingKey().setEnsureReferentialIntegrity(True)
+      if attr.getForeingKey().isClosedList():
+        dics.append(attr.getForeingKey())
+  if ddl_format == "compact":
+    # Formato compacto: se construye a partir del tipo de entidad
+    return (ft, None, dics)
+  # Cada tarea usa su propio explorador del pool: no consta que se puedan usar desde varios hilos a la vez
+  with borrowed_explorer(repo.getID()) as server:
+    sqls = server.getCreateTableSQLs(
+      repo.getID(), 
+      "public", 
+       table, 
+       ft
+    )
+  return (ft, list(sqls), dics)
+
+def __generateDDL(repo, include_datadicts, ddl_format):
+  """
+  Genera el DDL del repositorio. La lectura de la estructura de las tablas y de
+  los valores de los diccionarios se reparte entre config.DDL_POOL_SIZE hilos,
+  cada uno con un explorador prestado por el pool del modelo de datos para
+  generar las sentencias CREATE TABLE; el resultado mantiene el orden de las
+  tablas del repositorio.
+  Devuelve el DDL en el formato indicado ("sql" o "compact") y los valores de
+  los diccionarios (ver getDictionaries).
+  """
+  from addons.chatagent_prototype import config
+  from addons.chatagent_prototype import tracing
+  pool = Executors.newFixedThreadPool(max(1, config.DDL_POOL_SIZE))
+  try:
+    start = time.time()
+
+    tables = list(repo.keySet())
+    tableResults = __runInPool(pool, [_TimedTask(__getTableSQLs, repo, ddl_format, table) for table in tables])
+
+    fks = dict()
+    for (ft, sqls, tableDics), ms in tableResults:
+      for fk in tableDics:
+        if not fks.has_key(fk.getTableName()):
+          fks[fk.getTableName()] = fk
+    dicNames = [table for table in tables if fks.has_key(table)]
+    dicNames.extend(sorted([name for name in fks.keys() if name not in dicNames]))
+    dicResults = __runInPool(pool, [_TimedTask(__getValuesOfDic, repo, name, fks[name]) for name in dicNames])
     dics = dict()
-    for table in repo.keySet():
-      ft = repo.getFeatureType(table).getEditable()
-      for attr in ft:
-        if attr.isForeingKey() and attr.getForeingKey().isClosedList() and not dics.has_key(attr.getForeingKey().getTableName()):
-          fk = attr.getForeingKey()
-          value = __getValuesOfDic(repo, fk.getTableName(), fk)
-          if value:
-            dics[fk.getTableName()] = value
+    dicTimes = dict()
+    for name, (value, ms) in zip(dicNames, dicResults):
+      dicTimes[name] = ms
+      if value:
+        dics[name] = value
 
     builder = StringBuilder()    
-    for table in repo.keySet():
-      ft = repo.getFeatureType(table).getEditable()
-      # Nos aseguramos que se vayan a declarar las foreign keys
-      for attr in ft:
-        if attr.isForeingKey():
-          attr.getForeingKey().setEnsureReferentialIntegrity(True)
-      sqls = server.getCreateTableSQLs(
-        repo.getID(), 
-        "public", 
-         table, 
-         ft
-      )
+    if ddl_format == "compact":
+      builder.append(COMPACT_LEGEND)
+    for table, ((ft, sqls, tableDics), ms) in zip(tables, tableResults):
+      tracing.record("ddl_table", ms, table=table, dictionary_ms=dicTimes.get(table))
+      if ddl_format == "compact":
+        builder.append(render_compact_table(table, ft, table in dics.keys()))
+        if include_datadicts and table in dics.keys():
+          pkname, values = dics[table]
+          builder.append(render_compact_dictionary(table, pkname, values, config.DICTIONARY_SAMPLE_SIZE))
+        continue
       if table in dics.keys():
         builder.append("-- Tabla: %s tipo DICCIONARIO\n" % table)
       else:
@@ -127,15 +384,15 @@ def getDDL(modelName=MODEL_NAME, include_datadicts=True):
         builder.append(sql)
         builder.append("\n")
       if include_datadicts and table in dics.keys():
-        pkname, json = dics[table]
-        builder.append("-- Diccionario: %s\n-- La clave de este diccionario es el valor de la columna '%s'\n-- IMPORTANTE: Las claves del diccionario son los unicos valores permitidos para referenciar al campo '%s'\n-- Valores: %s\n" % (table, pkname, pkname,json.replace("\n","\n-- "))+"\n")
+        pkname, values = dics[table]
+        builder.append(__renderDictionary(table, pkname, values, config.DICTIONARY_SAMPLE_SIZE))
       builder.append("\n")
-      
-    # Por ultimo devolvemos todas las SQL generadas 
-    return builder.toString()
+
+    print "DEBUG: getDDL %d tablas y %d diccionarios leidos en %d ms" % (len(tables), len(dicNames), int((time.time() - start) * 1000))
+    # Por ultimo devolvemos todas las SQL generadas y los valores de los diccionarios
+    return (builder.toString(), dics)
   finally:
-    DisposeUtils.dispose(repo)
-    DisposeUtils.dispose(server)
+    pool.shutdownNow()
 
 
 def getProperty(name):
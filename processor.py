@@ -23,6 +23,24 @@ class Processor:
         """
         raise NotImplementedError("El método process_response debe ser implementado por las subclases.")
 
+    def process_headless(self, data_model, user_query, json_response):
+        """
+        Procesa la respuesta JSON de la IA sin interfaz de usuario, para el modo
+        por lotes. Ejecuta la parte de la lógica del procesador que no necesita
+        el panel de chat (por ejemplo, la consulta SQL) y devuelve un resumen
+        del resultado.
+        Por defecto no hace nada; los procesadores con lógica propia deben sobrescribirlo.
+
+        Args:
+            data_model (str): El identificador del modelo de datos.
+            user_query (str): La pregunta del usuario.
+            json_response (javax.json.JsonObject): El objeto JSON devuelto por la IA.
+
+        Returns:
+            dict: Resumen del resultado, serializable a JSON.
+        """
+        return {}
+
     def get_type(self):
         """
         Devuelve el tipo de procesador.
@@ -53,6 +71,59 @@ class Processor:
         """
         raise NotImplementedError("El método get_description debe ser implementado por las subclases.")
 
+    def get_intent_keywords(self):
+        """
+        Devuelve palabras o expresiones que, si aparecen en la petición del
+        usuario, indican que probablemente la respuesta será de este tipo.
+        Las usa el enrutado de peticiones (aiclients.routing) para decidir sin
+        llamar al modelo si una petición necesita el modelo potente.
+
+        Returns:
+            list: Palabras clave en minúsculas; se comparan sin tildes.
+        """
+        return []
+
+    def get_response_schema(self):
+        """
+        Devuelve el esquema JSON (un dict con la sintaxis de JSON Schema) de los
+        campos de la respuesta de este procesador, sin incluir el campo 'type'.
+        Se usa para pedir al modelo una salida estructurada en lugar de extraer
+        el JSON de un bloque markdown.
+
+        Returns:
+            dict: El esquema de tipo "object" de la respuesta, o None si el
+                  procesador no declara esquema.
+        """
+        return None
+
+def build_response_schema(processors):
+    """
+    Construye el esquema JSON de la respuesta del modelo a partir de los
+    procesadores registrados. Es un objeto con el campo 'type', cuyos valores
+    posibles son los tipos de los procesadores, y la unión de los campos de
+    todos ellos.
+
+    Args:
+        processors (list): Las instancias de Processor registradas.
+
+    Returns:
+        dict: El esquema de la respuesta, o None si algún procesador no declara esquema.
+    """
+    types = []
+    properties = {}
+    for processor in sorted(processors, key=lambda p: p.get_type()):
+        schema = processor.get_response_schema()
+        if schema is None:
+            return None
+        types.append(processor.get_type())
+        properties.update(schema.get("properties", {}))
+    properties["type"] = {"type": "string", "enum": types}
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": ["type"]
+    }
+
 def main(**args):
   print "processor ok"
 
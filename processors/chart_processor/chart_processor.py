@@ -21,9 +21,13 @@ import org.knowm.xchart.style.lines
 import org.knowm.xchart.style.markers
 import org.knowm.xchart.style.theme
 
+from addons.chatagent_prototype import tracing
 from addons.chatagent_prototype.processor import Processor
 from addons.chatagent_prototype.utils import loadImageIntoLabel
 from addons.chatagent_prototype.gvsigdesktop.utils import executeSQL, showPanel, addToToolBar
+from addons.chatagent_prototype.gvsigdesktop.columnar import ColumnarResult
+from addons.chatagent_prototype.gvsigdesktop.resultcache import execute_cached
+from addons.chatagent_prototype.gvsigdesktop.querylimits import get_query_limits
 
 class ChartProcessor(Processor):
     """
@@ -36,6 +40,10 @@ class ChartProcessor(Processor):
     def get_description(self):
         return u"Genera graficos de barras o tartas a partir de los datos."
 
+    def get_intent_keywords(self):
+        return [u"grafico", u"grafica", u"graficos", u"graficas", u"barras", u"tarta",
+                u"histograma", u"chart"]
+
     def get_initial_prompt_info(self):
         return u"""
 == Consultas de tipo 'chart' ==
@@ -124,6 +132,37 @@ class ChartProcessor(Processor):
  }
 """
 
+    def get_response_schema(self):
+        return {
+            "type": "object",
+            "properties": {
+                "sql": {"type": "string"},
+                "result_set_schema": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "name": {"type": "string"},
+                            "type": {"type": "string"},
+                            "source_sql_type": {"type": "string"}
+                        },
+                        "required": ["name", "type"]
+                    }
+                },
+                "function": {"type": "string"},
+                "title": {"type": "string"}
+            },
+            "required": ["sql", "result_set_schema", "function", "title"]
+        }
+
+    def process_headless(self, data_model, user_query, json_response):
+        """
+        Ejecuta la consulta SQL y genera el gráfico sin mostrarlo.
+        """
+        warnings = []
+        chart = build_chart(data_model, json_response, warnings)
+        return {"sql": json_response.getString("sql"), "chart": chart.getClass().getSimpleName(), "warnings": warnings}
+
     def process_response(self, chat_panel, user_query, json_response):
         try:
             title = json_response.getString("title", u"Gráfico listo")
@@ -167,45 +206,15 @@ class ExecutionWorker(SwingWorker):
         self.chat_panel = chat_panel
         self.resultSet = None
         self.chart = None
+        self.warnings = []
         self.exception = None
 
     def doInBackground(self):
         try:
-            # Paso 1: Ejecutar la consulta SQL
-            sql_query = self.json.getString("sql")
-            self.resultSet = executeSQL(self.chat_panel.getDataModel(),sql_query)
-            if not self.resultSet:
-                raise Exception(u"La ejecución de la consulta SQL no devolvió un ResultSet.")
-
-            generate_chart_code = self.json.getString("function")
-
-            print "DEBUG: generate_char:\n",generate_chart_code
-            
-            # Paso 2 y 3: Ejecutar el código Jython para generar el gráfico
-            # Creamos un diccionario local para la ejecución del código
-            local_scope = {}
-            # Ejecutamos el código de la función en el ámbito local
-            exec generate_chart_code in globals(), local_scope
-
-            # Obtenemos la función generada y la llamamos con el ResultSet
-            generate_chart = local_scope.get("generate_chart")
-            if not generate_chart:
-                raise Exception(u"La función 'generate_chart' no se encontró en el código Jython proporcionado.")
-
-            self.chart = generate_chart(self.resultSet)
-            if not self.chart:
-                raise Exception(u"La función 'generate_chart' no devolvió un objeto Chart.")
-
+            self.chart = build_chart(self.chat_panel.getDataModel(), self.json, self.warnings)
         except Exception as e:
             self.exception = e
             print u"Error en doInBackground (ChartGenerationWorker): %s" % e
-        finally:
-            # Asegurarse de cerrar el ResultSet si no se hizo dentro de generate_chart
-            if self.resultSet:
-                try:
-                    self.resultSet.close()
-                except Exception as e:
-                    print u"Error al cerrar ResultSet en finally (ChartGenerationWorker): %s" % e
         return None
 
     def done(self):
@@ -219,12 +228,78 @@ class ExecutionWorker(SwingWorker):
                 chart_panel = XChartPanel(self.chart)
                 chart_panel.setPreferredSize(Dimension(800, 600)) # Tamaño preferido para la ventana
                 showPanel(chart_panel, title)
+                for warning in self.warnings:
+                    self.chat_panel.append_message(self.chat_panel.getAgentName(), u"'%s': %s" % (title, warning))
             else:
                 self.chat_panel.append_message(self.chat_panel.getAgentName(),u"La generación del gráfico no devolvió un Chart.")
         except Exception as e:
             self.chat_panel.append_message(self.chat_panel.getAgentName(),u"Error al mostrar el gráfico: %s" % e)
             print u"Error en done (ChartGenerationWorker): %s" % e
 
+def build_chart(data_model, json_response, warnings=None):
+    """
+    Ejecuta la consulta SQL de la respuesta y el código Jython de su campo
+    'function' para generar el gráfico. No necesita la interfaz de usuario.
+
+    Args:
+        data_model (str): El identificador del modelo de datos.
+        json_response (javax.json.JsonObject): La respuesta de tipo 'chart'.
+        warnings (list, optional): Se le añaden los avisos para el usuario, como
+                                   que el gráfico no incluye todas las filas.
+
+    Returns:
+        org.knowm.xchart.internal.chartpart.Chart: El gráfico generado.
+    """
+    resultSet = None
+    try:
+        # Paso 1: Ejecutar la consulta SQL
+        sql_query = json_response.getString("sql")
+        with tracing.span("sql", sql_chars=len(sql_query)):
+            # Se lee entero (hasta el máximo de filas del modelo de datos) con una sola
+            # ejecución; la cache solo lo guarda si es pequeño
+            result = execute_cached(data_model,sql_query,max_rows=0)
+            if not isinstance(result, ColumnarResult):
+                raise Exception(u"La ejecución de la consulta SQL no devolvió un ResultSet.")
+            if result.truncated:
+                # Se ha recibido el resultado de la misma consulta lanzada a la vez por la
+                # tabla, que solo lee su primera página
+                result = ColumnarResult.from_result_set(executeSQL(data_model,sql_query,stream=True))
+            max_rows = get_query_limits(data_model)[1]
+            if max_rows and result.get_row_count() >= max_rows:
+                warning = u"el gráfico se ha generado solo con las primeras %d filas (máximo de filas del modelo de datos)." % max_rows
+                print u"Advertencia: %s" % warning
+                if warnings is not None:
+                    warnings.append(warning)
+            resultSet = result.cursor()
+
+        generate_chart_code = json_response.getString("function")
+
+        print "DEBUG: generate_char:\n",generate_chart_code
+        
+        # Paso 2 y 3: Ejecutar el código Jython para generar el gráfico
+        # Creamos un diccionario local para la ejecución del código
+        local_scope = {}
+        # Ejecutamos el código de la función en el ámbito local
+        exec generate_chart_code in globals(), local_scope
+
+        # Obtenemos la función generada y la llamamos con el ResultSet
+        generate_chart = local_scope.get("generate_chart")
+        if not generate_chart:
+            raise Exception(u"La función 'generate_chart' no se encontró en el código Jython proporcionado.")
+
+        with tracing.span("render", kind="chart"):
+            chart = generate_chart(resultSet)
+        if not chart:
+            raise Exception(u"La función 'generate_chart' no devolvió un objeto Chart.")
+        return chart
+    finally:
+        # Asegurarse de cerrar el ResultSet si no se hizo dentro de generate_chart
+        if resultSet:
+            try:
+                resultSet.close()
+            except Exception as e:
+                print u"Error al cerrar ResultSet en finally (ChartGenerationWorker): %s" % e
+
 def main(**args):
   print "chart_processor ok"
 
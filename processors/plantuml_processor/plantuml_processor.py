@@ -16,6 +16,7 @@ from javax.swing import SwingWorker, JButton, JLabel
 from java.awt.event import ActionListener
 from java.awt.event import MouseAdapter, MouseEvent 
 
+from addons.chatagent_prototype import tracing
 from addons.chatagent_prototype.processor import Processor
 from addons.chatagent_prototype.utils import loadImageIntoLabel
 from addons.chatagent_prototype.gvsigdesktop.utils import showPanel, showImage, addToToolBar
@@ -37,6 +38,10 @@ class PlantUMLProcessor(Processor):
         """
         return u"Gestiona consultas generales que involucren la creacion de diagramas usando PlantUML."
 
+    def get_intent_keywords(self):
+        return [u"diagrama", u"diagramas", u"uml", u"plantuml", u"entidad relacion",
+                u"modelo de datos", u"relaciones entre"]
+
     def get_initial_prompt_info(self):
         """
         Devuelve la parte del prompt inicial que describe este procesador.
@@ -61,6 +66,28 @@ class PlantUMLProcessor(Processor):
   }
 """
 
+    def get_response_schema(self):
+        """
+        Devuelve el esquema JSON de los campos de la respuesta de este procesador.
+        """
+        return {
+            "type": "object",
+            "properties": {
+                "diagram": {"type": "string"},
+                "title": {"type": "string"}
+            },
+            "required": ["diagram", "title"]
+        }
+
+    def process_headless(self, data_model, user_query, json_response):
+        """
+        Genera la imagen del diagrama sin mostrarla.
+        """
+        diagram = json_response.getString("diagram")
+        with tracing.span("render", kind="plantuml", diagram_chars=len(diagram)):
+            image_path = generate_plantuml_image(diagram)
+        return {"diagram_chars": len(diagram), "image": image_path}
+
     def process_response(self, chat_panel, user_query, json_response):
         try:
             diagram = json_response.getString("diagram")
@@ -109,7 +136,8 @@ class ExecutionWorker(SwingWorker):
 
     def doInBackground(self):
         try:
-            self.image_path = generate_plantuml_image(self.diagram)
+            with tracing.span("render", kind="plantuml", diagram_chars=len(self.diagram)):
+                self.image_path = generate_plantuml_image(self.diagram)
         except Exception as e:
             self.exception = e
             print "Error en doInBackground (ExecutionWorker): %s" % e
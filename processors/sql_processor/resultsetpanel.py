@@ -6,12 +6,24 @@ import gvsig
 
 
 import java
+import re
+import sys
+import time
 
-from java.lang import String, Class, Object
+from collections import OrderedDict
+
+from java.lang import String, Class, Object, Runnable, Thread
 from java.awt import BorderLayout, Dimension, Font
-from javax.swing import JPanel, JTable, JScrollPane, BorderFactory
+from java.util.concurrent import Executors, ThreadFactory
+from java.awt.event import ActionListener
+from javax.swing import JPanel, JTable, JScrollPane, BorderFactory, SwingUtilities, Timer
 from javax.swing.table import AbstractTableModel
-from java.sql import ResultSet
+from java.sql import ResultSet, SQLException, Types
+
+from addons.chatagent_prototype import config
+from addons.chatagent_prototype.gvsigdesktop.utils import executeSQL
+from addons.chatagent_prototype.gvsigdesktop.columnar import ColumnarResult, ColumnarTableModel
+from addons.chatagent_prototype.gvsigdesktop.querylimits import get_query_limits
 
 
 class ResultSetTableModel(AbstractTableModel):
@@ -89,11 +101,363 @@ class ResultSetTableModel(AbstractTableModel):
             return Object.class
 
 
+def _read_rows(resultSet, numColumns, maxRows=None):
+    # Lee como mucho maxRows filas del ResultSet (todas si es None)
+    rows = []
+    while (maxRows is None or len(rows) < maxRows) and resultSet.next():
+        rows.append([resultSet.getObject(i) for i in range(1, numColumns + 1)])
+    return rows
+
+def _close(resultSet):
+    try:
+        resultSet.close()
+    except Exception as e:
+        print "Error al cerrar ResultSet: %s" % e
+
+def _strip_sql(sql):
+    # Para usar la consulta como subconsulta no puede acabar en ';'
+    return sql.strip().rstrip(";").strip()
+
+def _top_level(sql):
+    # Devuelve la SQL con las cadenas y lo que va entre paréntesis cambiado por
+    # espacios, para buscar en ella las cláusulas de la consulta principal
+    chars = []
+    depth = 0
+    quote = None
+    for c in sql:
+        if quote is not None:
+            if c == quote:
+                quote = None
+            chars.append(" ")
+        elif c in "'\"":
+            quote = c
+            chars.append(" ")
+        elif c == "(":
+            depth += 1
+            chars.append(" ")
+        elif c == ")":
+            depth = max(0, depth - 1)
+            chars.append(" ")
+        else:
+            chars.append(" " if depth else c)
+    return "".join(chars)
+
+# Tipos de columna por los que no siempre se puede ordenar (geometrías, json, blobs...)
+_UNSORTABLE_TYPES = (Types.OTHER, Types.JAVA_OBJECT, Types.DISTINCT, Types.STRUCT,
+    Types.ARRAY, Types.BLOB, Types.CLOB, Types.NCLOB, Types.REF, Types.DATALINK,
+    Types.SQLXML, Types.LONGVARBINARY)
+
+def _sortable_columns(metaData):
+    # Posiciones (desde 1) de las columnas por las que se puede ordenar
+    columns = []
+    for i in range(1, metaData.getColumnCount() + 1):
+        try:
+            column_type = metaData.getColumnType(i)
+        except SQLException, e:
+            print u"Advertencia: no se conoce el tipo de la columna %d; no se usa para ordenar las paginas. %s" % (i, e)
+            continue
+        if column_type not in _UNSORTABLE_TYPES:
+            columns.append(i)
+    return columns
+
+def _ordered_sql(sql, columns):
+    # Devuelve la consulta con un orden estable para poder leerla por páginas con
+    # LIMIT/OFFSET: su propio ORDER BY, si lo tiene, seguido de las columnas indicadas
+    # (por posición) para deshacer los empates.
+    top = _top_level(sql).lower()
+    order = list(re.finditer(r"\border\s+by\b", top))
+    ordinals = u", ".join([str(column) for column in columns])
+    if not order:
+        if not ordinals:
+            return u"SELECT * FROM (%s) AS chatagent_page" % sql
+        return u"SELECT * FROM (%s) AS chatagent_page ORDER BY %s" % (sql, ordinals)
+    if re.search(r"\b(limit|offset|fetch|for)\b", top[order[-1].end():]):
+        # Ya limita sus filas: se usa como subconsulta, manteniendo su orden
+        return u"SELECT * FROM (%s) AS chatagent_page" % sql
+    if not ordinals:
+        return sql
+    return u"%s, %s" % (sql, ordinals)
+
+
+class _DaemonThreadFactory(ThreadFactory):
+    def newThread(self, runnable):
+        thread = Thread(runnable, "chatagent-resultset")
+        thread.setDaemon(True)
+        return thread
+
+_page_executor = None
+
+def _get_page_executor():
+    global _page_executor
+    if _page_executor is None:
+        _page_executor = Executors.newFixedThreadPool(max(1, config.RESULTSET_PAGE_THREADS), _DaemonThreadFactory())
+    return _page_executor
+
+
+class _InvokeLater(Runnable):
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def run(self):
+        self.function(*self.args)
+
+
+class _PageTask(Runnable):
+    def __init__(self, model, page):
+        self.model = model
+        self.page = page
+
+    def run(self):
+        rows = None
+        failed = False
+        if self.model.is_page_wanted(self.page):
+            try:
+                rows = self.model.fetch_page(self.page)
+            except:
+                failed = True
+                print u"Advertencia: no se ha podido leer la pagina %d de los resultados. %s" % (self.page, sys.exc_info()[1])
+        SwingUtilities.invokeLater(_InvokeLater(self.model.page_loaded, self.page, rows, failed))
+
+
+class _RetryPageListener(ActionListener):
+    def __init__(self, model, page):
+        self.model = model
+        self.page = page
+
+    def actionPerformed(self, event=None):
+        self.model.retry_page(self.page)
+
+
+class _CountTask(Runnable):
+    def __init__(self, model):
+        self.model = model
+
+    def run(self):
+        try:
+            count = self.model.fetch_count()
+        except:
+            print u"Advertencia: no se ha podido contar las filas de los resultados. %s" % sys.exc_info()[1]
+            return
+        SwingUtilities.invokeLater(_InvokeLater(self.model.count_loaded, count))
+
+
+class PagedResultSetTableModel(AbstractTableModel):
+    """
+    Modelo de tabla que muestra el resultado de una SQL sin cargarlo entero en memoria.
+
+    Al construirlo (fuera del hilo de eventos de Swing) se lee la primera página
+    del ResultSet ya obtenido; si hay más filas, se vuelve a leer con la consulta
+    ordenada de forma estable (su propio ORDER BY seguido de todas las columnas
+    que se pueden ordenar), para que las páginas no se solapen ni dejen huecos.
+    El resto se piden en segundo plano, cuando el JTable las necesita al
+    desplazarse, volviendo a lanzar esa consulta con LIMIT/OFFSET; mientras
+    llegan sus celdas se muestran vacías. Una página que no se ha podido leer se
+    vuelve a pedir pasados config.RESULTSET_PAGE_RETRY segundos, el doble en cada
+    nuevo fallo. Solo se conservan las max_pages páginas usadas más recientemente.
+    El número total de filas se cuenta en segundo plano con un COUNT(*); hasta
+    entonces la tabla crece una página más allá de la última leída. Nunca muestra
+    más filas que el máximo de las consultas del modelo de datos.
+    Salvo el constructor, los métodos se usan desde el hilo de eventos de Swing.
+    """
+    def __init__(self, dataModel, sql, resultSet, page_size=None, max_pages=None, truncated=False, on_row_cap=None):
+        """
+        Args:
+            dataModel (str): El modelo de datos contra el que se lanza la consulta.
+            sql (str): La consulta SQL.
+            resultSet (ResultSet): El resultado de executeSQL para la consulta; se lee
+                                   su primera página y se cierra.
+            page_size (int, optional): Filas por página. Por defecto config.RESULTSET_PAGE_SIZE.
+            max_pages (int, optional): Páginas que se conservan en memoria. Por defecto config.RESULTSET_MAX_PAGES.
+            truncated (bool, optional): El resultSet tiene solo las primeras filas del
+                                        resultado (el cursor de un ColumnarResult truncado),
+                                        así que hay más aunque no queden en él.
+            on_row_cap (callable, optional): Se llama con el máximo de filas de las consultas
+                                             del modelo de datos si el resultado lo alcanza,
+                                             cuando se conoce el total (en el hilo de eventos de Swing).
+        """
+        if page_size is None:
+            page_size = config.RESULTSET_PAGE_SIZE
+        if max_pages is None:
+            max_pages = config.RESULTSET_MAX_PAGES
+        self.dataModel = dataModel
+        self.sql = _strip_sql(sql)
+        self.page_size = max(1, page_size)
+        self.max_pages = max(2, max_pages)
+        self.max_rows = get_query_limits(dataModel)[1]
+        self.on_row_cap = on_row_cap
+        self.columnNames = []
+        self.columnTypes = []
+        self.pages = OrderedDict()  # Número de página -> filas, la usada más recientemente al final
+        self.pending = set()
+        self.failed = {}  # Número de página -> (fallos seguidos, instante a partir del que se puede volver a pedir)
+        self.last_page = 0
+        self.total = None  # Número total de filas, cuando se conoce
+        self.rowCount = 0
+        try:
+            metaData = resultSet.getMetaData()
+            for i in range(1, metaData.getColumnCount() + 1):
+                self.columnNames.append(metaData.getColumnLabel(i))
+                self.columnTypes.append(metaData.getColumnClassName(i))
+            self.page_sql = _ordered_sql(self.sql, _sortable_columns(metaData))
+            rows = _read_rows(resultSet, len(self.columnNames), self.page_size)
+            more = truncated or (len(rows) == self.page_size and resultSet.next())
+        finally:
+            _close(resultSet)
+        if more:
+            # La primera página ha de salir en el mismo orden que las demás
+            try:
+                rows = self.fetch_page(0)
+            except:
+                print u"Advertencia: no se ha podido ordenar la consulta para leerla por paginas. %s" % sys.exc_info()[1]
+                self.page_sql = u"SELECT * FROM (%s) AS chatagent_page" % self.sql
+        self.pages[0] = rows
+        if more:
+            self.rowCount = self._limit(2 * self.page_size)
+            _get_page_executor().submit(_CountTask(self))
+        else:
+            self.total = len(rows)
+            self.rowCount = self.total
+
+    def getColumnCount(self):
+        return len(self.columnNames)
+
+    def getRowCount(self):
+        return self.rowCount
+
+    def getColumnName(self, col):
+        return self.columnNames[col]
+
+    def getValueAt(self, row, col):
+        page = row / self.page_size
+        self.last_page = page
+        rows = self.pages.get(page)
+        if rows is None:
+            self._request_page(page)
+            return None
+        self.pages[page] = self.pages.pop(page)  # Pasa a ser la usada más recientemente
+        offset = row - page * self.page_size
+        if offset >= len(rows):
+            return None
+        return rows[offset][col]
+
+    def getColumnClass(self, col):
+        try:
+            return Class.forName(self.columnTypes[col])
+        except Exception:
+            return Object
+
+    def is_page_wanted(self, page):
+        """
+        Indica si una página pendiente sigue cerca de la zona visible de la tabla;
+        si el usuario ya se ha desplazado lejos no se lee.
+        """
+        return abs(page - self.last_page) < self.max_pages
+
+    def fetch_page(self, page):
+        """
+        Lee de la base de datos las filas de una página. Se llama desde un hilo de fondo.
+        """
+        sql = u"%s LIMIT %d OFFSET %d" % (self.page_sql, self.page_size, page * self.page_size)
+        resultSet = executeSQL(self.dataModel, sql, stream=True)
+        try:
+            return _read_rows(resultSet, len(self.columnNames))
+        finally:
+            _close(resultSet)
+
+    def fetch_count(self):
+        """
+        Cuenta en la base de datos las filas del resultado. Se llama desde un hilo de fondo.
+        """
+        result = executeSQL(self.dataModel, u"SELECT COUNT(*) FROM (%s) AS chatagent_count" % self.sql)
+        if not isinstance(result, ResultSet):
+            return int(result)
+        try:
+            result.next()
+            return int(result.getObject(1))
+        finally:
+            _close(result)
+
+    def page_loaded(self, page, rows, failed=False):
+        self.pending.discard(page)
+        if failed:
+            attempts = self.failed.get(page, (0, 0))[0] + 1
+            delay = min(config.RESULTSET_PAGE_RETRY * 2 ** (attempts - 1), 300)
+            self.failed[page] = (attempts, time.time() + delay)
+            timer = Timer(int(delay * 1000), _RetryPageListener(self, page))
+            timer.setRepeats(False)
+            timer.start()
+            return
+        if rows is None:
+            return
+        self.failed.pop(page, None)
+        self.pages[page] = rows
+        while len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+        first = page * self.page_size
+        if self.total is None:
+            if len(rows) < self.page_size:
+                self.total = first + len(rows)
+                self._set_row_count(self.total)
+            else:
+                self._set_row_count(max(self.rowCount, first + 2 * self.page_size))
+        if rows and first < self.rowCount:
+            self.fireTableRowsUpdated(first, min(first + len(rows), self.rowCount) - 1)
+
+    def count_loaded(self, count):
+        self.total = self._limit(count)
+        self._set_row_count(self.total)
+        if self.max_rows and count >= self.max_rows and self.on_row_cap is not None:
+            self.on_row_cap(self.max_rows)
+
+    def retry_page(self, page):
+        """
+        Vuelve a pedir una página que no se pudo leer, si sigue cerca de la zona visible.
+        """
+        failure = self.failed.get(page)
+        if failure is None or page in self.pages or not self.is_page_wanted(page):
+            return
+        self.failed[page] = (failure[0], 0)
+        self._request_page(page)
+
+    def _request_page(self, page):
+        if page in self.pending:
+            return
+        failure = self.failed.get(page)
+        if failure is not None and failure[1] > time.time():
+            return
+        self.pending.add(page)
+        _get_page_executor().submit(_PageTask(self, page))
+
+    def _limit(self, count):
+        if self.max_rows:
+            return min(count, self.max_rows)
+        return count
+
+    def _set_row_count(self, count):
+        count = self._limit(count)
+        previous = self.rowCount
+        self.rowCount = count
+        if count > previous:
+            self.fireTableRowsInserted(previous, count - 1)
+        elif count < previous:
+            self.fireTableRowsDeleted(count, previous - 1)
+
+
 class ResultSetTablePanel(JPanel):
-    def __init__(self, resultSet):
+    def __init__(self, resultSet, tableModel=None):
+        """
+        Args:
+            resultSet (ResultSet): El resultado a mostrar; se carga entero en memoria,
+                                   almacenado por columnas (ver gvsigdesktop/columnar.py).
+            tableModel (TableModel, optional): El modelo de tabla a mostrar en lugar
+                                               del resultSet, como PagedResultSetTableModel.
+        """
         super(ResultSetTablePanel, self).__init__(BorderLayout())
         self.setPreferredSize(Dimension(800, 300)) # Tamaño preferido para la ventana
-        self.tableModel = ResultSetTableModel(resultSet)
+        if tableModel is None:
+            tableModel = ColumnarTableModel(ColumnarResult.from_result_set(resultSet))
+        self.tableModel = tableModel
         self.table = JTable(self.tableModel)
         self.table.setAutoResizeMode(JTable.AUTO_RESIZE_OFF) # Permite scroll horizontal
         self.table.getTableHeader().setReorderingAllowed(False) # Evita reordenar columnas
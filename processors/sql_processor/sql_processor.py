@@ -6,7 +6,7 @@ Contiene la lógica para ejecutar consultas SQL generadas por la IA y mostrar lo
 import gvsig
 
 import java
-from javax.swing import JPanel, JTable, JScrollPane, BorderFactory, SwingWorker,JButton
+from javax.swing import JPanel, JTable, JScrollPane, BorderFactory, SwingWorker,JButton, Timer
 from javax.swing.table import AbstractTableModel
 from java.awt import BorderLayout, Dimension, Font
 from java.lang import String, Class, Object
@@ -17,10 +17,15 @@ from java.awt.event import MouseAdapter, MouseEvent
 
 from datetime import datetime
 
+from addons.chatagent_prototype import config
+from addons.chatagent_prototype import tracing
 from addons.chatagent_prototype.processor import Processor
 from addons.chatagent_prototype.utils import loadImageIntoLabel
 from addons.chatagent_prototype.gvsigdesktop.utils import executeSQL, showPanel, addToToolBar
-from addons.chatagent_prototype.processors.sql_processor.resultsetpanel import ResultSetTablePanel
+from addons.chatagent_prototype.gvsigdesktop.columnar import ColumnarResult, ColumnarTableModel
+from addons.chatagent_prototype.gvsigdesktop.resultcache import execute_cached
+from addons.chatagent_prototype.gvsigdesktop.querylimits import QueryHandle, QueryTimeout, QueryCancelled, get_query_limits
+from addons.chatagent_prototype.processors.sql_processor.resultsetpanel import ResultSetTablePanel, PagedResultSetTableModel
 
 class SqlProcessor(Processor):
     """
@@ -39,6 +44,12 @@ class SqlProcessor(Processor):
         """
         return u"Permite realizar consultas SQL en lenguaje natural."
 
+    def get_intent_keywords(self):
+        return [u"cuantos", u"cuantas", u"lista", u"listado", u"listame", u"muestrame",
+                u"dame", u"consulta", u"registros", u"filas", u"total", u"suma",
+                u"media", u"promedio", u"maximo", u"minimo", u"selecciona", u"busca",
+                u"sql", u"select"]
+
     def get_initial_prompt_info(self):
         """
         Devuelve la parte del prompt inicial que describe este procesador.
@@ -74,14 +85,40 @@ class SqlProcessor(Processor):
   }
 """
 
+    def get_response_schema(self):
+        """
+        Devuelve el esquema JSON de los campos de la respuesta de este procesador.
+        """
+        return {
+            "type": "object",
+            "properties": {
+                "sql": {"type": "string"},
+                "title": {"type": "string"},
+                "esValorEscalar": {"type": "boolean"}
+            },
+            "required": ["sql", "title", "esValorEscalar"]
+        }
+
+    def process_headless(self, data_model, user_query, json_response):
+        """
+        Ejecuta la consulta SQL de la respuesta y devuelve el número de filas
+        obtenidas (o el valor, si la consulta devuelve un escalar).
+        """
+        sql_query = json_response.getString("sql")
+        with tracing.span("sql", sql_chars=len(sql_query)) as span:
+            result = summarize_result(executeSQL(data_model, sql_query, stream=True))
+            span.set(**result)
+        result["sql"] = sql_query
+        return result
+
     def process_response(self, chat_panel, user_query, json_response ):
         try:
             sql_query = json_response.getString("sql")
             esValorEscalar = json_response.getBoolean("esValorEscalar", False)
             title = json_response.getString("title", u"Resultados de la consulta")
             if esValorEscalar:
-              worker = SqlExecutionWorker(title, sql_query, chat_panel)
-              worker.execute()
+              worker = SqlExecutionWorker(title, sql_query, chat_panel, scalar=True)
+              worker.execute_query()
             else:
               executeListener = ExecuteListener(title, sql_query, chat_panel)
               button = JButton("Abrir")
@@ -113,35 +150,110 @@ class ExecuteListener(ActionListener):
         self.chat_panel = chat_panel
     def actionPerformed(self, event=None):
         worker = SqlExecutionWorker(self.title, self.sql_query, self.chat_panel)
-        worker.execute()
-            
+        worker.execute_query()
+
+# Milisegundos que ha de durar una consulta para ofrecer cancelarla desde el chat
+CANCEL_BUTTON_DELAY = 1500
+
+class ShowCancelListener(ActionListener):
+    def __init__(self, worker):
+        self.worker = worker
+    def actionPerformed(self, event=None):
+        if self.worker.isDone():
+            return
+        button = JButton("Cancelar")
+        button.setFont(Font("Monospaced", Font.PLAIN, 12))
+        button.addActionListener(CancelListener(self.worker))
+        self.worker.cancelButton = button
+        self.worker.chat_panel.append_message(self.worker.chat_panel.getAgentName(),
+            u"Ejecutando la consulta '%s' (máximo %s). {component}" % (self.worker.title, self.worker.describe_limits()), button)
+
+class CancelListener(ActionListener):
+    def __init__(self, worker):
+        self.worker = worker
+    def actionPerformed(self, event=None):
+        event.getSource().setEnabled(False)
+        self.worker.handle.cancel()
+
 class SqlExecutionWorker(SwingWorker):
-    def __init__(self, title, sql_query, chat_panel):
+    def __init__(self, title, sql_query, chat_panel, scalar=False):
         self.title= title
         self.sql_query = sql_query
         self.chat_panel = chat_panel
-        self.resultSet = None
+        self.scalar = scalar
+        self.limits = get_query_limits(chat_panel.getDataModel())
+        self.handle = QueryHandle()
+        self.cancelButton = None
+        self.result = None
+        self.tableModel = None
         self.exception = None
 
+    def execute_query(self):
+        """
+        Lanza la consulta en segundo plano. Si tarda, se añade al chat un botón para cancelarla.
+        """
+        self.execute()
+        timer = Timer(CANCEL_BUTTON_DELAY, ShowCancelListener(self))
+        timer.setRepeats(False)
+        timer.start()
+
+    def describe_limits(self):
+        timeout, max_rows = self.limits
+        parts = []
+        if timeout:
+            parts.append(u"%s s" % timeout)
+        if max_rows:
+            parts.append(u"%d filas" % max_rows)
+        return u", ".join(parts) or u"sin límites"
+
     def doInBackground(self):
         try:
-            self.resultSet = executeSQL(self.chat_panel.getDataModel(),  self.sql_query)
+            with tracing.span("sql", sql_chars=len(self.sql_query)):
+                dataModel = self.chat_panel.getDataModel()
+                # Solo se leen las filas de una pagina (y se mira si hay mas): los
+                # resultados pequeños se guardan en la cache y los grandes se leen
+                # por paginas segun se desplace la tabla
+                self.result = execute_cached(dataModel,  self.sql_query, self.handle, max_rows=config.RESULTSET_PAGE_SIZE)
+                if isinstance(self.result, ColumnarResult):
+                    if self.result.truncated:
+                        self.tableModel = PagedResultSetTableModel(dataModel, self.sql_query, self.result.cursor(),
+                            truncated=True, on_row_cap=self.row_cap_reached)
+                    else:
+                        self.tableModel = ColumnarTableModel(self.result)
         except Exception as e:
             self.exception = e
             print "Error en doInBackground (SqlExecutionWorker): %s" % e
         return None # SwingWorker requiere un retorno
 
+    def row_cap_reached(self, max_rows):
+        # Lo llama la tabla por páginas cuando conoce el total de filas
+        self.chat_panel.append_message(self.chat_panel.getAgentName(),
+            u"'%s': se muestran solo las primeras %d filas (máximo de filas del modelo de datos)." % (self.title, max_rows))
+
     def done(self):
+        if self.cancelButton is not None:
+            self.cancelButton.setEnabled(False)
         try:
-            if self.exception:
+            timeout, max_rows = self.limits
+            if isinstance(self.exception, QueryTimeout):
+                self.chat_panel.append_message(self.chat_panel.getAgentName(),
+                    u"La consulta '%s' ha superado el tiempo máximo de %s s y se ha cancelado." % (self.title, timeout))
+            elif isinstance(self.exception, QueryCancelled):
+                self.chat_panel.append_message(self.chat_panel.getAgentName(),u"Consulta '%s' cancelada." % self.title)
+            elif self.exception:
                 self.chat_panel.append_message(self.chat_panel.getAgentName(),u"Error al ejecutar la consulta.")
-            elif isinstance(self.resultSet, ResultSet):
-                table_panel = ResultSetTablePanel(self.resultSet)
-                showPanel(table_panel, self.title)
-            elif self.resultSet == None:
+            elif isinstance(self.result, ColumnarResult) and self.scalar and \
+                    self.result.get_row_count() == 1 and self.result.get_column_count() == 1:
+                self.chat_panel.append_message(self.chat_panel.getAgentName(),u"%s: %s" % (self.title, self.result.get_value(0, 0)))
+            elif isinstance(self.result, ColumnarResult):
+                with tracing.span("render", kind="table") as span:
+                    table_panel = ResultSetTablePanel(None, self.tableModel)
+                    showPanel(table_panel, self.title)
+                    span.set(rows=table_panel.tableModel.getRowCount())
+            elif self.result == None:
               self.chat_panel.append_message(self.chat_panel.getAgentName(),u"No se han obtenido resultados.")
             else:
-                s = str(self.resultSet)
+                s = str(self.result)
                 if s:
                   self.chat_panel.append_message(self.chat_panel.getAgentName(),u"%s: %s" % (self.title,s))
                 else:
@@ -150,6 +262,23 @@ class SqlExecutionWorker(SwingWorker):
             self.chat_panel.append_message(self.chat_panel.getAgentName(),u"Error al mostrar los resultados de la consulta.")
             print "Error en done (SqlExecutionWorker): %s" % e
 
+def summarize_result(result):
+    """
+    Recorre y cierra el resultado de executeSQL, devolviendo un resumen.
+
+    Returns:
+        dict: {"rows": n} si es un ResultSet, o {"value": valor} si es un escalar.
+    """
+    if not isinstance(result, ResultSet):
+        return {"value": None if result is None else unicode(result)}
+    rows = 0
+    try:
+        while result.next():
+            rows += 1
+    finally:
+        result.close()
+    return {"rows": rows}
+
 def main(**args):
   print "ok"
   
\ No newline at end of file
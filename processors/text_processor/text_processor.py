@@ -24,6 +24,11 @@ class TextProcessor(Processor):
         """
         return u"Gestiona consultas de texto generales."
 
+    def get_intent_keywords(self):
+        return [u"hola", u"buenos dias", u"buenas tardes", u"buenas noches", u"gracias",
+                u"adios", u"ayuda", u"que puedes hacer", u"quien eres", u"explica",
+                u"que significa", u"que es", u"por que"]
+
     def get_initial_prompt_info(self):
         """
         Devuelve la parte del prompt inicial que describe este procesador.
@@ -42,6 +47,21 @@ class TextProcessor(Processor):
   }
 """
 
+    def get_response_schema(self):
+        """
+        Devuelve el esquema JSON de los campos de la respuesta de este procesador.
+        """
+        return {
+            "type": "object",
+            "properties": {
+                "message": {"type": "string"}
+            },
+            "required": ["message"]
+        }
+
+    def process_headless(self, data_model, user_query, json_response):
+        return {"message_chars": len(json_response.getString("message", u""))}
+
     def process_response(self, chat, user_query, json_response):
         try:
             message = json_response.getString("message")
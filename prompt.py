@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: prompt
+
+Descripción:
+Construcción del prompt inicial que se envía al modelo: el prompt base de la
+configuración completado con la descripción de los procesadores registrados
+y el DDL de las tablas del modelo de datos.
+Lo comparten el panel de chat y el modo por lotes (batch).
+La extensión de la vista actual no forma parte del prompt inicial, que se
+prepara al seleccionar el modelo de datos y puede quedar en la cache de
+contexto; build_turn_context la añade en cada turno.
+
+Con config.PROMPT_SECTIONS_ON_DEMAND el prompt inicial no lleva las
+instrucciones detalladas de los procesadores; build_turn_context devuelve las
+del procesador seleccionado para cada turno.
+En modelos de datos grandes (config.SCHEMA_PRUNING_ENABLED) el prompt inicial
+solo lleva la lista de tablas y build_schema_context devuelve el DDL de las
+tablas relacionadas con cada petición, junto con los valores de los
+diccionarios grandes que coinciden con ella.
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+"""
+
+from java.lang import StringBuilder
+
+from addons.chatagent_prototype import config
+from addons.chatagent_prototype import tracing
+from addons.chatagent_prototype.gvsigdesktop.utils import getDDL, getCurrentViewBboxAsWKT
+from addons.chatagent_prototype.gvsigdesktop.schemaindex import get_schema_index
+from addons.chatagent_prototype.gvsigdesktop.dictindex import get_dictionary_index, format_matches
+from addons.chatagent_prototype.gvsigdesktop.ddlformat import DDL_FORMATS, estimate_tokens
+
+
+ON_DEMAND_SECTIONS_NOTE = u"""
+Las instrucciones detalladas del tipo de consulta que corresponda se incluiran
+junto a cada peticion del usuario, tras el texto "Instrucciones para esta peticion".
+Siguelas al construir la respuesta de esa peticion.
+"""
+
+SCHEMA_ON_DEMAND_NOTE = u"""
+El modelo de datos tiene muchas tablas y aqui solo se listan sus nombres. La
+definicion (DDL) de las tablas relacionadas con cada peticion se incluira junto
+a ella, en "Instrucciones para esta peticion". Usa solo tablas y columnas que
+aparezcan en esa definicion; si falta alguna tabla que necesites, dilo.
+
+Tablas del modelo de datos:
+"""
+
+def build_initial_prompt(processors, data_model, sections_on_demand=None):
+    """
+    Construye el prompt inicial para un modelo de datos.
+
+    Args:
+        processors (dict): Los procesadores registrados, indexados por su tipo.
+        data_model (str): El identificador del modelo de datos.
+        sections_on_demand (bool, optional): Si es True no se incluyen las instrucciones
+                                             detalladas de los procesadores (ver build_turn_context).
+                                             Por defecto config.PROMPT_SECTIONS_ON_DEMAND.
+
+    Returns:
+        str: El prompt inicial, o None si no hay modelo de datos.
+    """
+    if not data_model:
+        return None
+    if sections_on_demand is None:
+        sections_on_demand = config.PROMPT_SECTIONS_ON_DEMAND
+    supported_query_types = StringBuilder()
+    detailed_query_descriptions = StringBuilder()
+    for processor_type in sorted(processors.keys()): # Ordenar para una salida consistente
+        processor = processors[processor_type]
+        supported_query_types.append("- %s: %s\n" % (processor.get_type(), processor.get_description()))
+        if not sections_on_demand:
+            detailed_query_descriptions.append(processor.get_initial_prompt_info())
+    if sections_on_demand:
+        detailed_query_descriptions.append(ON_DEMAND_SECTIONS_NOTE)
+    if schema_pruning_active(data_model):
+        ddl_info = SCHEMA_ON_DEMAND_NOTE + get_schema_index(data_model).catalog()
+    else:
+        ddl_info = getDDL(data_model)
+    full_prompt_text = config.BASE_INITIAL_PROMPT.replace("{supported_query_types}", supported_query_types.toString())
+    full_prompt_text = full_prompt_text.replace("{ddl_info}", ddl_info)
+    full_prompt_text = full_prompt_text.replace("{detailed_query_descriptions}", detailed_query_descriptions.toString())
+    return full_prompt_text
+
+def schema_pruning_active(data_model):
+    """
+    Indica si el prompt del modelo de datos lleva solo la lista de tablas y el
+    DDL de cada petición se selecciona con build_schema_context.
+    """
+    if not config.SCHEMA_PRUNING_ENABLED or not data_model:
+        return False
+    return len(get_schema_index(data_model)) >= config.SCHEMA_PRUNING_MIN_TABLES
+
+def build_schema_context(data_model, user_prompt, previous_tables=None):
+    """
+    Selecciona las tablas relacionadas con una petición y devuelve su DDL,
+    junto con las entradas de los diccionarios grandes que coinciden con ella
+    (ver build_dictionary_context).
+
+    Args:
+        data_model (str): El identificador del modelo de datos.
+        user_prompt (str): La petición del usuario.
+        previous_tables (list, optional): Las tablas seleccionadas en el turno anterior.
+                                          Se usan cuando la petición no menciona ninguna
+                                          tabla (por ejemplo, "¿y en 2020?").
+
+    Returns:
+        tuple: (texto para la petición o None, lista de tablas seleccionadas o None si
+               el modelo de datos no usa la selección de tablas).
+    """
+    sections = []
+    tables = None
+    if schema_pruning_active(data_model):
+        with tracing.span("schema_select") as span:
+            tables = get_schema_index(data_model).select_tables(user_prompt, config.SCHEMA_PRUNING_TOP_K)
+            if not tables:
+                tables = previous_tables or []
+            span.set(tables=len(tables))
+            if tables:
+                ddl = getDDL(data_model, tables=tables)
+                span.set(ddl_chars=len(ddl))
+                sections.append(u"Definicion de las tablas relacionadas con esta peticion:\n%s" % ddl)
+    dictionary_context = build_dictionary_context(data_model, user_prompt)
+    if dictionary_context:
+        sections.append(dictionary_context)
+    if not sections:
+        return (None, tables)
+    return (u"\n".join(sections), tables)
+
+def build_dictionary_context(data_model, user_prompt):
+    """
+    Busca los términos de la petición en los diccionarios que el DDL solo
+    muestra en parte (más de config.DICTIONARY_SAMPLE_SIZE valores).
+
+    Returns:
+        str: Las entradas que coinciden, o None si no hay ninguna.
+    """
+    if not data_model or not config.DICTIONARY_SAMPLE_SIZE:
+        return None
+    with tracing.span("dictionary_match") as span:
+        index = get_dictionary_index(data_model, config.DICTIONARY_SAMPLE_SIZE)
+        matches = index.match(user_prompt, config.DICTIONARY_MATCH_MAX, config.DICTIONARY_MATCH_MIN_SCORE)
+        span.set(entries=len(index), matches=len(matches))
+    if not matches:
+        return None
+    return u"Valores de diccionario que coinciden con terminos de la peticion (usa sus claves en las SQL):\n%s" % format_matches(matches)
+
+def build_turn_context(processors, processor_type, schema_context=None, view_bbox=None):
+    """
+    Devuelve las instrucciones a enviar en un turno: la extensión de la vista
+    actual, las detalladas del procesador cuando el prompt inicial se construye
+    con las secciones bajo demanda, y el DDL de las tablas seleccionadas (ver
+    build_schema_context).
+
+    Args:
+        processors (dict): Los procesadores registrados, indexados por su tipo.
+        processor_type (str): El tipo estimado para la petición, o None si no se
+                              ha podido clasificar; en ese caso se devuelven las
+                              instrucciones de todos los procesadores.
+        schema_context (str, optional): El DDL de las tablas del turno.
+        view_bbox (str, optional): La extensión de la vista en WKT. Por defecto
+                                   la de la vista actual de gvSIG.
+
+    Returns:
+        str: Las instrucciones del turno.
+    """
+    if view_bbox is None:
+        view_bbox = getCurrentViewBboxAsWKT()
+    sections = StringBuilder()
+    sections.append(u"Bounding-box de la Vista actual (WKT):\n%s\n" % view_bbox)
+    if config.PROMPT_SECTIONS_ON_DEMAND:
+        if processor_type in processors:
+            sections.append(processors[processor_type].get_initial_prompt_info())
+        else:
+            for name in sorted(processors.keys()):
+                sections.append(processors[name].get_initial_prompt_info())
+    if schema_context:
+        sections.append(u"\n").append(schema_context)
+    return sections.toString()
+
+def measure_ddl_formats(data_model, count_tokens=None):
+    """
+    Mide el tamaño del DDL completo del modelo de datos en cada formato de
+    ddlformat, para elegir el que ocupa menos tokens sin perder precisión en las SQL.
+
+    Args:
+        data_model (str): El identificador del modelo de datos.
+        count_tokens (callable, optional): Función que devuelve los tokens de un texto.
+                                           Por defecto GeminiClient.count_tokens si hay
+                                           clave del API; si no, una estimación.
+
+    Returns:
+        dict: Formato -> dict con las claves chars, tokens y estimated.
+    """
+    if count_tokens is None and config.API_KEY:
+        from addons.chatagent_prototype.aiclients.gemini import GeminiClient
+        count_tokens = GeminiClient().count_tokens
+    results = {}
+    print u"%-8s %10s %10s %8s" % (u"formato", u"caracteres", u"tokens", u"relativo")
+    for ddl_format in DDL_FORMATS:
+        ddl = getDDL(data_model, ddl_format=ddl_format)
+        estimated = count_tokens is None
+        tokens = None
+        if not estimated:
+            try:
+                tokens = count_tokens(ddl)
+            except Exception, e:
+                print u"Advertencia: no se han podido contar los tokens, se estiman. %s" % e
+                estimated = True
+        if estimated:
+            tokens = estimate_tokens(ddl)
+        results[ddl_format] = {"chars": len(ddl), "tokens": tokens, "estimated": estimated}
+    base = results[DDL_FORMATS[0]]["tokens"] or 1
+    for ddl_format in DDL_FORMATS:
+        result = results[ddl_format]
+        print u"%-8s %10d %9d%s %7.0f%%" % (ddl_format, result["chars"], result["tokens"],
+                                           u"~" if result["estimated"] else u" ", 100.0 * result["tokens"] / base)
+    return results
+
+
+def main(**args):
+  data_model = args.get("data_model")
+  if data_model:
+    measure_ddl_formats(data_model)
+  print "Ok"
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Módulo: tracing
+
+Descripción:
+Instrumentación ligera de la latencia de cada turno del chat.
+Cada etapa de un turno (construcción del prompt, llamada al modelo, parseo de
+la respuesta, procesador, ejecución de la SQL y representación del resultado)
+se mide con un "span" que lleva asociados atributos como los tokens consumidos
+o el tamaño de los datos. Cada span se añade como una línea JSON a un fichero
+rotativo y se conserva en memoria para calcular estadísticas (p50/p95) por etapa.
+Está diseñado para ejecutarse en Jython 2.7 sobre Java 1.8.
+
+Uso:
+    from addons.chatagent_prototype import tracing
+    with tracing.span("sql", sql_chars=len(sql)) as span:
+        ...
+        span.set(rows=n)
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+from addons.chatagent_prototype import config
+
+STAGES = ("turn", "prompt_build", "network", "parse", "processor", "sql", "render")
+
+
+class Span:
+    """
+    Medida de una etapa en curso. Los atributos añadidos con set se guardan
+    junto a la duración al cerrar el span.
+    """
+    def __init__(self, name, turn, attrs):
+        self.name = name
+        self.turn = turn
+        self.attrs = attrs
+        self.start = time.time()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def elapsed_ms(self):
+        return int((time.time() - self.start) * 1000)
+
+
+class Tracer:
+    """
+    Registra spans en un fichero JSONL rotativo y en memoria.
+    Es seguro usarlo desde varios hilos.
+    """
+
+    def __init__(self, path=None, max_bytes=None, backups=None, window=None, enabled=None):
+        """
+        Args:
+            path (str, optional): Fichero de trazas. Por defecto config.TRACE_FILE.
+            max_bytes (int, optional): Tamaño a partir del que se rota. Por defecto config.TRACE_MAX_BYTES.
+            backups (int, optional): Ficheros rotados a conservar. Por defecto config.TRACE_BACKUPS.
+            window (int, optional): Spans por etapa conservados en memoria. Por defecto config.TRACE_STATS_WINDOW.
+            enabled (bool, optional): Si se escribe el fichero de trazas. Por defecto config.TRACE_ENABLED.
+        """
+        if path is None:
+            path = config.TRACE_FILE
+        if max_bytes is None:
+            max_bytes = config.TRACE_MAX_BYTES
+        if backups is None:
+            backups = config.TRACE_BACKUPS
+        if window is None:
+            window = config.TRACE_STATS_WINDOW
+        if enabled is None:
+            enabled = config.TRACE_ENABLED
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.window = window
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.turn = 0
+        self.durations = {}  # Etapa -> deque con las últimas duraciones en ms
+
+    def new_turn(self):
+        """
+        Empieza un nuevo turno del chat. Los spans que se abran a partir de ahora,
+        desde cualquier hilo, se asocian a él.
+
+        Returns:
+            int: El número del turno.
+        """
+        self.lock.acquire()
+        try:
+            self.turn += 1
+            return self.turn
+        finally:
+            self.lock.release()
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """
+        Mide la duración del bloque 'with' como una etapa 'name'.
+        Si el bloque lanza una excepción se registra en el atributo "error".
+        El span se asocia al turno en curso salvo que se indique otro con 'turn'.
+        """
+        turn = attrs.pop("turn", self.turn)
+        span = Span(name, turn, attrs)
+        try:
+            yield span
+        except:
+            span.set(error=unicode(sys.exc_info()[1]))
+            raise
+        finally:
+            self.record(name, span.elapsed_ms(), turn=span.turn, **span.attrs)
+
+    def record(self, name, duration_ms, turn=None, **attrs):
+        """
+        Registra una etapa ya medida.
+        """
+        record = {
+            "ts": time.time(),
+            "turn": self.turn if turn is None else turn,
+            "stage": name,
+            "duration_ms": duration_ms
+        }
+        record.update(attrs)
+        self.lock.acquire()
+        try:
+            durations = self.durations.get(name)
+            if durations is None:
+                durations = deque(maxlen=self.window)
+                self.durations[name] = durations
+            durations.append(duration_ms)
+            if self.enabled:
+                self._write(record)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """
+        Devuelve las estadísticas de duración de cada etapa con los spans en memoria.
+
+        Returns:
+            dict: Etapa -> dict con las claves count, p50, p95 y max (en ms).
+        """
+        self.lock.acquire()
+        try:
+            snapshot = dict([(name, sorted(durations)) for name, durations in self.durations.items()])
+        finally:
+            self.lock.release()
+        result = {}
+        for name, values in snapshot.items():
+            if not values:
+                continue
+            result[name] = {
+                "count": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "max": values[-1]
+            }
+        return result
+
+    def format_stats(self):
+        """
+        Devuelve las estadísticas como una tabla de texto para mostrarla en el chat.
+        """
+        stats = self.stats()
+        if not stats:
+            return u"No hay trazas registradas todavía."
+        names = [name for name in STAGES if name in stats]
+        names.extend(sorted([name for name in stats if name not in STAGES]))
+        lines = [u"%-14s %6s %8s %8s %8s" % (u"etapa", u"n", u"p50 ms", u"p95 ms", u"max ms")]
+        for name in names:
+            s = stats[name]
+            lines.append(u"%-14s %6d %8d %8d %8d" % (name, s["count"], s["p50"], s["p95"], s["max"]))
+        return u"\n".join(lines)
+
+    def _write(self, record):
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                self._rotate()
+            f = open(self.path, "ab")
+            try:
+                f.write(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+                f.write("\n")
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            print u"Advertencia: no se ha podido escribir la traza en '%s'. %s" % (self.path, e)
+
+    def _rotate(self):
+        # traces.jsonl -> traces.jsonl.1 -> traces.jsonl.2 ...; el más antiguo se descarta
+        oldest = "%s.%d" % (self.path, self.backups)
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for n in range(self.backups - 1, 0, -1):
+            name = "%s.%d" % (self.path, n)
+            if os.path.exists(name):
+                os.rename(name, "%s.%d" % (self.path, n + 1))
+        if self.backups > 0:
+            os.rename(self.path, "%s.1" % self.path)
+        else:
+            os.remove(self.path)
+
+
+def percentile(sorted_values, p):
+    """
+    Percentil 'p' (método del rango más cercano) de una lista ordenada.
+    """
+    if not sorted_values:
+        return None
+    rank = int((p / 100.0) * len(sorted_values) + 0.5)
+    rank = min(max(rank, 1), len(sorted_values))
+    return sorted_values[rank - 1]
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+def get_tracer():
+    """
+    Devuelve el Tracer compartido por toda la aplicación.
+    """
+    global _tracer
+    if _tracer is None:
+        _tracer_lock.acquire()
+        try:
+            if _tracer is None:
+                _tracer = Tracer()
+        finally:
+            _tracer_lock.release()
+    return _tracer
+
+def span(name, **attrs):
+    """
+    Abreviatura de get_tracer().span(name, **attrs).
+    """
+    return get_tracer().span(name, **attrs)
+
+def record(name, duration_ms, **attrs):
+    """
+    Abreviatura de get_tracer().record(name, duration_ms, **attrs).
+    """
+    get_tracer().record(name, duration_ms, **attrs)
+
+
+def main(**args):
+  tracer = Tracer(enabled=False)
+  for i in range(100):
+    tracer.record("network", i * 10)
+  print tracer.format_stats()
+  print "Ok"
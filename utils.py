@@ -25,6 +25,10 @@ def send_message(api, user_input, initial_prompt=None):
   response = api.send_message(user_input,initial_prompt)  
   return response
 
+def send_message_async(api, user_input, initial_prompt=None, on_chunk=None, turn_context=None):
+  request = api.send_message_async(user_input,initial_prompt,on_chunk=on_chunk,turn_context=turn_context)
+  return request
+
 def loadImageIntoLabel(label, imagePath):
     """
     Carga una imagen desde la ruta de archivo especificada (PNG) y la establece
@@ -126,6 +130,24 @@ def extraer_json_de_markdown(texto_completo):
     # Si no se encuentra el patrón completo (inicio y fin), devolver None y el texto original
     return None, texto_completo
 
+def extraer_json(texto_completo):
+    """
+    Obtiene el JSON de la respuesta del modelo.
+    Con salida estructurada la respuesta es directamente un objeto JSON y se
+    devuelve tal cual, sin buscar marcas de Markdown; en otro caso se busca
+    el bloque JSON con extraer_json_de_markdown.
+
+    Args:
+        texto_completo (unicode): La respuesta del modelo.
+
+    Returns:
+        tuple: El JSON (unicode) o None si no se encuentra, y el texto restante.
+    """
+    texto = texto_completo.strip()
+    if texto.startswith(u"{") and texto.endswith(u"}"):
+        return texto, u""
+    return extraer_json_de_markdown(texto)
+
 BUTTON_PLACEHOLDER = "{component}"
 
 def insertText(editorPane, text, *components): 